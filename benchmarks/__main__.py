@@ -0,0 +1,200 @@
+"""
+Нагрузочные тесты REST и WebSocket API.
+
+Запуск из корня репозитория:
+    python -m benchmarks run --backend memory --users 50 --output results.json
+    python -m benchmarks run --backend sqlite --set messages.write_behind=true
+    python -m benchmarks compare before.json after.json
+    python -m benchmarks serialization --messages 5000 --recipients 100
+
+Сценарии: signup_burst, login_burst, get_users, chat_history, websocket_fanout.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+import httpx
+import toml
+
+from benchmarks import scenarios
+from benchmarks.server import REPOSITORY_ROOT, BenchmarkServer
+
+SCENARIOS = ('signup_burst', 'login_burst', 'get_users', 'chat_history', 'websocket_fanout')
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPOSITORY_ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def _run_scenarios(server: BenchmarkServer, args) -> dict:
+    selected = set(args.scenarios)
+    results = {}
+    prefix = uuid.uuid4().hex[:6]
+    logins = [f'bench{prefix}{index}' for index in range(max(args.users, args.ws_groups * args.ws_members))]
+    tokens = {}
+
+    limits = httpx.Limits(max_connections=args.concurrency * 2)
+    async with httpx.AsyncClient(base_url=server.base_url, timeout=120.0, limits=limits) as client:
+        # Пользователи и токены нужны всем сценариям, поэтому регистрация и вход выполняются всегда
+        results['signup_burst'] = await scenarios.signup_burst(client, logins, args.concurrency)
+        results['login_burst'] = await scenarios.login_burst(client, logins, tokens, args.concurrency)
+
+        if 'get_users' in selected:
+            results['get_users'] = await scenarios.get_users(client, tokens, args.requests, args.concurrency)
+        if 'chat_history' in selected:
+            results['chat_history'] = await scenarios.chat_history(
+                client, server.ws_url, tokens, args.history, args.requests, args.concurrency
+            )
+        if 'websocket_fanout' in selected:
+            results['websocket_fanout'] = await scenarios.websocket_fanout(
+                client, server.ws_url, tokens, args.ws_groups, args.ws_members, args.ws_messages
+            )
+
+    return {name: result.to_dict() for name, result in results.items() if name in selected}
+
+
+def _print_results(results: dict):
+    print(f"{'scenario':<20}{'ops':>8}{'err':>6}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, result in results.items():
+        latency = result['latency_ms']
+        print(f"{name:<20}{result['operations']:>8}{result['errors']:>6}"
+              f"{result['throughput_ops'] or 0:>10.1f}"
+              f"{latency['p50'] or 0:>10.2f}{latency['p95'] or 0:>10.2f}{latency['p99'] or 0:>10.2f}")
+        if 'fanout_latency_ms' in result:
+            fanout = result['fanout_latency_ms']
+            print(f"{'  fan-out':<20}{result['deliveries_received']:>8}"
+                  f"{result['deliveries_expected'] - result['deliveries_received']:>6}"
+                  f"{result['deliveries_per_s'] or 0:>10.1f}"
+                  f"{fanout['p50'] or 0:>10.2f}{fanout['p95'] or 0:>10.2f}{fanout['p99'] or 0:>10.2f}")
+
+
+def _parse_settings(items) -> dict:
+    """
+    Разбирает параметры вида секция.ключ=значение, значение читается как TOML
+    """
+    settings = {}
+    for item in items:
+        path, _, value = item.partition('=')
+        section, _, key = path.partition('.')
+        settings.setdefault(section, {})[key] = toml.loads(f'value = {value}')['value']
+    return settings
+
+
+def run(args):
+    settings = _parse_settings(args.settings)
+    with BenchmarkServer(backend=args.backend, workers=args.workers, settings=settings) as server:
+        results = asyncio.run(_run_scenarios(server, args))
+
+    report = {
+        'commit': _git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': sys.version.split()[0],
+        'parameters': {
+            'backend': args.backend,
+            'workers': args.workers,
+            'users': args.users,
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'history': args.history,
+            'ws_groups': args.ws_groups,
+            'ws_members': args.ws_members,
+            'ws_messages': args.ws_messages,
+            'settings': settings,
+        },
+        'scenarios': results,
+    }
+
+    _print_results(results)
+
+    output = args.output or os.path.join(
+        REPOSITORY_ROOT, 'benchmarks', 'results', f"{report['commit'] or 'local'}-{int(time.time())}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2, ensure_ascii=False)
+    print(f'Результаты сохранены в {output}')
+
+
+def _delta(before, after):
+    if before is None or after is None:
+        return '-'
+    if before == 0:
+        return f'{after:.2f}'
+    return f'{after:.2f} ({(after - before) / before * 100:+.1f}%)'
+
+
+def compare(args):
+    with open(args.before) as file:
+        before = json.load(file)
+    with open(args.after) as file:
+        after = json.load(file)
+
+    print(f"{before.get('commit')} -> {after.get('commit')}")
+    for name, after_result in after['scenarios'].items():
+        before_result = before['scenarios'].get(name)
+        if not before_result:
+            continue
+        print(name)
+        print(f"  {'ops/s':<8}{_delta(before_result['throughput_ops'], after_result['throughput_ops'])}")
+        for key in ('p50', 'p95', 'p99'):
+            print(f"  {key:<8}{_delta(before_result['latency_ms'][key], after_result['latency_ms'][key])}")
+        if 'fanout_latency_ms' in after_result and 'fanout_latency_ms' in before_result:
+            for key in ('p50', 'p95', 'p99'):
+                print(f"  {'fan ' + key:<8}"
+                      f"{_delta(before_result['fanout_latency_ms'][key], after_result['fanout_latency_ms'][key])}")
+
+
+def serialization(args):
+    # Модули приложения импортируются только для этой команды: run запускает сервер отдельным процессом
+    from benchmarks import serialization as serialization_benchmark
+
+    results = serialization_benchmark.run(args.messages, args.recipients, args.repeat)
+    serialization_benchmark.print_results(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Нагрузочные тесты мессенджера')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Запустить сценарии')
+    run_parser.add_argument('--backend', choices=('memory', 'sqlite'), default='memory')
+    run_parser.add_argument('--workers', type=int, default=1)
+    run_parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    run_parser.add_argument('--users', type=int, default=50, help='Количество регистрируемых пользователей')
+    run_parser.add_argument('--concurrency', type=int, default=16)
+    run_parser.add_argument('--requests', type=int, default=200, help='Количество запросов в REST сценариях')
+    run_parser.add_argument('--history', type=int, default=2000, help='Количество сообщений в истории чата')
+    run_parser.add_argument('--ws-groups', type=int, default=5)
+    run_parser.add_argument('--ws-members', type=int, default=10)
+    run_parser.add_argument('--ws-messages', type=int, default=20, help='Сообщений от каждого клиента')
+    run_parser.add_argument('--set', dest='settings', action='append', default=[], metavar='SECTION.KEY=VALUE',
+                            help='Параметр файла настроек сервера, например messages.write_behind=true')
+    run_parser.add_argument('--output', help='Файл для сохранения результатов в формате JSON')
+    run_parser.set_defaults(handler=run)
+
+    compare_parser = commands.add_parser('compare', help='Сравнить два файла с результатами')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.set_defaults(handler=compare)
+
+    serialization_parser = commands.add_parser('serialization', help='Сравнить json и orjson')
+    serialization_parser.add_argument('--messages', type=int, default=5000, help='Сообщений в истории чата')
+    serialization_parser.add_argument('--recipients', type=int, default=100, help='Получателей кадра')
+    serialization_parser.add_argument('--repeat', type=int, default=20)
+    serialization_parser.set_defaults(handler=serialization)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+import asyncio
+import json
+import random
+import time
+from typing import Dict, List
+
+import httpx
+import websockets
+
+from benchmarks.stats import ScenarioResult, latency_summary, run_load
+
+PASSWORD = 'benchmark-password'
+
+
+def is_success(response: httpx.Response) -> bool:
+    """
+    Проверка успешности ответа. Обработчики приложения возвращают ошибки как объект HTTPException
+    в теле ответа с кодом 200, поэтому смотрим и на код ответа, и на тело
+    """
+    if response.status_code >= 400:
+        return False
+    try:
+        body = response.json()
+    except ValueError:
+        return True
+    return not (isinstance(body, dict) and 'detail' in body and body.get('status_code', 200) >= 400)
+
+
+def auth_headers(token: str) -> Dict[str, str]:
+    return {'Authorization': f'Bearer {token}'}
+
+
+async def signup_burst(client: httpx.AsyncClient, logins: List[str], concurrency: int) -> ScenarioResult:
+    async def signup(index: int) -> bool:
+        login = logins[index]
+        response = await client.post('/signup', json={
+            'login': login, 'password': PASSWORD, 'name': login.title(), 'surname': 'Bench',
+        })
+        return is_success(response)
+
+    return await run_load('signup_burst', signup, len(logins), concurrency)
+
+
+async def login_burst(client: httpx.AsyncClient, logins: List[str], tokens: Dict[str, str],
+                      concurrency: int) -> ScenarioResult:
+    async def login(index: int) -> bool:
+        user_login = logins[index]
+        response = await client.post('/login', data={'username': user_login, 'password': PASSWORD})
+        if not is_success(response):
+            return False
+        tokens[user_login] = response.json()['access_token']
+        return True
+
+    return await run_load('login_burst', login, len(logins), concurrency)
+
+
+async def get_users(client: httpx.AsyncClient, tokens: Dict[str, str], total: int,
+                    concurrency: int) -> ScenarioResult:
+    token_list = list(tokens.values())
+
+    async def request(index: int) -> bool:
+        response = await client.get('/users', headers=auth_headers(token_list[index % len(token_list)]))
+        return is_success(response)
+
+    return await run_load('get_users', request, total, concurrency)
+
+
+async def create_group_chat(client: httpx.AsyncClient, creator_token: str, members: List[str], name: str) -> str:
+    response = await client.post('/chats/', headers=auth_headers(creator_token),
+                                 json={'members_login': members, 'name': name})
+    if not is_success(response):
+        raise RuntimeError(f'Не удалось создать чат {name}: {response.text}')
+    return response.json()['chat_id']
+
+
+class BenchClient:
+    """
+    Клиент WebSocket, подключенный к одному чату. Отметка времени отправки передается в тексте
+    сообщения, поэтому задержку доставки можно посчитать у каждого получателя
+    """
+
+    def __init__(self, ws_url: str, login: str, token: str, chat_id: str):
+        self.url = f'{ws_url}/communication/ws?auth_token={token}'
+        self.login = login
+        self.token = token
+        self.chat_id = chat_id
+        self.connection = None
+        self.echo_latencies_ms: List[float] = []
+        self.fanout_latencies_ms: List[float] = []
+        self.received = 0
+        self._echo_waiters: Dict[int, asyncio.Future] = {}
+        self._reader = None
+
+    async def connect(self):
+        self.connection = await websockets.connect(self.url, max_size=None)
+        await self.connection.send(json.dumps({
+            'type': 1,
+            'content': {'chat_id': self.chat_id, 'auth_token': self.token},
+        }))
+        self._reader = asyncio.ensure_future(self._read())
+
+    async def _read(self):
+        try:
+            async for frame in self.connection:
+                received_ns = time.perf_counter_ns()
+                payload = json.loads(frame)
+                message = payload.get('message', {})
+                content = message.get('content', {})
+                if message.get('type') != 0 or not str(content.get('content', '')).startswith('bench|'):
+                    continue
+                _, sender, sequence, sent_ns = content['content'].split('|')
+                latency_ms = (received_ns - int(sent_ns)) / 1e6
+                if sender == self.login:
+                    self.echo_latencies_ms.append(latency_ms)
+                    waiter = self._echo_waiters.pop(int(sequence), None)
+                    if waiter and not waiter.done():
+                        waiter.set_result(True)
+                else:
+                    self.fanout_latencies_ms.append(latency_ms)
+                    self.received += 1
+        except websockets.ConnectionClosed:
+            pass
+
+    async def send(self, sequence: int, timeout: float = 30.0):
+        waiter = asyncio.get_running_loop().create_future()
+        self._echo_waiters[sequence] = waiter
+        await self.connection.send(json.dumps({
+            'type': 0,
+            'content': {
+                'creator_login': self.login,
+                'content': f'bench|{self.login}|{sequence}|{time.perf_counter_ns()}',
+            },
+        }))
+        await asyncio.wait_for(waiter, timeout)
+
+    async def close(self):
+        if self.connection:
+            await self.connection.close()
+        if self._reader:
+            await asyncio.gather(self._reader, return_exceptions=True)
+
+
+async def chat_history(client: httpx.AsyncClient, ws_url: str, tokens: Dict[str, str], history: int,
+                       total: int, concurrency: int) -> ScenarioResult:
+    logins = list(tokens)[:3]
+    creator = logins[0]
+    chat_id = await create_group_chat(client, tokens[creator], logins[1:], 'bench-history')
+
+    writer = BenchClient(ws_url, creator, tokens[creator], chat_id)
+    await writer.connect()
+    seed_started = time.perf_counter()
+    for sequence in range(history):
+        await writer.send(sequence)
+    seed_duration = time.perf_counter() - seed_started
+    await writer.close()
+
+    sizes = []
+
+    async def request(index: int) -> bool:
+        reader_login = logins[index % len(logins)]
+        response = await client.get(f'/chats/{chat_id}', headers=auth_headers(tokens[reader_login]))
+        sizes.append(len(response.content))
+        return is_success(response)
+
+    result = await run_load('chat_history', request, total, concurrency)
+    result.extra['history_messages'] = history
+    result.extra['response_bytes'] = max(sizes) if sizes else 0
+    result.extra['seed'] = {
+        'messages': history,
+        'duration_s': round(seed_duration, 3),
+        'latency_ms': latency_summary(writer.echo_latencies_ms),
+    }
+    return result
+
+
+async def websocket_fanout(client: httpx.AsyncClient, ws_url: str, tokens: Dict[str, str], groups: int,
+                           members: int, messages: int, timeout: float = 60.0) -> ScenarioResult:
+    logins = list(tokens)
+    if len(logins) < groups * members:
+        raise RuntimeError(f'Для {groups} групп по {members} участников нужно {groups * members} пользователей')
+
+    clients: List[BenchClient] = []
+    for group in range(groups):
+        group_logins = logins[group * members:(group + 1) * members]
+        chat_id = await create_group_chat(client, tokens[group_logins[0]], group_logins[1:], f'bench-group-{group}')
+        clients.extend(BenchClient(ws_url, login, tokens[login], chat_id) for login in group_logins)
+
+    await asyncio.gather(*(bench_client.connect() for bench_client in clients))
+
+    result = ScenarioResult('websocket_fanout')
+
+    async def sender(bench_client: BenchClient):
+        # Небольшой случайный сдвиг, чтобы клиенты не отправляли сообщения строго синхронно
+        await asyncio.sleep(random.random() / 100)
+        for sequence in range(messages):
+            try:
+                await bench_client.send(sequence)
+            except (asyncio.TimeoutError, websockets.ConnectionClosed):
+                result.errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(sender(bench_client) for bench_client in clients))
+
+    expected = len(clients) * messages * (members - 1)
+    deadline = time.monotonic() + timeout
+    while sum(bench_client.received for bench_client in clients) < expected and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    result.duration_s = time.perf_counter() - started
+
+    await asyncio.gather(*(bench_client.close() for bench_client in clients))
+
+    for bench_client in clients:
+        result.latencies_ms.extend(bench_client.echo_latencies_ms)
+
+    received = sum(bench_client.received for bench_client in clients)
+    result.extra['clients'] = len(clients)
+    result.extra['deliveries_expected'] = expected
+    result.extra['deliveries_received'] = received
+    result.extra['fanout_latency_ms'] = latency_summary(
+        [latency for bench_client in clients for latency in bench_client.fanout_latencies_ms]
+    )
+    result.extra['deliveries_per_s'] = round(received / result.duration_s, 2) if result.duration_s else None
+    return result
@@ -0,0 +1,103 @@
+"""
+Микробенчмарк сериализации: стандартный json против orjson.
+
+Сравниваются два пути:
+- history - ответ GET /chats/{chat_id} с историей из большого количества сообщений
+  (JSONResponse против ORJSONResponse);
+- fanout - рассылка одного кадра ResponseMessage группе получателей: раньше кадр кодировался
+  для каждого получателя в send_json, теперь кодируется один раз в encode_frame;
+- msgpack - тот же кадр в подпротоколе msgpack (encode_msgpack_frame) против JSON: время
+  кодирования и размер кадра.
+"""
+import json
+import time
+
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+from database.models import Message, MessageType, ResponseMessage, WebSocketMessage, encode_frame, \
+    encode_msgpack_frame
+
+
+def _history(messages: int) -> dict:
+    created_at = 1_700_000_000_000
+    return {
+        'chat_name': 'bench',
+        'created_at': created_at,
+        'members': [f'user{index}' for index in range(20)],
+        'messages': [
+            {
+                'id': f'{seq:012d}',
+                'seq': seq,
+                'created_at': created_at + seq,
+                'creator_login': f'user{seq % 20}',
+                'content': f'Сообщение номер {seq} ' + 'x' * 80,
+            }
+            for seq in range(1, messages + 1)
+        ],
+        'next_cursor': None,
+    }
+
+
+def _frame() -> dict:
+    message = Message(creator_login='user0', content='Сообщение ' + 'x' * 200, seq=1)
+    return ResponseMessage(
+        message=WebSocketMessage(type=MessageType.MESSAGE, content=message),
+        chat_id='chat',
+    ).dict()
+
+
+def _measure(func, repeat: int) -> float:
+    """
+    Лучшее время одного вызова в миллисекундах из repeat попыток
+    """
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = (time.perf_counter() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(messages: int = 5000, recipients: int = 100, repeat: int = 20) -> dict:
+    history = _history(messages)
+    frame = _frame()
+
+    def json_fanout():
+        for _ in range(recipients):
+            # То же, что делает starlette WebSocket.send_json для каждого получателя
+            json.dumps(frame, separators=(',', ':'))
+
+    results = {
+        'history': {
+            'json_ms': _measure(lambda: JSONResponse(content=history), repeat),
+            'orjson_ms': _measure(lambda: ORJSONResponse(content=history), repeat),
+            'bytes': len(ORJSONResponse(content=history).body),
+        },
+        'fanout': {
+            'json_ms': _measure(json_fanout, repeat),
+            'orjson_ms': _measure(lambda: encode_frame(frame), repeat),
+            'recipients': recipients,
+        },
+    }
+    for result in results.values():
+        result['speedup'] = round(result['json_ms'] / result['orjson_ms'], 1)
+
+    results['msgpack'] = {
+        'json_ms': _measure(lambda: encode_frame(frame), repeat),
+        'msgpack_ms': _measure(lambda: encode_msgpack_frame(frame), repeat),
+        'json_bytes': len(encode_frame(frame).encode()),
+        'msgpack_bytes': len(encode_msgpack_frame(frame)),
+    }
+    return results
+
+
+def print_results(results: dict):
+    print(f"{'path':<10}{'json ms':>12}{'orjson ms':>12}{'speedup':>10}")
+    for name in ('history', 'fanout'):
+        result = results[name]
+        print(f"{name:<10}{result['json_ms']:>12.3f}{result['orjson_ms']:>12.3f}{result['speedup']:>9.1f}x")
+
+    result = results['msgpack']
+    print(f"\nкадр ResponseMessage: orjson {result['json_ms']:.4f} ms, {result['json_bytes']} байт; "
+          f"msgpack {result['msgpack_ms']:.4f} ms, {result['msgpack_bytes']} байт")
@@ -0,0 +1,99 @@
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import toml
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class BenchmarkServer:
+    """
+    Запускает main:app под uvicorn в отдельном процессе с временным файлом настроек,
+    в котором выбрано локальное хранилище (memory или sqlite)
+    """
+
+    def __init__(self, backend: str = 'memory', workers: int = 1, settings: dict = None):
+        self.backend = backend
+        self.workers = workers
+        self.settings = settings or {}
+        self.port = _free_port()
+        self._directory = tempfile.TemporaryDirectory(prefix='messenger-bench-')
+        self._process = None
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.port}'
+
+    @property
+    def ws_url(self) -> str:
+        return f'ws://127.0.0.1:{self.port}'
+
+    def _write_config(self) -> str:
+        config = {
+            'keys': {'jwt': secrets.token_hex(32), 'hash': secrets.token_hex(16)},
+            'crypt_settings': {'algorithm': 'HS256'},
+            'database': {
+                'backend': self.backend,
+                'sqlite_path': os.path.join(self._directory.name, 'bench.sqlite3'),
+            },
+        }
+        if self.workers > 1:
+            # Соединения участников чата распределяются по воркерам, кадры между ними идут через шину
+            config['bus'] = {'backend': 'unix', 'socket_dir': os.path.join(self._directory.name, 'bus')}
+        for section, values in self.settings.items():
+            config.setdefault(section, {}).update(values)
+
+        path = os.path.join(self._directory.name, 'settings.toml')
+        with open(path, 'w') as file:
+            toml.dump(config, file)
+        return path
+
+    def start(self, timeout: float = 30.0):
+        env = dict(os.environ, CONFIG_PATH=self._write_config())
+        self._process = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'main:app',
+             '--host', '127.0.0.1', '--port', str(self.port),
+             '--workers', str(self.workers), '--log-level', 'warning'],
+            cwd=REPOSITORY_ROOT,
+            env=env,
+        )
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                raise RuntimeError(f'Сервер завершился с кодом {self._process.returncode}')
+            try:
+                httpx.get(f'{self.base_url}/docs', timeout=1.0)
+                return
+            except httpx.HTTPError:
+                time.sleep(0.2)
+        self.stop()
+        raise RuntimeError('Сервер не запустился за отведенное время')
+
+    def stop(self):
+        if self._process and self._process.poll() is None:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+        self._directory.cleanup()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
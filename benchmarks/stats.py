@@ -0,0 +1,95 @@
+import asyncio
+import math
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """
+    Перцентиль с линейной интерполяцией между соседними значениями
+    :param values: Выборка
+    :param q: Уровень перцентиля от 0 до 100
+    :return: Значение перцентиля или None для пустой выборки
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower, upper = math.floor(position), math.ceil(position)
+    if lower == upper:
+        return ordered[lower]
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def latency_summary(latencies_ms: List[float]) -> Dict[str, Optional[float]]:
+    """
+    Сводка по задержкам в миллисекундах
+    """
+    def rounded(value):
+        return round(value, 3) if value is not None else None
+
+    return {
+        'count': len(latencies_ms),
+        'mean': rounded(sum(latencies_ms) / len(latencies_ms)) if latencies_ms else None,
+        'p50': rounded(percentile(latencies_ms, 50)),
+        'p95': rounded(percentile(latencies_ms, 95)),
+        'p99': rounded(percentile(latencies_ms, 99)),
+        'max': rounded(max(latencies_ms)) if latencies_ms else None,
+    }
+
+
+class ScenarioResult:
+    """
+    Результат сценария: задержки успешных операций, количество ошибок и общее время
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies_ms: List[float] = []
+        self.errors = 0
+        self.duration_s = 0.0
+        self.extra: Dict[str, dict] = {}
+
+    def to_dict(self) -> dict:
+        operations = len(self.latencies_ms) + self.errors
+        result = {
+            'operations': operations,
+            'errors': self.errors,
+            'duration_s': round(self.duration_s, 3),
+            'throughput_ops': round(operations / self.duration_s, 2) if self.duration_s else None,
+            'latency_ms': latency_summary(self.latencies_ms),
+        }
+        result.update(self.extra)
+        return result
+
+
+async def run_load(name: str, operation: Callable[[int], Awaitable[bool]],
+                   total: int, concurrency: int) -> ScenarioResult:
+    """
+    Выполняет total операций не более чем в concurrency параллельных задачах
+    :param name: Имя сценария
+    :param operation: Корутина от номера операции, возвращающая True при успехе
+    :param total: Общее количество операций
+    :param concurrency: Количество одновременно выполняемых операций
+    :return: Результат сценария
+    """
+    result = ScenarioResult(name)
+    counter = iter(range(total))
+
+    async def worker():
+        for index in counter:
+            started = time.perf_counter()
+            try:
+                succeeded = await operation(index)
+            except Exception:
+                succeeded = False
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            if succeeded:
+                result.latencies_ms.append(elapsed_ms)
+            else:
+                result.errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, total))))
+    result.duration_s = time.perf_counter() - started
+    return result
@@ -24,3 +24,15 @@ class Configuration:
         except KeyError:
             self.log.error(f'Такого ключа {item} не существует')
             return None
+
+    def get(self, section: str, key: str, default=None):
+        """
+        Получение необязательного параметра из секции конфигурации
+        :param section: Имя секции
+        :param key: Имя параметра
+        :param default: Значение по умолчанию, если секции или параметра нет
+        :return: Значение параметра
+        """
+        if not self.config:
+            return default
+        return self.config.get(section, {}).get(key, default)
@@ -1,25 +1,106 @@
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import firestore
+from config import Configuration
 
 import os
 
+from database.storage import ASCENDING, DESCENDING, DOCUMENT_ID, AlreadyExists, NotFound, Increment, Maximum, \
+    StorageClient, async_transactional
+
+try:
+    from google.cloud.firestore_v1 import FieldFilter
+except ImportError:
+    from database.storage import FieldFilter
+
+config = Configuration()
+config.read()
+
+# Ограничение Firestore на количество операций в одном пакете записи
+MAX_BATCH_WRITES = 500
+
+
+async def run_transaction(database, callback, *args, max_attempts: int = 5):
+    """
+    Выполняет callback(transaction, *args) в транзакции. Документы, которые callback читает через
+    database.get_all(..., transaction=transaction), не должны измениться до фиксации его записей
+    transaction.update/set/create/delete, иначе callback вызывается заново
+    :param database: Клиент базы DataBaseConnector().db
+    :param callback: Корутина-функция транзакции
+    :param max_attempts: Количество попыток
+    :return: Результат callback последней попытки
+    """
+    if isinstance(database, StorageClient):
+        return await async_transactional(callback)(database.transaction(max_attempts=max_attempts), *args)
+
+    from database.compat import SyncClientAdapter
+    if isinstance(database, SyncClientAdapter):
+        return await database.run_transaction(callback, *args, max_attempts=max_attempts)
+
+    from google.cloud.firestore_v1.async_transaction import async_transactional as firestore_transactional
+    return await firestore_transactional(callback)(database.transaction(max_attempts=max_attempts), *args)
+
 
 class DataBaseConnector:
+    """
+    Подключение к хранилищу документов. Хранилище выбирается параметром backend в секции [database]
+    файла настроек:
+    - "firestore" (по умолчанию) - Cloud Firestore. Параметр client задает режим клиента:
+      "async" (по умолчанию) - AsyncClient, "sync" - синхронный клиент, обернутый в SyncClientAdapter
+      с тем же await-интерфейсом;
+    - "memory" - хранилище в памяти процесса;
+    - "sqlite" - файл SQLite, путь задается параметром sqlite_path.
+    Клиент создается один раз на процесс и разделяется всеми экземплярами коннектора
+    """
+
+    _clients = {}
+
     def __init__(self):
+        self._backend = config.get('database', 'backend', 'firestore')
+
+        if self._backend not in DataBaseConnector._clients:
+            DataBaseConnector._clients[self._backend] = self._create_client()
+
+        self._db = DataBaseConnector._clients[self._backend]
+
+    def _create_client(self):
+        if self._backend == 'memory':
+            from database.storage.memory import MemoryClient
+            return MemoryClient()
+
+        if self._backend == 'sqlite':
+            from database.storage.sqlite import SQLiteClient
+            return SQLiteClient(config.get('database', 'sqlite_path', 'messenger.sqlite3'))
+
+        if self._backend != 'firestore':
+            raise ValueError(f'Неизвестное хранилище {self._backend}')
+
+        self._initialize_firebase()
+
+        from firebase_admin import firestore, firestore_async
+
+        if config.get('database', 'client', 'async') == 'sync':
+            from database.compat import SyncClientAdapter
+            return SyncClientAdapter(firestore.client())
+
+        return firestore_async.client()
+
+    @staticmethod
+    def _initialize_firebase():
+        import firebase_admin
+        from firebase_admin import credentials
+
         absolute_config_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json")
 
         config_file_path = os.environ.get('FIREBASE_CONFIG_PATH', absolute_config_file_path)
 
-        self._cred = credentials.Certificate(config_file_path)
-
         if not firebase_admin._apps:
-            self._app = firebase_admin.initialize_app(self._cred)
-        else:
-            self._app = firebase_admin.get_app()
+            firebase_admin.initialize_app(credentials.Certificate(config_file_path))
 
-        self._db = firestore.client()
+    @property
+    def backend(self) -> str:
+        return self._backend
 
     @property
     def db(self):
+        """
+        Клиент базы с асинхронным интерфейсом: get/set/add/delete - корутины, stream() - асинхронный генератор
+        """
         return self._db
@@ -0,0 +1,75 @@
+"""
+Заполнение полей last_activity_at, unread и last_message в метаданных чатов пользователей
+(users/{login}/chats).
+
+Список чатов сортируется по last_activity_at, а Firestore не возвращает в такой выдаче документы
+без этого поля. Новые чаты получают поле при создании, скрипт нужен для уже существующих:
+время активности - время последнего сообщения чата или время создания, если сообщений нет,
+last_message - начало последнего сообщения чата.
+Запуск из корня репозитория:
+    python -m database.backfill_chat_activity [--dry-run] [--batch-size 400]
+
+Скрипт можно запускать повторно: метаданные, где поля уже есть, не изменяются.
+"""
+import argparse
+import asyncio
+from typing import Dict, Optional
+
+from database import MAX_BATCH_WRITES, DataBaseConnector, DESCENDING
+from database.migrate_timestamps import BatchWriter
+from database.models import Message, parse_timestamp
+from lib.chat_activity import message_preview
+from lib import chat_activity_writer
+
+
+async def last_message(database, chat_id: str, cache: Dict[str, Optional[Message]]) -> Optional[Message]:
+    if chat_id not in cache:
+        query = database.collection('chats').document(chat_id).collection('messages') \
+            .order_by('seq', direction=DESCENDING).limit(1)
+        cache[chat_id] = None
+        async for message_doc in query.stream():
+            cache[chat_id] = Message(**message_doc.to_dict())
+    return cache[chat_id]
+
+
+async def backfill(batch_size: int, dry_run: bool):
+    database = DataBaseConnector().db
+    writer = BatchWriter(database, batch_size, dry_run)
+    last_messages: Dict[str, Optional[Message]] = {}
+
+    async for user_doc in database.collection('users').stream():
+        async for meta_doc in user_doc.reference.collection('chats').stream():
+            meta = meta_doc.to_dict()
+            if meta.get('last_activity_at') is not None and 'last_message' in meta:
+                continue
+            message = await last_message(database, meta['chat_id'], last_messages)
+            fields = {}
+            if meta.get('last_activity_at') is None:
+                fields['last_activity_at'] = message.created_at if message \
+                    else parse_timestamp(meta.get('created_at')) or 0
+            if 'last_message' not in meta:
+                fields['last_message'] = message_preview(message, chat_activity_writer.preview_length).dict() \
+                    if message else None
+            if 'unread' not in meta:
+                fields['unread'] = 0
+            await writer.update(meta_doc.reference, fields)
+
+    await writer.flush()
+
+    action = 'Будут обновлены' if dry_run else 'Обновлены'
+    print(f'{action} метаданные чатов: {writer.written}')
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m database.backfill_chat_activity',
+                                     description='Заполнение времени активности, счетчиков непрочитанных '
+                                                 'и последних сообщений в чатах')
+    parser.add_argument('--batch-size', type=int, default=400, help=f'Не больше {MAX_BATCH_WRITES}')
+    parser.add_argument('--dry-run', action='store_true', help='Только посчитать документы')
+    args = parser.parse_args()
+
+    asyncio.run(backfill(min(args.batch_size, MAX_BATCH_WRITES), args.dry_run))
+
+
+if __name__ == '__main__':
+    main()
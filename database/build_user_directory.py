@@ -0,0 +1,43 @@
+"""
+Построение каталога пользователей (коллекция user_directory) для поиска по префиксу.
+
+Новые пользователи попадают в каталог при регистрации, скрипт нужен для уже существующих.
+Запуск из корня репозитория:
+    python -m database.build_user_directory [--dry-run] [--batch-size 400]
+
+Скрипт можно запускать повторно: документы каталога перезаписываются по текущим данным пользователей.
+"""
+import argparse
+import asyncio
+
+from database import MAX_BATCH_WRITES, DataBaseConnector
+from database.migrate_timestamps import BatchWriter
+from lib.directory import DIRECTORY_COLLECTION, directory_entry
+
+
+async def build(batch_size: int, dry_run: bool):
+    database = DataBaseConnector().db
+    writer = BatchWriter(database, batch_size, dry_run)
+    directory = database.collection(DIRECTORY_COLLECTION)
+
+    async for user_doc in database.collection('users').stream():
+        await writer.set(directory.document(user_doc.id), directory_entry(user_doc.to_dict()))
+
+    await writer.flush()
+
+    action = 'Будет записано' if dry_run else 'Записано'
+    print(f'{action} документов каталога: {writer.written}')
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m database.build_user_directory',
+                                     description='Построение каталога пользователей для поиска')
+    parser.add_argument('--batch-size', type=int, default=400, help=f'Не больше {MAX_BATCH_WRITES}')
+    parser.add_argument('--dry-run', action='store_true', help='Только посчитать документы')
+    args = parser.parse_args()
+
+    asyncio.run(build(min(args.batch_size, MAX_BATCH_WRITES), args.dry_run))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+import asyncio
+import functools
+from itertools import islice
+
+from google.cloud.firestore_v1.base_document import DocumentSnapshot
+from google.cloud.firestore_v1.base_query import BaseQuery
+from google.cloud.firestore_v1.batch import WriteBatch
+from google.cloud.firestore_v1.client import Client
+from google.cloud.firestore_v1.collection import CollectionReference
+from google.cloud.firestore_v1.document import DocumentReference
+from google.cloud.firestore_v1.transaction import transactional
+
+# Методы синхронного клиента, которые ходят в сеть и должны выполняться вне event loop
+BLOCKING_METHODS = frozenset({'get', 'create', 'set', 'add', 'update', 'delete', 'commit'})
+
+# У пакета записи create/set/update/delete только накапливают операции, в сеть ходит commit
+BATCH_BLOCKING_METHODS = frozenset({'commit'})
+
+# Методы, которые у асинхронного клиента возвращают асинхронный генератор
+STREAMING_METHODS = frozenset({'stream', 'get_all'})
+
+# Количество документов, забираемых из синхронного stream() за один переход в поток
+STREAM_CHUNK_SIZE = 100
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Выполняет блокирующую функцию в пуле потоков, не останавливая event loop
+    :param func: Блокирующая функция
+    :return: Результат выполнения функции
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+def _unwrap(value):
+    if isinstance(value, SyncProxy):
+        return value.wrapped
+    if isinstance(value, (list, tuple)):
+        return type(value)(_unwrap(item) for item in value)
+    return value
+
+
+def _wrap(value):
+    if isinstance(value, (Client, DocumentReference, CollectionReference, BaseQuery, WriteBatch)):
+        return SyncProxy(value)
+    if isinstance(value, DocumentSnapshot):
+        return SnapshotProxy(value)
+    if isinstance(value, tuple):
+        return tuple(_wrap(item) for item in value)
+    if isinstance(value, list):
+        return [_wrap(item) for item in value]
+    return value
+
+
+async def _stream_in_thread(method, args, kwargs):
+    iterator = iter(await run_blocking(method, *args, **kwargs))
+    while True:
+        chunk = await run_blocking(lambda: list(islice(iterator, STREAM_CHUNK_SIZE)))
+        if not chunk:
+            return
+        for document in chunk:
+            yield SnapshotProxy(document)
+
+
+class SyncProxy:
+    """
+    Обертка над объектом синхронного клиента Firestore, повторяющая интерфейс AsyncClient:
+    сетевые вызовы возвращают корутины и выполняются в пуле потоков, stream() - асинхронный генератор
+    """
+
+    def __init__(self, target):
+        self._target = target
+
+    @property
+    def wrapped(self):
+        return self._target
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+
+        if not callable(attribute):
+            return _wrap(attribute)
+
+        if name in STREAMING_METHODS:
+            return lambda *args, **kwargs: _stream_in_thread(attribute, _unwrap(args),
+                                                             {key: _unwrap(value) for key, value in kwargs.items()})
+
+        blocking_methods = BATCH_BLOCKING_METHODS if isinstance(self._target, WriteBatch) else BLOCKING_METHODS
+        if name in blocking_methods:
+            async def blocking_call(*args, **kwargs):
+                result = await run_blocking(attribute, *_unwrap(args), **kwargs)
+                return _wrap(result)
+            return blocking_call
+
+        @functools.wraps(attribute)
+        def call(*args, **kwargs):
+            return _wrap(attribute(*_unwrap(args), **kwargs))
+        return call
+
+
+class SnapshotProxy:
+    """
+    Обертка над снимком документа: данные отдаются как есть, ссылка на документ - через SyncProxy
+    """
+
+    def __init__(self, snapshot: DocumentSnapshot):
+        self._snapshot = snapshot
+
+    @property
+    def reference(self):
+        return SyncProxy(self._snapshot.reference)
+
+    def __getattr__(self, name):
+        return getattr(self._snapshot, name)
+
+
+class SyncClientAdapter(SyncProxy):
+    """
+    Совместимый слой для перехода на асинхронный клиент: позволяет работать с синхронным
+    firestore.client() через тот же await-интерфейс, что и у firestore_async.client()
+    """
+
+    async def run_transaction(self, callback, *args, max_attempts: int = 5):
+        """
+        Выполняет асинхронную функцию транзакции database.run_transaction с синхронным клиентом:
+        транзакция с повторами идет в потоке, а функция - в event loop с транзакцией, обернутой в SyncProxy
+        """
+        loop = asyncio.get_running_loop()
+
+        def attempt(transaction):
+            return asyncio.run_coroutine_threadsafe(callback(SyncProxy(transaction), *args), loop).result()
+
+        return await run_blocking(transactional(attempt), self.wrapped.transaction(max_attempts=max_attempts))
@@ -0,0 +1,59 @@
+"""
+Подсчет счетчиков followers_count и following_count для уже существующих пользователей.
+
+Новые подписки изменяют счетчики сами (lib.counters), скрипт нужен один раз после обновления.
+Запуск из корня репозитория (серверы лучше остановить, иначе подписки во время подсчета не попадут в счетчики):
+    python -m database.count_follows [--dry-run] [--batch-size 400]
+
+Скрипт можно запускать повторно: счетчики перезаписываются по текущим коллекциям подписок,
+шарды счетчиков удаляются.
+"""
+import argparse
+import asyncio
+
+from database import MAX_BATCH_WRITES, DataBaseConnector
+from database.migrate_timestamps import BatchWriter
+from lib import counters
+
+
+async def count_documents(collection) -> int:
+    return sum([1 async for _ in collection.stream()])
+
+
+async def count(batch_size: int, dry_run: bool):
+    database = DataBaseConnector().db
+    writer = BatchWriter(database, batch_size, dry_run)
+    users = 0
+
+    async for user_doc in database.collection('users').stream():
+        user_ref = user_doc.reference
+        followers = await count_documents(user_ref.collection('followers'))
+        following = await count_documents(user_ref.collection('following'))
+
+        async for shard_doc in user_ref.collection(counters.SHARDS_COLLECTION).stream():
+            await writer.delete(shard_doc.reference)
+
+        fields = {counters.FOLLOWERS_FIELD: followers, counters.FOLLOWING_FIELD: following}
+        if counters.SHARDS > 1 and followers >= counters.CELEBRITY_THRESHOLD:
+            fields[counters.SHARDS_FIELD] = counters.SHARDS
+        await writer.update(user_ref, fields)
+        users += 1
+
+    await writer.flush()
+
+    action = 'Будут обновлены' if dry_run else 'Обновлены'
+    print(f'{action} счетчики пользователей: {users}')
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m database.count_follows',
+                                     description='Подсчет счетчиков подписчиков и подписок')
+    parser.add_argument('--batch-size', type=int, default=400, help=f'Не больше {MAX_BATCH_WRITES}')
+    parser.add_argument('--dry-run', action='store_true', help='Только посчитать пользователей')
+    args = parser.parse_args()
+
+    asyncio.run(count(min(args.batch_size, MAX_BATCH_WRITES), args.dry_run))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+Перевод отметок времени из строк '%d.%m.%Y %H:%M' в миллисекунды от начала эпохи
+и нумерация сообщений чатов полем seq.
+
+Запуск из корня репозитория (серверы лучше остановить, чтобы номера сообщений не разошлись):
+    python -m database.migrate_timestamps [--dry-run] [--batch-size 400]
+
+Скрипт можно запускать повторно: уже переведенные поля и пронумерованные чаты не изменяются.
+"""
+import argparse
+import asyncio
+import math
+
+from database import MAX_BATCH_WRITES, DataBaseConnector
+from database.models import parse_timestamp
+
+# Поля с отметками времени во вложенных коллекциях пользователя
+USER_SUBCOLLECTION_FIELDS = {
+    'chats': 'created_at',
+    'followers': 'created_at',
+    'following': 'created_at',
+    'notifications': 'received_at',
+}
+
+
+class BatchWriter:
+    """
+    Накопитель обновлений документов, отправляющий их пакетами записи
+    """
+
+    def __init__(self, database, batch_size: int, dry_run: bool):
+        self.database = database
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.written = 0
+        self._batch = database.batch()
+        self._pending = 0
+
+    async def update(self, reference, fields: dict):
+        self._batch.update(reference, fields)
+        await self._added()
+
+    async def set(self, reference, data: dict):
+        self._batch.set(reference, data)
+        await self._added()
+
+    async def delete(self, reference):
+        self._batch.delete(reference)
+        await self._added()
+
+    async def _added(self):
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        if self._pending and not self.dry_run:
+            await self._batch.commit()
+        self.written += self._pending
+        self._batch = self.database.batch()
+        self._pending = 0
+
+
+def _converted(data: dict, field: str) -> dict:
+    value = data.get(field)
+    converted = parse_timestamp(value)
+    if isinstance(value, str) and isinstance(converted, int):
+        return {field: converted}
+    return {}
+
+
+async def migrate_chat(writer: BatchWriter, chat_doc) -> int:
+    """
+    Переводит отметку времени чата и нумерует его сообщения в хронологическом порядке
+    :return: Количество сообщений в чате
+    """
+    updates = _converted(chat_doc.to_dict(), 'created_at')
+    if updates:
+        await writer.update(chat_doc.reference, updates)
+
+    messages = [(message_doc.reference, message_doc.to_dict())
+                async for message_doc in chat_doc.reference.collection('messages').stream()]
+
+    renumber = any(not isinstance(data.get('seq'), int) for _, data in messages)
+
+    def order(item):
+        reference, data = item
+        created_at = parse_timestamp(data.get('created_at'))
+        seq = data.get('seq')
+        return (created_at if isinstance(created_at, int) else 0,
+                seq if isinstance(seq, int) else math.inf,
+                reference.id)
+
+    for seq, (reference, data) in enumerate(sorted(messages, key=order), start=1):
+        updates = _converted(data, 'created_at')
+        if renumber and data.get('seq') != seq:
+            updates['seq'] = seq
+        if updates:
+            await writer.update(reference, updates)
+
+    return len(messages)
+
+
+async def migrate_user(writer: BatchWriter, user_doc):
+    for collection_name, field in USER_SUBCOLLECTION_FIELDS.items():
+        async for item_doc in user_doc.reference.collection(collection_name).stream():
+            updates = _converted(item_doc.to_dict(), field)
+            if updates:
+                await writer.update(item_doc.reference, updates)
+
+
+async def migrate(batch_size: int, dry_run: bool):
+    database = DataBaseConnector().db
+    writer = BatchWriter(database, batch_size, dry_run)
+
+    chats = messages = users = 0
+    async for chat_doc in database.collection('chats').stream():
+        messages += await migrate_chat(writer, chat_doc)
+        chats += 1
+
+    async for user_doc in database.collection('users').stream():
+        await migrate_user(writer, user_doc)
+        users += 1
+
+    await writer.flush()
+
+    action = 'Будет обновлено' if dry_run else 'Обновлено'
+    print(f'Чатов: {chats}, сообщений: {messages}, пользователей: {users}. {action} документов: {writer.written}')
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m database.migrate_timestamps',
+                                     description='Перевод отметок времени в миллисекунды и нумерация сообщений')
+    parser.add_argument('--batch-size', type=int, default=400, help=f'Не больше {MAX_BATCH_WRITES}')
+    parser.add_argument('--dry-run', action='store_true', help='Только посчитать документы для обновления')
+    args = parser.parse_args()
+
+    asyncio.run(migrate(min(args.batch_size, MAX_BATCH_WRITES), args.dry_run))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,74 @@
-from fastapi import WebSocket
+from fastapi import WebSocket, WebSocketDisconnect
 from fastapi.exceptions import HTTPException
 
-from pydantic import BaseModel, EmailStr, PrivateAttr
-from typing import Optional, Any, List, Union, Dict
+from pydantic import BaseModel, EmailStr, PrivateAttr, Field, validator
+from typing import Optional, Any, Callable, List, Union, Dict
 import datetime
+import time
 from enum import Enum, IntEnum
 from database import DataBaseConnector
+from config import Configuration
+import asyncio
+import msgpack
+import orjson
+
+config = Configuration()
+config.read()
+
+SEND_QUEUE_SIZE = config.get('websocket', 'send_queue_size', 256)
+SEND_QUEUE_OVERFLOW_POLICY = config.get('websocket', 'overflow_policy', 'drop_oldest')
+
+JSON_PROTOCOL = 'json'
+# Подпротокол WebSocket (заголовок Sec-WebSocket-Protocol) для двоичных кадров MessagePack
+MSGPACK_PROTOCOL = 'msgpack'
+
+
+LEGACY_TIMESTAMP_FORMAT = '%d.%m.%Y %H:%M'
+
+
+def encode_frame(frame: Union[dict, str]) -> str:
+    """
+    Текст JSON кадра WebSocket. Кадр, уже закодированный в строку, возвращается как есть,
+    поэтому один и тот же кадр для нескольких получателей кодируется один раз
+    :param frame: Кадр в виде словаря или строки
+    :return: Строка JSON
+    """
+    if isinstance(frame, str):
+        return frame
+    return orjson.dumps(frame).decode()
+
+
+def timestamp_ms() -> int:
+    """
+    Текущее время в миллисекундах от начала эпохи Unix
+    """
+    return time.time_ns() // 1_000_000
+
+
+def parse_timestamp(value: Any) -> Any:
+    """
+    Приводит отметку времени к миллисекундам от начала эпохи. Строки старого формата
+    '%d.%m.%Y %H:%M' интерпретируются в локальном часовом поясе сервера
+    :param value: Отметка времени в миллисекундах, строке старого формата или None
+    :return: Отметка времени в миллисекундах или исходное значение, если его нельзя разобрать
+    """
+    if isinstance(value, str):
+        try:
+            return int(datetime.datetime.strptime(value, LEGACY_TIMESTAMP_FORMAT).timestamp() * 1000)
+        except ValueError:
+            return value
+    return value
 
 
 class MessageType(IntEnum, Enum):
     MESSAGE = 0,
     UPDATE_USER_STATUS = 1,
     UPDATE_CHATS = 2,
+    MARK_READ = 3,
+    PRESENCE = 4,
+    RESUME = 5,
+    NOTIFICATION = 6,
+    RENUMBER = 7,
 
 
 class Role(IntEnum, Enum):
@@ -32,6 +89,15 @@ class Token(BaseModel):
     expires: str
 
 
+class TokenClaims(BaseModel):
+    """
+    Данные пользователя из JWT токена
+    """
+    login: str
+    role: Role = Role.USER
+    expires_at: int
+
+
 class User(BaseModel):
     name: Optional[str]
     surname: Optional[str]
@@ -39,6 +105,22 @@ class User(BaseModel):
     email: Optional[EmailStr]
 
 
+class UserProfile(User):
+    followers_count: int = 0
+    following_count: int = 0
+
+
+class Relationship(BaseModel):
+    follows: bool
+    followed_by: bool
+    mutual: bool
+
+
+class BulkFollowRequest(BaseModel):
+    follow: List[str] = []
+    unfollow: List[str] = []
+
+
 class BaseUserModel(User):
     role: Role = Role.USER
     password: str
@@ -65,29 +147,84 @@ class Post(BaseModel):
 
 
 class Subscription(BaseModel):
-    created_at: Optional[str] = datetime.datetime.now().strftime('%d.%m.%Y %H:%M')
+    created_at: int = Field(default_factory=timestamp_ms)
+
+    _parse_created_at = validator('created_at', pre=True, allow_reuse=True)(parse_timestamp)
 
 
 class Message(BaseModel):
-    created_at: Optional[str] = datetime.datetime.now().strftime('%d.%m.%Y %H:%M')
+    created_at: int = Field(default_factory=timestamp_ms)
+    seq: Optional[int] = None
     creator_login: str
     content: str
 
+    _parse_created_at = validator('created_at', pre=True, allow_reuse=True)(parse_timestamp)
+
 
 class Chat(BaseModel):
     chat_name: Optional[str] = None
-    created_at: Optional[str] = datetime.datetime.now().strftime('%d.%m.%Y %H:%M')
+    created_at: int = Field(default_factory=timestamp_ms)
     members: List[str]
 
+    _parse_created_at = validator('created_at', pre=True, allow_reuse=True)(parse_timestamp)
+
 
 class ChatMeta(BaseModel):
     chat_name: str
     chat_id: str
-    created_at: str
+    created_at: int
+
+    _parse_created_at = validator('created_at', pre=True, allow_reuse=True)(parse_timestamp)
+
+
+class MessagePreview(BaseModel):
+    creator_login: str
+    content: str
+    created_at: int
+    seq: Optional[int] = None
 
 
 class ChatMetaDataBase(ChatMeta):
     unread: int = 0
+    last_activity_at: Optional[int] = None
+    last_message: Optional[MessagePreview] = None
+
+
+class ReadMark(BaseModel):
+    chat_id: str
+
+
+class PresenceStatus(str, Enum):
+    ONLINE = 'online'
+    AWAY = 'away'
+    OFFLINE = 'offline'
+
+
+class Presence(BaseModel):
+    status: PresenceStatus
+    login: Optional[str] = None
+    last_seen_at: Optional[int] = None
+
+
+class Resume(BaseModel):
+    """
+    Запрос клиента после переподключения - номер последнего полученного сообщения каждого чата,
+    и ответ сервера - пропущенные сообщения одного чата. truncated - пропущено больше,
+    чем поместилось в ответ, остальное клиент получает через GET /chats/{chat_id}?after=
+    """
+    chats: Dict[str, int]
+    messages: List[Message] = []
+    truncated: bool = False
+
+
+class Renumber(BaseModel):
+    """
+    Кадр сервера: сообщение, разосланное под номером previous_seq до записи в базу, сохранено
+    под номером message.seq, потому что previous_seq занял другой воркер. Клиент находит свое
+    сообщение по previous_seq, отправителю и времени создания и меняет его номер
+    """
+    previous_seq: int
+    message: Message
 
 
 class ChatModelRequest(BaseModel):
@@ -101,9 +238,24 @@ class ChatModelResponse(Chat):
 
 class Notification(BaseModel):
     description: str
-    received_at: str = datetime.datetime.now().strftime('%d.%m.%Y %H:%M')
+    received_at: int = Field(default_factory=timestamp_ms)
     user: str
     chat_id: Optional[str]
+    # Вид уведомления и количество объединенных в нем событий, например сообщений одного чата
+    kind: str = 'generic'
+    count: int = 1
+    read: bool = False
+
+    _parse_received_at = validator('received_at', pre=True, allow_reuse=True)(parse_timestamp)
+
+
+class NotificationItem(Notification):
+    id: str
+
+
+class NotificationsReadRequest(BaseModel):
+    ids: List[str] = []
+    all: bool = False
 
 
 class Endpoint:
@@ -114,24 +266,232 @@ class Endpoint:
 
 class WebSocketMessage(BaseModel):
     type: MessageType
-    content: Union[Message, UserStatus, ChatMeta]
+    content: Union[Message, NotificationItem, UserStatus, ChatMeta, ReadMark, Presence, Resume, Renumber]
 
 
 class ResponseMessage(BaseModel):
     message: WebSocketMessage
-    chat_id: str
+    chat_id: Optional[str] = None
+
+
+# Порядок полей содержимого кадра в протоколе MessagePack для каждого типа сообщения.
+# Кадр клиента - [type, [поля содержимого]], кадр сервера - [type, chat_id, [поля содержимого]].
+# Пустые поля в конце списка не передаются. Содержимое с полями не из таблицы передается словарем
+FRAME_CONTENT_FIELDS = {
+    MessageType.MESSAGE: ('creator_login', 'content', 'created_at', 'seq'),
+    MessageType.UPDATE_USER_STATUS: ('chat_id', 'auth_token'),
+    MessageType.UPDATE_CHATS: ('chat_name', 'chat_id', 'created_at', 'unread', 'last_activity_at', 'last_message'),
+    MessageType.MARK_READ: ('chat_id',),
+    MessageType.PRESENCE: ('status', 'login', 'last_seen_at'),
+    MessageType.RESUME: ('chats', 'messages', 'truncated'),
+    MessageType.NOTIFICATION: ('id', 'description', 'received_at', 'user', 'chat_id', 'kind', 'count', 'read'),
+    MessageType.RENUMBER: ('previous_seq', 'message'),
+}
+
+
+def _pack_content(message_type: int, content: Any) -> Any:
+    fields = FRAME_CONTENT_FIELDS.get(message_type)
+    if fields is None or not isinstance(content, dict) or not set(content) <= set(fields):
+        return content
+    values = [content.get(field) for field in fields]
+    while values and values[-1] is None:
+        values.pop()
+    return values
+
+
+def _unpack_content(message_type: int, content: Any) -> Any:
+    fields = FRAME_CONTENT_FIELDS.get(message_type)
+    if fields is None or not isinstance(content, list):
+        return content
+    return dict(zip(fields, content))
+
+
+def encode_msgpack_frame(frame: dict) -> bytes:
+    """
+    Двоичный кадр MessagePack. Кадр ResponseMessage передается списком без имен полей,
+    остальные кадры - словарем
+    :param frame: Кадр в виде словаря
+    :return: Байты кадра
+    """
+    message = frame.get('message')
+    if set(frame) == {'message', 'chat_id'} and isinstance(message, dict) and set(message) == {'type', 'content'}:
+        message_type = int(message['type'])
+        return msgpack.packb([message_type, frame['chat_id'], _pack_content(message_type, message['content'])])
+    return msgpack.packb(frame)
+
+
+def decode_frame(data: Union[str, bytes]) -> dict:
+    """
+    Разбирает кадр клиента: текст - JSON, байты - MessagePack
+    :param data: Данные кадра
+    :return: Словарь WebSocketMessage
+    """
+    try:
+        frame = orjson.loads(data) if isinstance(data, str) else msgpack.unpackb(data)
+    except ValueError:
+        # orjson.JSONDecodeError и ошибки msgpack наследуются от ValueError
+        raise HTTPException(400, 'Кадр не разобран')
+    if isinstance(frame, list):
+        if len(frame) != 2 or not isinstance(frame[0], int):
+            raise HTTPException(400, 'Кадр-список должен иметь вид [type, content]')
+        message_type, content = frame
+        return {'type': message_type, 'content': _unpack_content(message_type, content)}
+    if not isinstance(frame, dict):
+        raise HTTPException(400, 'Невозможно обработать запрос')
+    return frame
+
+
+class EncodedFrame:
+    """
+    Кадр для рассылки, который кодируется не больше одного раза для каждого протокола
+    :param frame: Кадр в виде словаря
+    :param json_text: Кадр, уже закодированный в JSON, например полученный через шину от другого воркера
+    """
+    __slots__ = ('_frame', '_encoded')
+
+    def __init__(self, frame: dict = None, json_text: str = None):
+        self._frame = frame
+        self._encoded: Dict[str, Union[str, bytes]] = {}
+        if json_text is not None:
+            self._encoded[JSON_PROTOCOL] = json_text
 
+    @property
+    def json(self) -> str:
+        return self.encode(JSON_PROTOCOL)
+
+    def encode(self, protocol: str) -> Union[str, bytes]:
+        payload = self._encoded.get(protocol)
+        if payload is None:
+            if self._frame is None:
+                self._frame = orjson.loads(self._encoded[JSON_PROTOCOL])
+            if protocol == MSGPACK_PROTOCOL:
+                payload = encode_msgpack_frame(self._frame)
+            else:
+                payload = encode_frame(self._frame)
+            self._encoded[protocol] = payload
+        return payload
+
+
+class SendQueueStats:
+    """
+    Счетчики исходящих очередей соединений WebSocket
+    """
 
-class OpenedConnection:
-    chats_meta: Dict[str, ChatMetaDataBase] = {}
+    def __init__(self):
+        self.enqueued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.send_errors = 0
+        self.slow_consumers_disconnected = 0
+
+    def to_dict(self) -> dict:
+        return {
+            'enqueued': self.enqueued,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'send_errors': self.send_errors,
+            'slow_consumers_disconnected': self.slow_consumers_disconnected,
+        }
+
+
+send_queue_stats = SendQueueStats()
 
-    def __init__(self, connection: WebSocket, user_status: Union[UserStatus, None] = None):
+
+class OpenedConnection:
+    """
+    Открытое соединение пользователя. Все исходящие кадры проходят через ограниченную очередь,
+    которую разбирает отдельная задача-писатель, поэтому медленный клиент не задерживает
+    отправителя и остальных получателей. При переполнении очереди действует политика
+    overflow_policy из секции [websocket]: "drop_oldest" - отбросить самый старый кадр,
+    "disconnect" - закрыть соединение медленного клиента
+    """
+    def __init__(self, connection: WebSocket, user_status: Union[UserStatus, None] = None,
+                 protocol: str = JSON_PROTOCOL):
         self.connection = connection
         self.user_status = user_status
+        self.protocol = protocol
+        self.chats_meta: Dict[str, ChatMetaDataBase] = {}
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self._writer: Optional[asyncio.Task] = None
+        self._closing = False
 
     def get_chat_meta(self, chat_id: str):
         return self.chats_meta[chat_id]
 
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def start(self):
+        self._writer = asyncio.ensure_future(self._write_frames())
+
+    async def _write_frames(self):
+        while True:
+            payload = await self._queue.get()
+            try:
+                if isinstance(payload, bytes):
+                    await self.connection.send_bytes(payload)
+                else:
+                    await self.connection.send_text(payload)
+                send_queue_stats.sent += 1
+            except Exception:
+                # Соединение закрыто: оставшиеся кадры отправлять некуда
+                send_queue_stats.send_errors += 1
+                self._closing = True
+                return
+
+    async def receive(self) -> dict:
+        """
+        Ожидает кадр клиента в JSON или MessagePack
+        :return: Словарь WebSocketMessage
+        """
+        message = await self.connection.receive()
+        if message['type'] == 'websocket.disconnect':
+            raise WebSocketDisconnect(message.get('code', 1000))
+        data = message.get('bytes')
+        return decode_frame(data if data is not None else message.get('text'))
+
+    def send(self, frame: Union[dict, str, EncodedFrame]) -> bool:
+        """
+        Ставит кадр в очередь отправки без ожидания
+        :param frame: Кадр для отправки в виде словаря, уже закодированной строки JSON или EncodedFrame
+        :return: True, если кадр поставлен в очередь
+        """
+        if self._closing:
+            return False
+
+        if self._queue.full():
+            if SEND_QUEUE_OVERFLOW_POLICY == 'disconnect':
+                send_queue_stats.dropped += 1
+                send_queue_stats.slow_consumers_disconnected += 1
+                self._closing = True
+                asyncio.ensure_future(self._close_slow_consumer())
+                return False
+            self._queue.get_nowait()
+            send_queue_stats.dropped += 1
+
+        if isinstance(frame, EncodedFrame):
+            payload = frame.encode(self.protocol)
+        elif self.protocol == MSGPACK_PROTOCOL:
+            payload = EncodedFrame(json_text=frame).encode(self.protocol) if isinstance(frame, str) \
+                else encode_msgpack_frame(frame)
+        else:
+            payload = encode_frame(frame)
+        self._queue.put_nowait(payload)
+        send_queue_stats.enqueued += 1
+        return True
+
+    async def _close_slow_consumer(self):
+        try:
+            await self.connection.close(code=1013)
+        except Exception:
+            pass
+
+    def stop(self):
+        self._closing = True
+        if self._writer:
+            self._writer.cancel()
+
 
 class WebSocketManager:
 
@@ -141,8 +501,16 @@ class WebSocketManager:
         return cls.instance
 
     def __init__(self):
+        # Экземпляр один на процесс, повторный вызов конструктора не сбрасывает соединения
+        if hasattr(self, 'opened_connections'):
+            return
         self.opened_connections: Dict[str, OpenedConnection] = {}
         self.database = DataBaseConnector().db
+        # Шина для доставки кадров пользователям, подключенным к другим воркерам
+        self.bus = None
+        self.forwarded_frames = 0
+        # Обработчики сообщений шины других подсистем по типу сообщения
+        self.bus_handlers: Dict[str, Callable[[dict], Any]] = {}
 
     def __getitem__(self, item: str):
         """
@@ -155,24 +523,121 @@ class WebSocketManager:
         else:
             return None
 
+    async def attach_bus(self, bus):
+        """
+        Подключает шину между воркерами. Вызывается при старте приложения
+        :param bus: Экземпляр lib.bus.MessageBus
+        """
+        self.bus = bus
+        await bus.start(self._on_bus_message)
+        for login in self.opened_connections:
+            bus.announce(login, True)
+
+    async def detach_bus(self):
+        if self.bus:
+            await self.bus.stop()
+            self.bus = None
+
+    def _on_bus_message(self, message: dict):
+        if message.get('type') == 'deliver':
+            self._deliver_local(message['logins'], message['payload'])
+            return
+        handler = self.bus_handlers.get(message.get('type'))
+        if handler:
+            handler(message)
+
     def update_user_status(self, user: BaseUserModel, status: UserStatus):
         try:
             self.opened_connections[user.login].user_status = status
         except KeyError:
             raise HTTPException(400, 'Пользователь не активен')
 
-    async def connect(self, user: BaseUserModel, websocket: WebSocket):
-        await websocket.accept()
-        self.opened_connections.update(
-            {user.login: OpenedConnection(
-                connection=websocket,
-                user_status=None
-            )}
+    async def connect(self, user: BaseUserModel, websocket: WebSocket) -> OpenedConnection:
+        # Клиент, предложивший подпротокол msgpack, получает двоичные кадры, остальные - JSON
+        subprotocol = MSGPACK_PROTOCOL if MSGPACK_PROTOCOL in websocket.scope.get('subprotocols', []) else None
+        await websocket.accept(subprotocol=subprotocol)
+        opened_connection = OpenedConnection(
+            connection=websocket,
+            user_status=None,
+            protocol=subprotocol or JSON_PROTOCOL,
         )
-
-    def disconnect(self, user: BaseUserModel):
+        opened_connection.start()
+        previous_connection = self.opened_connections.get(user.login)
+        if previous_connection:
+            previous_connection.stop()
+        self.opened_connections.update({user.login: opened_connection})
+        if self.bus:
+            self.bus.announce(user.login, True)
+        return opened_connection
+
+    def disconnect(self, user: BaseUserModel, opened_connection: Optional[OpenedConnection] = None):
+        """
+        Удаляет соединение пользователя из списка активных
+        :param user: Пользователь
+        :param opened_connection: Закрываемое соединение. Если пользователь уже переподключился,
+        новое соединение не удаляется
+        """
+        current_connection = self.opened_connections.get(user.login)
+        if opened_connection:
+            opened_connection.stop()
+            if current_connection is not opened_connection:
+                return
         try:
             del self.opened_connections[user.login]
-            # в базу сохранять последнее время активности
+            current_connection.stop()
+            if self.bus:
+                self.bus.announce(user.login, False)
         except KeyError:
             raise HTTPException(400, 'Соединения не существовало')
+
+    def broadcast(self, logins, frame: Union[dict, str, EncodedFrame]) -> int:
+        """
+        Ставит кадр в очереди отправки всех подключенных пользователей из списка.
+        Кадр кодируется один раз для каждого протокола, всем получателям с одним протоколом
+        уходят одни и те же данные. Получателям, подключенным к другим воркерам, кадр
+        пересылается через шину в JSON одним сообщением на воркер
+        :param logins: Логины получателей
+        :param frame: Кадр для отправки в виде словаря, уже закодированной строки JSON или EncodedFrame
+        :return: Количество локальных соединений, в очереди которых поставлен кадр
+        """
+        if not isinstance(frame, EncodedFrame):
+            frame = EncodedFrame(json_text=frame) if isinstance(frame, str) else EncodedFrame(frame)
+        remote_logins = []
+        delivered = 0
+        for login in logins:
+            opened_connection = self.opened_connections.get(login)
+            if opened_connection is None:
+                remote_logins.append(login)
+            elif opened_connection.send(frame):
+                delivered += 1
+
+        if self.bus and remote_logins:
+            for worker_id, worker_logins in self.bus.route(remote_logins).items():
+                self.bus.publish(worker_id, {'type': 'deliver', 'logins': worker_logins, 'payload': frame.json})
+                self.forwarded_frames += 1
+        return delivered
+
+    def _deliver_local(self, logins, payload: str) -> int:
+        frame = EncodedFrame(json_text=payload)
+        delivered = 0
+        for login in logins:
+            opened_connection = self.opened_connections.get(login)
+            if opened_connection and opened_connection.send(frame):
+                delivered += 1
+        return delivered
+
+    def stats(self) -> dict:
+        depths = [opened_connection.queue_depth for opened_connection in self.opened_connections.values()]
+        msgpack_connections = sum(1 for opened_connection in self.opened_connections.values()
+                                  if opened_connection.protocol == MSGPACK_PROTOCOL)
+        result = {
+            'connections': len(depths),
+            'msgpack_connections': msgpack_connections,
+            'queue_size': SEND_QUEUE_SIZE,
+            'overflow_policy': SEND_QUEUE_OVERFLOW_POLICY,
+            'queued_frames': sum(depths),
+            'max_queue_depth': max(depths) if depths else 0,
+            'forwarded_frames': self.forwarded_frames,
+        }
+        result.update(send_queue_stats.to_dict())
+        return result
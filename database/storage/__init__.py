@@ -0,0 +1,601 @@
+"""
+Локальные хранилища с интерфейсом асинхронного клиента Firestore.
+
+Реализуют ровно то подмножество API, которым пользуется приложение:
+collection().document(), get()/exists/to_dict(), set(), create(), update(), add(), delete(),
+stream(), where(FieldFilter(...)), order_by(), limit(), start_after(), batch(), get_all()
+преобразования Increment и Maximum в set()/update() и условие write_option(exists=...) в update()/delete(),
+транзакции transaction() с чтением через get_all(..., transaction=...) и повтором через async_transactional.
+Конкретное хранилище
+(в памяти процесса или SQLite) реализует три примитива класса DocumentStore,
+вся остальная семантика общая.
+"""
+import copy
+import functools
+import random
+import string
+from datetime import datetime, timezone
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+try:
+    from google.api_core.exceptions import Aborted, AlreadyExists, NotFound
+except ImportError:
+    class Aborted(Exception):
+        pass
+
+    class AlreadyExists(Exception):
+        pass
+
+    class NotFound(Exception):
+        pass
+
+try:
+    from google.cloud.firestore_v1.transforms import Increment, Maximum
+except ImportError:
+    class Increment:
+        """
+        Атомарное увеличение числового поля на value, как firestore.Increment.
+        Отсутствующее или нечисловое поле считается равным нулю
+        """
+
+        def __init__(self, value):
+            self.value = value
+
+    class Maximum:
+        """
+        Атомарная запись в числовое поле наибольшего из текущего значения и value, как firestore.Maximum
+        """
+
+        def __init__(self, value):
+            self.value = value
+
+ASCENDING = 'ASCENDING'
+DESCENDING = 'DESCENDING'
+
+AUTO_ID_ALPHABET = string.ascii_letters + string.digits
+AUTO_ID_LENGTH = 20
+
+OPERATORS = frozenset({'==', '!=', '<', '<=', '>', '>=', 'in', 'not-in', 'array_contains', 'array_contains_any'})
+
+
+def auto_id() -> str:
+    """
+    Генерирует идентификатор документа в формате Firestore
+    :return: Строка из 20 латинских букв и цифр
+    """
+    return ''.join(random.choice(AUTO_ID_ALPHABET) for _ in range(AUTO_ID_LENGTH))
+
+
+class FieldFilter:
+    """
+    Условие фильтрации запроса, совместимое с google.cloud.firestore_v1.FieldFilter
+    """
+
+    def __init__(self, field_path: str, op_string: str, value: Any = None):
+        if op_string not in OPERATORS:
+            raise ValueError(f'Неподдерживаемый оператор {op_string}')
+        self.field_path = field_path
+        self.op_string = op_string
+        self.value = value
+
+
+def _type_rank(value) -> int:
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, datetime):
+        return 3
+    if isinstance(value, str):
+        return 4
+    if isinstance(value, bytes):
+        return 5
+    if isinstance(value, list):
+        return 6
+    return 7
+
+
+def sort_key(value):
+    """
+    Ключ сортировки значений полей в порядке Firestore: сначала по типу, затем по значению
+    """
+    rank = _type_rank(value)
+    if rank == 6:
+        return rank, [sort_key(item) for item in value]
+    if rank == 7:
+        return rank, sorted((key, sort_key(item)) for key, item in value.items())
+    return rank, value
+
+
+_MISSING = object()
+
+# Путь сортировки по идентификатору документа, как FieldPath.document_id() в Firestore
+DOCUMENT_ID = '__name__'
+
+
+def get_field(data: Dict[str, Any], field_path: str):
+    """
+    Значение поля документа по пути вида 'a.b.c'
+    :return: Значение поля или _MISSING, если поля нет
+    """
+    value = data
+    for part in field_path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+
+def order_value(item: Tuple[str, Dict[str, Any]], field_path: str):
+    """
+    Значение поля сортировки документа, для DOCUMENT_ID - идентификатор документа
+    :param item: Пара (идентификатор, данные документа)
+    """
+    return item[0] if field_path == DOCUMENT_ID else get_field(item[1], field_path)
+
+
+def matches(data: Dict[str, Any], field_filter) -> bool:
+    """
+    Проверяет документ на соответствие условию фильтра по правилам Firestore:
+    документ без поля не попадает в выборку, сравнения выполняются только между значениями одного типа
+    """
+    value = get_field(data, field_filter.field_path)
+    if value is _MISSING:
+        return False
+
+    op, target = field_filter.op_string, field_filter.value
+
+    if op == '==':
+        return _type_rank(value) == _type_rank(target) and value == target
+    if op == '!=':
+        return value is not None and not (_type_rank(value) == _type_rank(target) and value == target)
+    if op == 'in':
+        return any(_type_rank(value) == _type_rank(item) and value == item for item in target)
+    if op == 'not-in':
+        return value is not None and not any(_type_rank(value) == _type_rank(item) and value == item
+                                             for item in target)
+    if op == 'array_contains':
+        return isinstance(value, list) and target in value
+    if op == 'array_contains_any':
+        return isinstance(value, list) and any(item in value for item in target)
+
+    if _type_rank(value) != _type_rank(target):
+        return False
+    if op == '<':
+        return sort_key(value) < sort_key(target)
+    if op == '<=':
+        return sort_key(value) <= sort_key(target)
+    if op == '>':
+        return sort_key(value) > sort_key(target)
+    return sort_key(value) >= sort_key(target)
+
+
+def _compare(left, right) -> int:
+    return (left > right) - (left < right)
+
+
+def id_direction(orders) -> str:
+    """
+    Направление неявной сортировки по идентификатору документа: как в Firestore,
+    совпадает с направлением последней явной сортировки
+    """
+    return orders[-1][1] if orders else ASCENDING
+
+
+def cursor_position(item: Tuple[str, Dict[str, Any]], orders, cursor) -> int:
+    """
+    Положение документа относительно курсора в порядке сортировки запроса
+    :param item: Пара (идентификатор, данные документа)
+    :param orders: Список пар (поле, направление)
+    :param cursor: Пара (значения полей курсора, идентификатор документа курсора или None)
+    :return: -1, если документ раньше курсора, 0 - совпадает с ним, 1 - позже
+    """
+    values, cursor_id = cursor
+    for field_path, direction in orders:
+        if field_path not in values:
+            break
+        result = _compare(sort_key(order_value(item, field_path)), sort_key(values[field_path]))
+        if result:
+            return -result if direction == DESCENDING else result
+    if cursor_id is None:
+        return 0
+    result = _compare(item[0], cursor_id)
+    return -result if id_direction(orders) == DESCENDING else result
+
+
+def apply_query(documents: List[Tuple[str, Dict[str, Any]]], filters, orders, limit: Optional[int],
+                start_after=None):
+    """
+    Применяет фильтры, сортировку, курсор и ограничение к списку документов коллекции
+    :param documents: Пары (идентификатор, данные документа)
+    :param filters: Список условий FieldFilter
+    :param orders: Список пар (поле, направление)
+    :param limit: Максимальное количество документов
+    :param start_after: Курсор - пара (значения полей, идентификатор документа или None)
+    :return: Отфильтрованный и отсортированный список пар (идентификатор, данные)
+    """
+    result = [item for item in documents if all(matches(item[1], field_filter) for field_filter in filters)]
+
+    # Как и в Firestore, сортировка по полю исключает документы без этого поля
+    for field_path, direction in orders:
+        result = [item for item in result if order_value(item, field_path) is not _MISSING]
+
+    result.sort(key=lambda item: item[0], reverse=id_direction(orders) == DESCENDING)
+    for field_path, direction in reversed(orders):
+        result.sort(key=lambda item: sort_key(order_value(item, field_path)), reverse=direction == DESCENDING)
+
+    if start_after is not None:
+        result = [item for item in result if cursor_position(item, orders, start_after) > 0]
+
+    if limit is not None:
+        result = result[:limit]
+    return result
+
+
+class ExistsOption(NamedTuple):
+    """
+    Условие записи, как client.write_option(exists=...) в Firestore: документ должен существовать
+    (exists=True) или отсутствовать (exists=False), иначе весь пакет записи отклоняется
+    """
+    exists: bool
+
+
+class Write(NamedTuple):
+    """
+    Операция записи документа: kind - 'set', 'create', 'update', 'delete' или 'verify'.
+    'verify' ничего не меняет и отклоняет пакет, если данные документа уже не равны data
+    """
+    kind: str
+    collection_path: str
+    document_id: str
+    data: Optional[Dict[str, Any]] = None
+    merge: bool = False
+    option: Optional[ExistsOption] = None
+
+    @property
+    def path(self) -> str:
+        return f'{self.collection_path}/{self.document_id}'
+
+
+def _resolve_value(current_value: Any, value: Any) -> Any:
+    numeric = isinstance(current_value, (int, float)) and not isinstance(current_value, bool)
+    if isinstance(value, Increment):
+        return current_value + value.value if numeric else value.value
+    if isinstance(value, Maximum):
+        return max(current_value, value.value) if numeric else value.value
+    return copy.deepcopy(value)
+
+
+def resolve_write(current: Optional[Dict[str, Any]], write: Write) -> Optional[Dict[str, Any]]:
+    """
+    Вычисляет новое содержимое документа после операции записи
+    :param current: Текущие данные документа или None, если документа нет
+    :param write: Операция записи
+    :return: Новые данные документа или None, если документ удаляется
+    """
+    if write.option is not None:
+        if write.option.exists and current is None:
+            raise NotFound(f'Документ {write.path} не существует')
+        if not write.option.exists and current is not None:
+            raise AlreadyExists(f'Документ {write.path} уже существует')
+
+    if write.kind == 'verify':
+        if current != write.data:
+            raise Aborted(f'Документ {write.path} изменился после чтения в транзакции')
+        return current
+
+    if write.kind == 'delete':
+        return None
+
+    if write.kind == 'create' and current is not None:
+        raise AlreadyExists(f'Документ {write.path} уже существует')
+
+    if write.kind == 'update':
+        if current is None:
+            raise NotFound(f'Документ {write.path} не существует')
+        result = copy.deepcopy(current)
+        for field_path, value in write.data.items():
+            target = result
+            *parents, name = field_path.split('.')
+            for part in parents:
+                target = target.setdefault(part, {})
+            target[name] = _resolve_value(target.get(name), value)
+        return result
+
+    if write.merge and current is not None:
+        result = copy.deepcopy(current)
+        for name, value in write.data.items():
+            result[name] = _resolve_value(result.get(name), value)
+        return result
+
+    return {name: _resolve_value(None, value) for name, value in write.data.items()}
+
+
+class DocumentStore:
+    """
+    Примитивы хранения документов, которые реализует конкретный бэкенд.
+    Документ адресуется путем коллекции ('users', 'users/login/chats') и идентификатором.
+    Метод apply выполняет список операций записи атомарно: либо все, либо ни одной
+    """
+
+    async def read(self, collection_path: str, document_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    async def read_many(self, keys: List[Tuple[str, str]]) -> List[Optional[Dict[str, Any]]]:
+        """
+        Чтение нескольких документов. Бэкенд может переопределить метод, чтобы читать их одним запросом
+        :param keys: Пары (путь коллекции, идентификатор документа)
+        :return: Данные документов в порядке keys, None для несуществующих
+        """
+        return [await self.read(collection_path, document_id) for collection_path, document_id in keys]
+
+    async def apply(self, writes: List[Write]):
+        raise NotImplementedError
+
+    async def query(self, collection_path: str, filters, orders, limit: Optional[int], start_after=None):
+        raise NotImplementedError
+
+
+class DocumentSnapshot:
+    def __init__(self, reference: 'DocumentReference', data: Optional[Dict[str, Any]]):
+        self._reference = reference
+        self._data = data
+
+    @property
+    def id(self) -> str:
+        return self._reference.id
+
+    @property
+    def reference(self) -> 'DocumentReference':
+        return self._reference
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        if self._data is None:
+            return None
+        return copy.deepcopy(self._data)
+
+    def get(self, field_path: str):
+        value = get_field(self._data or {}, field_path)
+        if value is _MISSING:
+            raise KeyError(field_path)
+        return copy.deepcopy(value)
+
+
+class DocumentReference:
+    def __init__(self, store: DocumentStore, collection_path: str, document_id: str):
+        self._store = store
+        self._collection_path = collection_path
+        self.id = document_id
+
+    @property
+    def path(self) -> str:
+        return f'{self._collection_path}/{self.id}'
+
+    @property
+    def parent(self) -> 'CollectionReference':
+        return CollectionReference(self._store, self._collection_path)
+
+    def collection(self, collection_id: str) -> 'CollectionReference':
+        return CollectionReference(self._store, f'{self.path}/{collection_id}')
+
+    def _write(self, kind: str, data: Optional[Dict[str, Any]] = None, merge: bool = False,
+               option: Optional[ExistsOption] = None) -> Write:
+        return Write(kind, self._collection_path, self.id, data, merge, option)
+
+    async def _apply(self, write: Write):
+        await self._store.apply([write])
+        return datetime.now(timezone.utc)
+
+    async def get(self) -> DocumentSnapshot:
+        return DocumentSnapshot(self, await self._store.read(self._collection_path, self.id))
+
+    async def create(self, document_data: Dict[str, Any]):
+        return await self._apply(self._write('create', document_data))
+
+    async def set(self, document_data: Dict[str, Any], merge: bool = False):
+        return await self._apply(self._write('set', document_data, merge))
+
+    async def update(self, field_updates: Dict[str, Any], option: Optional[ExistsOption] = None):
+        return await self._apply(self._write('update', field_updates, option=option))
+
+    async def delete(self, option: Optional[ExistsOption] = None):
+        return await self._apply(self._write('delete', option=option))
+
+    def __eq__(self, other):
+        return isinstance(other, DocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+
+class Query:
+    def __init__(self, store: DocumentStore, collection_path: str,
+                 filters: tuple = (), orders: tuple = (), limit: Optional[int] = None, start_after=None):
+        self._store = store
+        self._collection_path = collection_path
+        self._filters = filters
+        self._orders = orders
+        self._limit = limit
+        self._start_after = start_after
+
+    def _copy(self, **changes) -> 'Query':
+        state = dict(filters=self._filters, orders=self._orders, limit=self._limit, start_after=self._start_after)
+        state.update(changes)
+        return Query(self._store, self._collection_path, **state)
+
+    def where(self, field_path: str = None, op_string: str = None, value: Any = None, *, filter=None) -> 'Query':
+        field_filter = filter if filter is not None else FieldFilter(field_path, op_string, value)
+        return self._copy(filters=self._filters + (field_filter,))
+
+    def order_by(self, field_path: str, direction: str = ASCENDING) -> 'Query':
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count: int) -> 'Query':
+        return self._copy(limit=count)
+
+    def start_after(self, document_fields_or_snapshot) -> 'Query':
+        """
+        Начинает выборку после курсора. Курсор - снимок документа (значения полей сортировки
+        и идентификатор) или словарь значений полей сортировки
+        """
+        if isinstance(document_fields_or_snapshot, DocumentSnapshot):
+            cursor = (document_fields_or_snapshot.to_dict() or {}, document_fields_or_snapshot.id)
+        else:
+            cursor = (dict(document_fields_or_snapshot), None)
+        return self._copy(start_after=cursor)
+
+    async def stream(self):
+        documents = await self._store.query(self._collection_path, self._filters, self._orders, self._limit,
+                                            self._start_after)
+        for document_id, data in documents:
+            yield DocumentSnapshot(DocumentReference(self._store, self._collection_path, document_id), data)
+
+    async def get(self) -> List[DocumentSnapshot]:
+        return [snapshot async for snapshot in self.stream()]
+
+
+class CollectionReference(Query):
+    def __init__(self, store: DocumentStore, collection_path: str):
+        super().__init__(store, collection_path)
+
+    @property
+    def id(self) -> str:
+        return self._collection_path.rsplit('/', 1)[-1]
+
+    def document(self, document_id: Optional[str] = None) -> DocumentReference:
+        return DocumentReference(self._store, self._collection_path, document_id or auto_id())
+
+    async def add(self, document_data: Dict[str, Any], document_id: Optional[str] = None):
+        document_ref = self.document(document_id)
+        update_time = await document_ref.set(document_data)
+        return update_time, document_ref
+
+
+class WriteBatch:
+    """
+    Пакет операций записи, применяемых атомарно при commit(), как AsyncWriteBatch в Firestore
+    """
+
+    def __init__(self, store: DocumentStore):
+        self._store = store
+        self._writes: List[Write] = []
+
+    def create(self, reference: DocumentReference, document_data: Dict[str, Any]):
+        self._writes.append(reference._write('create', document_data))
+
+    def set(self, reference: DocumentReference, document_data: Dict[str, Any], merge: bool = False):
+        self._writes.append(reference._write('set', document_data, merge))
+
+    def update(self, reference: DocumentReference, field_updates: Dict[str, Any],
+               option: Optional[ExistsOption] = None):
+        self._writes.append(reference._write('update', field_updates, option=option))
+
+    def delete(self, reference: DocumentReference, option: Optional[ExistsOption] = None):
+        self._writes.append(reference._write('delete', option=option))
+
+    def __len__(self):
+        return len(self._writes)
+
+    async def commit(self):
+        writes, self._writes = self._writes, []
+        if writes:
+            await self._store.apply(writes)
+        return [datetime.now(timezone.utc) for _ in writes]
+
+
+class Transaction(WriteBatch):
+    """
+    Транзакция, как AsyncTransaction в Firestore. Документы, прочитанные через
+    StorageClient.get_all(..., transaction=...), при фиксации проверяются вместе с записью:
+    если кто-то изменил их после чтения, фиксация отклоняется с Aborted и async_transactional
+    повторяет функцию транзакции
+    """
+
+    def __init__(self, store: DocumentStore, max_attempts: int = 5):
+        super().__init__(store)
+        self._max_attempts = max_attempts
+        self._reads: Dict[str, Write] = {}
+
+    def _read(self, reference: DocumentReference, data: Optional[Dict[str, Any]]):
+        self._reads.setdefault(reference.path, reference._write('verify', copy.deepcopy(data)))
+
+    def _reset(self):
+        self._writes = []
+        self._reads = {}
+
+    async def commit(self):
+        writes = [*self._reads.values(), *self._writes]
+        self._reset()
+        if writes:
+            await self._store.apply(writes)
+        return [datetime.now(timezone.utc) for _ in writes]
+
+
+def async_transactional(func):
+    """
+    Декоратор функции транзакции, как firestore.async_transactional: функция вызывается
+    с транзакцией первым аргументом и повторяется, пока фиксация не пройдет
+    :raises ValueError: Транзакция не зафиксирована за max_attempts попыток
+    """
+    @functools.wraps(func)
+    async def wrapper(transaction: Transaction, *args, **kwargs):
+        for attempt in range(transaction._max_attempts):
+            transaction._reset()
+            result = await func(transaction, *args, **kwargs)
+            try:
+                await transaction.commit()
+                return result
+            except Aborted:
+                continue
+        raise ValueError(f'Транзакция не выполнена за {transaction._max_attempts} попыток')
+    return wrapper
+
+
+class StorageClient:
+    """
+    Клиент локального хранилища с интерфейсом firestore_async.client()
+    """
+
+    def __init__(self, store: DocumentStore):
+        self._store = store
+
+    def collection(self, collection_id: str) -> CollectionReference:
+        return CollectionReference(self._store, collection_id)
+
+    def document(self, document_path: str) -> DocumentReference:
+        collection_path, document_id = document_path.rsplit('/', 1)
+        return DocumentReference(self._store, collection_path, document_id)
+
+    def batch(self) -> WriteBatch:
+        return WriteBatch(self._store)
+
+    def transaction(self, max_attempts: int = 5) -> Transaction:
+        return Transaction(self._store, max_attempts)
+
+    @staticmethod
+    def write_option(exists: bool) -> ExistsOption:
+        """
+        Условие записи на существование документа, как client.write_option в Firestore
+        """
+        return ExistsOption(exists)
+
+    async def get_all(self, references: List[DocumentReference], transaction: Optional[Transaction] = None):
+        """
+        Чтение нескольких документов за одно обращение к хранилищу
+        :param references: Ссылки на документы
+        :param transaction: Транзакция, при фиксации которой прочитанные документы должны быть неизменны
+        :return: Асинхронный генератор снимков, для несуществующих документов exists == False
+        """
+        references = list(references)
+        documents = await self._store.read_many([(reference._collection_path, reference.id)
+                                                 for reference in references])
+        for reference, data in zip(references, documents):
+            if transaction is not None:
+                transaction._read(reference, data)
+            yield DocumentSnapshot(reference, data)
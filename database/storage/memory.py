@@ -0,0 +1,43 @@
+import copy
+from typing import Any, Dict, List, Optional, Tuple
+
+from database.storage import DocumentStore, StorageClient, Write, apply_query, resolve_write
+
+
+class MemoryStore(DocumentStore):
+    """
+    Хранилище в памяти процесса. Данные копируются при чтении и записи,
+    поэтому изменение полученного словаря не меняет сохраненный документ
+    """
+
+    def __init__(self):
+        self._collections: Dict[str, Dict[str, Dict[str, Any]]] = {}
+
+    async def read(self, collection_path: str, document_id: str) -> Optional[Dict[str, Any]]:
+        data = self._collections.get(collection_path, {}).get(document_id)
+        return copy.deepcopy(data)
+
+    async def apply(self, writes: List[Write]):
+        # Сначала вычисляются все новые версии документов, и только если ни одна операция
+        # не завершилась ошибкой, они сохраняются
+        pending: Dict[Tuple[str, str], Optional[Dict[str, Any]]] = {}
+        for write in writes:
+            key = (write.collection_path, write.document_id)
+            current = pending[key] if key in pending else self._collections.get(key[0], {}).get(key[1])
+            pending[key] = resolve_write(current, write)
+
+        for (collection_path, document_id), data in pending.items():
+            if data is None:
+                self._collections.get(collection_path, {}).pop(document_id, None)
+            else:
+                self._collections.setdefault(collection_path, {})[document_id] = data
+
+    async def query(self, collection_path: str, filters, orders, limit: Optional[int], start_after=None):
+        documents = self._collections.get(collection_path, {}).items()
+        return [(document_id, copy.deepcopy(data))
+                for document_id, data in apply_query(list(documents), filters, orders, limit, start_after)]
+
+
+class MemoryClient(StorageClient):
+    def __init__(self):
+        super().__init__(MemoryStore())
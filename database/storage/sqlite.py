@@ -0,0 +1,255 @@
+import asyncio
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from database.storage import DESCENDING, DOCUMENT_ID, DocumentStore, StorageClient, Write, apply_query, id_direction, \
+    order_value, resolve_write, sort_key
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    collection TEXT NOT NULL,
+    id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (collection, id)
+) WITHOUT ROWID
+"""
+
+# Типы json_type() SQLite, соответствующие типу значения фильтра
+JSON_TYPES = {
+    bool: ('true', 'false'),
+    int: ('integer', 'real'),
+    float: ('integer', 'real'),
+    str: ('text',),
+}
+
+COMPARISONS = {'==': '=', '<': '<', '<=': '<=', '>': '>', '>=': '>='}
+
+# Ранг типа значения поля, как database.storage.sort_key: json_extract возвращает true и false
+# как 1 и 0, поэтому без ранга булевы значения сортировались бы вместе с числами
+TYPE_RANK = ("CASE json_type(data, ?) WHEN 'null' THEN 0 WHEN 'true' THEN 1 WHEN 'false' THEN 1 "
+             "WHEN 'integer' THEN 2 WHEN 'real' THEN 2 WHEN 'text' THEN 4 WHEN 'array' THEN 6 ELSE 7 END")
+
+
+def _json_path(field_path: str) -> str:
+    return '$.' + '.'.join(f'"{part}"' for part in field_path.split('.'))
+
+
+def _placeholders(values) -> str:
+    return ', '.join('?' for _ in values)
+
+
+def _compile_filter(field_filter):
+    """
+    Переводит условие фильтра в выражение SQL над json-данными документа
+    :return: Пара (выражение, параметры) или None, если условие нельзя выразить в SQL
+    """
+    path = _json_path(field_filter.field_path)
+    op, value = field_filter.op_string, field_filter.value
+
+    if op in ('in', 'array_contains_any'):
+        if not value or any(type(item) not in JSON_TYPES for item in value):
+            return None
+    elif type(value) not in JSON_TYPES:
+        return None
+
+    if op in COMPARISONS:
+        types = JSON_TYPES[type(value)]
+        return (f"json_type(data, ?) IN ({_placeholders(types)}) AND json_extract(data, ?) {COMPARISONS[op]} ?",
+                [path, *types, path, value])
+    if op == '!=':
+        types = JSON_TYPES[type(value)]
+        return (f"json_type(data, ?) != 'null' AND "
+                f"NOT (json_type(data, ?) IN ({_placeholders(types)}) AND json_extract(data, ?) = ?)",
+                [path, path, *types, path, value])
+    if op == 'in':
+        # Значения одного типа в списке 'in' сравниваются по json_type каждого значения
+        clauses, params = [], []
+        for item in value:
+            types = JSON_TYPES[type(item)]
+            clauses.append(f"(json_type(data, ?) IN ({_placeholders(types)}) AND json_extract(data, ?) = ?)")
+            params.extend([path, *types, path, item])
+        return '(' + ' OR '.join(clauses) + ')', params
+    if op == 'array_contains':
+        return ("EXISTS (SELECT 1 FROM json_each(data, ?) WHERE json_each.value = ?)", [path, value])
+    if op == 'array_contains_any':
+        return (f"EXISTS (SELECT 1 FROM json_each(data, ?) WHERE json_each.value IN ({_placeholders(value)}))",
+                [path, *value])
+    return None
+
+
+def _compile_cursor(orders, cursor):
+    """
+    Переводит курсор start_after в лексикографическое условие по полям сортировки
+    и неявной сортировке по идентификатору документа
+    :return: Пара (выражение, параметры) или None, если курсор нельзя выразить в SQL
+    """
+    values, cursor_id = cursor
+    keys = []
+    for field_path, direction in orders:
+        if field_path not in values:
+            break
+        if field_path == DOCUMENT_ID:
+            keys.append(('id', [], direction, values[field_path]))
+            continue
+        if type(values[field_path]) not in JSON_TYPES:
+            return None
+        path = _json_path(field_path)
+        rank, value = sort_key(values[field_path])
+        keys.append((TYPE_RANK, [path], direction, rank))
+        keys.append(('json_extract(data, ?)', [path], direction, value))
+    else:
+        if cursor_id is not None:
+            keys.append(('id', [], id_direction(orders), cursor_id))
+
+    if not keys:
+        return '0', []
+
+    clauses, params = [], []
+    for index, (expression, expression_params, direction, value) in enumerate(keys):
+        parts = []
+        for previous_expression, previous_params, _, previous_value in keys[:index]:
+            parts.append(f'{previous_expression} = ?')
+            params.extend([*previous_params, previous_value])
+        parts.append(f"{expression} {'<' if direction == DESCENDING else '>'} ?")
+        params.extend([*expression_params, value])
+        clauses.append('(' + ' AND '.join(parts) + ')')
+    return '(' + ' OR '.join(clauses) + ')', params
+
+
+class SQLiteStore(DocumentStore):
+    """
+    Хранилище документов в файле SQLite. Документ хранится строкой JSON в таблице documents,
+    условия запросов по возможности выполняются в SQL через json_extract.
+    Все обращения к базе идут через один выделенный поток, поэтому event loop не блокируется
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._connection = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-store')
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self._path)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute(SCHEMA)
+            self._connection.commit()
+        return self._connection
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _read(self, collection_path: str, document_id: str):
+        row = self._connect().execute(
+            'SELECT data FROM documents WHERE collection = ? AND id = ?',
+            (collection_path, document_id)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _read_many(self, keys: List[Tuple[str, str]]):
+        found = {}
+        # Ограничение SQLite на количество параметров запроса - 999
+        for start in range(0, len(keys), 400):
+            chunk = keys[start:start + 400]
+            rows = self._connect().execute(
+                'SELECT collection, id, data FROM documents WHERE '
+                + ' OR '.join(['(collection = ? AND id = ?)'] * len(chunk)),
+                [value for key in chunk for value in key]
+            ).fetchall()
+            found.update(((collection_path, document_id), data) for collection_path, document_id, data in rows)
+        return [json.loads(found[key]) if key in found else None for key in keys]
+
+    def _apply(self, writes: List[Write]):
+        connection = self._connect()
+        try:
+            # Блокировка на запись берется до чтения текущих версий документов, иначе
+            # create() и Increment из разных процессов могли бы перезаписать друг друга
+            connection.execute('BEGIN IMMEDIATE')
+            for write in writes:
+                data = resolve_write(self._read(write.collection_path, write.document_id), write)
+                if write.kind == 'verify':
+                    continue
+                if data is None:
+                    connection.execute('DELETE FROM documents WHERE collection = ? AND id = ?',
+                                       (write.collection_path, write.document_id))
+                else:
+                    connection.execute(
+                        'INSERT OR REPLACE INTO documents (collection, id, data) VALUES (?, ?, ?)',
+                        (write.collection_path, write.document_id, json.dumps(data, ensure_ascii=False))
+                    )
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+
+    def _query_all(self, collection_path: str, filters, orders, limit: Optional[int], start_after=None):
+        """
+        Выполняет запрос в Python над всеми документами коллекции
+        """
+        rows = self._connect().execute(
+            'SELECT id, data FROM documents WHERE collection = ?', (collection_path,)
+        ).fetchall()
+        documents = [(document_id, json.loads(data)) for document_id, data in rows]
+        return apply_query(documents, filters, orders, limit, start_after)
+
+    def _query(self, collection_path: str, filters, orders, limit: Optional[int], start_after=None):
+        compiled = [_compile_filter(field_filter) for field_filter in filters]
+        if start_after is not None:
+            compiled.append(_compile_cursor(orders, start_after))
+
+        if any(clause is None for clause in compiled):
+            return self._query_all(collection_path, filters, orders, limit, start_after)
+
+        sql = ['SELECT id, data FROM documents WHERE collection = ?']
+        params: list = [collection_path]
+
+        for clause, clause_params in compiled:
+            sql.append(f'AND {clause}')
+            params.extend(clause_params)
+
+        order_clauses, order_params = [], []
+        for field_path, direction in orders:
+            suffix = 'DESC' if direction == DESCENDING else 'ASC'
+            if field_path == DOCUMENT_ID:
+                order_clauses.append(f'id {suffix}')
+                continue
+            sql.append('AND json_type(data, ?) IS NOT NULL')
+            params.append(_json_path(field_path))
+            order_clauses.extend([f'{TYPE_RANK} {suffix}', f'json_extract(data, ?) {suffix}'])
+            order_params.extend([_json_path(field_path)] * 2)
+        order_clauses.append(f"id {'DESC' if id_direction(orders) == DESCENDING else 'ASC'}")
+        sql.append('ORDER BY ' + ', '.join(order_clauses))
+        params.extend(order_params)
+
+        if limit is not None:
+            sql.append('LIMIT ?')
+            params.append(limit)
+
+        rows = self._connect().execute(' '.join(sql), params).fetchall()
+        documents = [(document_id, json.loads(data)) for document_id, data in rows]
+        # Массивы и словари SQLite сравнивает как текст JSON, а Firestore - поэлементно
+        if any(isinstance(order_value(item, field_path), (list, dict))
+               for item in documents for field_path, _ in orders):
+            return self._query_all(collection_path, filters, orders, limit, start_after)
+        return documents
+
+    async def read(self, collection_path: str, document_id: str) -> Optional[Dict[str, Any]]:
+        return await self._run(self._read, collection_path, document_id)
+
+    async def read_many(self, keys: List[Tuple[str, str]]) -> List[Optional[Dict[str, Any]]]:
+        return await self._run(self._read_many, list(keys))
+
+    async def apply(self, writes: List[Write]):
+        await self._run(self._apply, writes)
+
+    async def query(self, collection_path: str, filters, orders, limit: Optional[int], start_after=None):
+        return await self._run(self._query, collection_path, filters, orders, limit, start_after)
+
+
+class SQLiteClient(StorageClient):
+    def __init__(self, path: str):
+        super().__init__(SQLiteStore(path))
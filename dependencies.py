@@ -1,5 +1,5 @@
 from lib import verify_password, get_password_hash, \
-    create_access_token, root_collection_item_exist
+    create_access_token, root_collection_item_exist, get_user_document, update_user_document
 from database.models import BaseUserModel
 from database import DataBaseConnector
 
@@ -16,25 +16,29 @@ config.read()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
 
-def get_user(user_login: str):
-    user_ref = root_collection_item_exist(firebase, 'users', user_login)
-    if user_ref:
-        user_dict = (user_ref.get()).to_dict()
+async def get_user(user_login: str):
+    user_dict = await get_user_document(firebase, user_login)
+    if user_dict:
         model = BaseUserModel(**user_dict)
         return model
 
 
-def authenticate_user(user_login: str, password: str):
-    user = get_user(user_login)
+async def authenticate_user(user_login: str, password: str):
+    user = await get_user(user_login)
     if not user:
         return False
-    if not verify_password(password, user.password):
+    verified, new_hash = await verify_password(password, user.password)
+    if not verified:
         return False
+    if new_hash:
+        # Стоимость bcrypt в настройках изменилась - сохраняем хэш, пересчитанный при проверке
+        await update_user_document(firebase, user_login, {'password': new_hash})
+        user.password = new_hash
     return user
 
 
-def check_user_permission(request: Request, user_login: str):
+async def check_user_permission(request: Request, user_login: str):
     print(request, user_login)
-    user_ref = get_user(user_login)
+    user_ref = await get_user(user_login)
     if user_ref:
         user_dict = (user_ref.get()).to_dict()
\ No newline at end of file
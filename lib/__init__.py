@@ -1,29 +1,80 @@
 from fastapi.exceptions import HTTPException
 from fastapi import Request, WebSocket, WebSocketException
-from passlib.context import CryptContext
-from datetime import datetime, timedelta
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from datetime import datetime, timedelta, timezone
 
 # from database.models import BaseUserModel, Chat, ChatMeta, \
 #     Notification, Token, MessageType, Message, WebSocketManager, WebSocketMessage
 from config import Configuration
 
 from jose import JWTError, jwt, ExpiredSignatureError
-from typing import Union, Optional
+from typing import Union, Optional, List, Tuple, Dict, AsyncIterator
 from uuid import uuid4
 
+import asyncio
+import base64
+import json
+import orjson
+
 import database.models as models
+from database import DataBaseConnector, ASCENDING, DESCENDING, DOCUMENT_ID, AlreadyExists
+from lib.cache import TTLLRUCache, ExpiringLRUCache
+from lib.write_behind import WriteBehindBuffer
+from lib.hashing import PasswordHasher
+from lib.loader import DocumentLoader
+from lib.chat_activity import ChatActivityWriter, unread_count
+from lib.presence import PresenceService
+from lib.chat_cache import ChatCache
+from lib.notifications import NotificationPipeline
+from lib.bus import LOST_MESSAGE_TYPE
+from lib import directory
 
 websocket_manager = models.WebSocketManager()
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 config = Configuration()
 config.read()
 
 JWT_HASH_KEY = config['keys']['jwt']
 CRYPT_ALGORITHM = config['crypt_settings']['algorithm']
 
+password_hasher = PasswordHasher(
+    rounds=config.get('crypt_settings', 'bcrypt_rounds', 12),
+    executor=config.get('crypt_settings', 'hash_executor', 'thread'),
+    workers=config.get('crypt_settings', 'hash_workers', 2),
+    max_concurrency=config.get('crypt_settings', 'hash_max_concurrency', None),
+)
+
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_PAGE_MAX_SIZE = 500
+
+USERS_PAGE_SIZE = 50
+USERS_PAGE_MAX_SIZE = 200
+
+CHATS_PAGE_SIZE = 50
+CHATS_PAGE_MAX_SIZE = 200
+
+NOTIFICATIONS_PAGE_SIZE = 50
+NOTIFICATIONS_PAGE_MAX_SIZE = 200
 
-def root_collection_item_exist(database, collection_name: str, item_id: str):
+user_cache = TTLLRUCache(
+    'users',
+    maxsize=config.get('cache', 'users_max_size', 10000),
+    ttl=config.get('cache', 'users_ttl', 60),
+)
+
+token_cache = ExpiringLRUCache('tokens', maxsize=config.get('cache', 'tokens_max_size', 10000))
+
+
+def document_loader(database) -> DocumentLoader:
+    """
+    Загрузчик документов для одного запроса: чтения, запрошенные одновременно,
+    выполняются одним get_all, документы пользователей берутся из кэша профилей
+    :param database: Объект базы Firestore
+    """
+    return DocumentLoader(database, user_cache)
+
+
+async def root_collection_item_exist(database, collection_name: str, item_id: str):
     """
     Получение документа из главной коллекции в базе Firestore
     :param database: Объект базы Firestore
@@ -32,7 +83,12 @@ def root_collection_item_exist(database, collection_name: str, item_id: str):
     :return: Ссылку на документ в случае его существования в базе, иначе - None
     """
     item_ref = database.collection(collection_name).document(item_id)
-    item_doc = item_ref.get()
+
+    if collection_name == 'users':
+        user_dict = await get_user_document(database, item_id)
+        return item_ref if user_dict is not None else None
+
+    item_doc = await item_ref.get()
 
     if item_doc.exists:
         return item_ref
@@ -40,60 +96,124 @@ def root_collection_item_exist(database, collection_name: str, item_id: str):
     return None
 
 
-def verify_password(plain_password, hashed_password):
+async def get_user_document(database, user_login: str) -> Optional[dict]:
+    """
+    Получение документа пользователя через кэш профилей
+    :param database: Объект базы Firestore
+    :param user_login: Логин пользователя
+    :return: Словарь документа пользователя или None, если пользователя нет
+    """
+    user_dict = user_cache.get(user_login)
+    if user_dict is not None:
+        return user_dict
+
+    user_doc = await database.collection('users').document(user_login).get()
+    if not user_doc.exists:
+        return None
+
+    user_dict = user_doc.to_dict()
+    user_cache.set(user_login, user_dict)
+    return user_dict
+
+
+async def set_user_document(database, user_login: str, user_dict: dict):
+    """
+    Запись документа пользователя с обновлением кэша профилей и каталога пользователей.
+    Документ пользователя и документ каталога записываются одним пакетом
+    :param database: Объект базы Firestore
+    :param user_login: Логин пользователя
+    :param user_dict: Словарь документа пользователя
+    """
+    user_cache.invalidate(user_login)
+    batch = database.batch()
+    batch.set(database.collection('users').document(user_login), user_dict)
+    batch.set(database.collection(directory.DIRECTORY_COLLECTION).document(user_login),
+              directory.directory_entry(user_dict))
+    await batch.commit()
+    user_cache.set(user_login, user_dict)
+
+
+async def update_user_document(database, user_login: str, fields: dict):
+    """
+    Обновление полей документа пользователя со сбросом записи в кэше профилей
+    :param database: Объект базы Firestore
+    :param user_login: Логин пользователя
+    :param fields: Обновляемые поля
+    """
+    user_cache.invalidate(user_login)
+    await database.collection('users').document(user_login).update(fields)
+
+
+async def verify_password(plain_password, hashed_password):
     """
     Проверка совпадения хэшей пароля
     :param plain_password: Пароль введенный пользователем
     :param hashed_password: Хэшированный пароль из базы
-    :return: True если хэши паролей совпали, False - иначе
+    :return: Пара (True если хэши паролей совпали, False - иначе;
+    новый хэш, если сохраненный получен с другой стоимостью bcrypt, иначе None)
     """
-    return pwd_context.verify(plain_password, hashed_password)
+    return await password_hasher.verify_and_update(plain_password, hashed_password)
 
 
-def get_password_hash(password: str):
+async def get_password_hash(password: str):
     """
-    Хэширует пароль по схеме bcrypt
+    Хэширует пароль по схеме bcrypt со стоимостью bcrypt_rounds из секции [crypt_settings]
     :param password: Исходный пароль
     :return: Захэшированный пароль
     """
-    return pwd_context.hash(password)
+    return await password_hasher.hash(password)
 
 
 def create_access_token(user: models.BaseUserModel, expires_delta: timedelta = timedelta(days=1)):
     """
-    Создание JWT токена для авторизации пользователя
+    Создание JWT токена для авторизации пользователя. В токен попадают только
+    логин (sub), роль (role) и срок годности (exp)
     :param user: Пользователь
     :param expires_delta: Срок годности токена (по умолчанию 1 день)
     :return: Возвращает сформированный токен в виде строки
     """
 
-    user_dict = user.dict()
-    expires = datetime.utcnow()
-    expires = (expires + expires_delta).strftime("%a, %d %b %Y %H:%M:%S GMT")
-    # expires = (datetime.utcnow() + expires_delta).strftime("%a, %d %b %Y %H:%M:%S GMT")
-    user_dict.update({'expires': expires})
-    encoded_jwt = jwt.encode(user_dict, config['keys']['jwt'],
+    expires = datetime.utcnow() + expires_delta
+    claims = {
+        'sub': user.login,
+        'role': int(user.role),
+        'exp': int(expires.replace(tzinfo=timezone.utc).timestamp()),
+    }
+    encoded_jwt = jwt.encode(claims, config['keys']['jwt'],
                              algorithm=config['crypt_settings']['algorithm'])
 
-    token = models.Token(access_token=encoded_jwt, token_type='Bearer', expires=expires)
+    token = models.Token(access_token=encoded_jwt, token_type='Bearer',
+                         expires=expires.strftime("%a, %d %b %Y %H:%M:%S GMT"))
 
     return token
 
 
-def create_dialog(database, creator_ref, member_ref) -> Union[models.ChatMeta, None]:
-    creator_model = models.BaseUserModel(**creator_ref.get().to_dict())
-    member_model = models.BaseUserModel(**member_ref.get().to_dict())
+async def create_dialog(database, creator_ref, member_ref,
+                        loader: DocumentLoader = None) -> Tuple[Optional[models.ChatMeta], Optional[models.ChatMeta]]:
+    """
+    Создает диалог двух пользователей
+    :param database: Объект базы Firestore
+    :param creator_ref: Ссылка на документ создателя диалога
+    :param member_ref: Ссылка на документ собеседника
+    :param loader: Загрузчик документов запроса, через него все документы читаются за одно обращение к базе
+    :return: Пара метаданных диалога для создателя и для собеседника, (None, None) если диалог не создан
+    """
+    loader = loader or document_loader(database)
 
-    creator_chat_ref = creator_ref.collection('chats').document(member_model.login)
-    creator_chat_doc = creator_chat_ref.get()
+    creator_chat_ref = creator_ref.collection('chats').document(member_ref.id)
+    member_chat_ref = member_ref.collection('chats').document(creator_ref.id)
 
-    member_chat_ref = member_ref.collection('chats').document(creator_model.login)
-    member_chat_doc = member_chat_ref.get()
+    creator_dict, member_dict, creator_chat_dict, member_chat_dict = await loader.load_many(
+        [creator_ref, member_ref, creator_chat_ref, member_chat_ref]
+    )
+    creator_model = models.BaseUserModel(**creator_dict)
+    member_model = models.BaseUserModel(**member_dict)
 
     creator_chat_meta = None
+    member_chat_meta = None
 
     try:
-        if creator_chat_doc.exists and member_chat_doc.exists:
+        if creator_chat_dict is not None and member_chat_dict is not None:
             raise HTTPException(detail={'message': 'Диалог существует'}, status_code=400)
         else:
             chat = models.Chat(
@@ -101,26 +221,31 @@ def create_dialog(database, creator_ref, member_ref) -> Union[models.ChatMeta, N
                 messages=[],
             )
 
-            update_time, chat_ref = database.collection('chats').add(chat.dict())
+            update_time, chat_ref = await database.collection('chats').add(chat.dict())
+            chat_membership.changed(chat_ref.id)
 
-            creator_chat_meta = models.ChatMeta(
+            creator_chat_meta = models.ChatMetaDataBase(
                 chat_name=f'{member_model.name} {member_model.surname}',
                 chat_id=chat_ref.id,
                 created_at=chat.created_at,
+                last_activity_at=chat.created_at,
             )
 
-            member_chat_meta = models.ChatMeta(
+            member_chat_meta = models.ChatMetaDataBase(
                 chat_name=f'{creator_model.name} {creator_model.surname}',
                 chat_id=chat_ref.id,
-                created_at=chat.created_at
+                created_at=chat.created_at,
+                last_activity_at=chat.created_at,
             )
-            creator_chat_ref.set(creator_chat_meta.dict())
-            member_chat_ref.set(member_chat_meta.dict())
+            batch = database.batch()
+            batch.set(creator_chat_ref, creator_chat_meta.dict())
+            batch.set(member_chat_ref, member_chat_meta.dict())
+            await batch.commit()
     finally:
         return creator_chat_meta, member_chat_meta
 
 
-def create_chat(database, members, chat_name: str = uuid4()) -> Union[models.ChatMeta, None]:
+async def create_chat(database, members, chat_name: str = uuid4()) -> Union[models.ChatMeta, None]:
 
     chat_meta = None
     try:
@@ -128,20 +253,63 @@ def create_chat(database, members, chat_name: str = uuid4()) -> Union[models.Cha
             members=members,
             chat_name=chat_name
         )
-        update_time, chat_ref = database.collection('chats').add(chat.dict())
-        chat_meta = models.ChatMeta(
+        update_time, chat_ref = await database.collection('chats').add(chat.dict())
+        chat_membership.changed(chat_ref.id)
+        chat_meta = models.ChatMetaDataBase(
             chat_name=chat_name,
             chat_id=chat_ref.id,
-            created_at=chat.created_at
+            created_at=chat.created_at,
+            last_activity_at=chat.created_at,
         )
+        # Существование участников проверяет вызывающий код, поэтому документы пользователей
+        # не читаются, а метаданные чата записываются всем участникам одним пакетом
+        batch = database.batch()
         for member_login in members:
-            member_ref = root_collection_item_exist(database, 'users', member_login)
-            member_chat_ref = member_ref.collection('chats').document(chat_name)
-            member_chat_ref.set(chat_meta.dict())
+            member_chat_ref = database.collection('users').document(member_login).collection('chats').document(chat_name)
+            batch.set(member_chat_ref, chat_meta.dict())
+        await batch.commit()
     finally:
         return chat_meta
 
 
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+
+def wants_ndjson(request: Request) -> bool:
+    """
+    Проверяет, запросил ли клиент потоковую выдачу списка заголовком Accept: application/x-ndjson
+    :param request: Объект запроса
+    """
+    return NDJSON_MEDIA_TYPE in request.headers.get('accept', '')
+
+
+def ndjson_response(items: AsyncIterator[dict], headers: Dict[str, str] = None) -> StreamingResponse:
+    """
+    Потоковый ответ: каждый элемент - отдельная строка JSON, отправляемая сразу,
+    как только документ прочитан из базы. Список целиком в памяти не собирается
+    :param items: Асинхронный генератор словарей
+    :param headers: Дополнительные заголовки ответа
+    :return: Ответ с типом application/x-ndjson
+    """
+    async def lines():
+        async for item in items:
+            yield orjson.dumps(item) + b'\n'
+
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE, headers=headers)
+
+
+async def list_response(request: Request, key: str, items: AsyncIterator[dict]):
+    """
+    Ответ со списком документов: {key: [...]} или поток NDJSON, если клиент его запросил
+    :param request: Объект запроса
+    :param key: Ключ списка в ответе JSON
+    :param items: Асинхронный генератор словарей
+    """
+    if wants_ndjson(request):
+        return ndjson_response(items)
+    return ORJSONResponse(content={key: [item async for item in items]}, status_code=200)
+
+
 def get_token_from_request(request: Request) -> str:
     """
     Получение токена из заголовка Authorization в запросе
@@ -152,63 +320,501 @@ def get_token_from_request(request: Request) -> str:
     return token
 
 
-def get_user_from_token(token: str) -> Union[models.BaseUserModel, None]:
+def get_user_from_token(token: str) -> Union[models.TokenClaims, None]:
     """
-    Получение пользователя из JWT токена
+    Получение данных пользователя из JWT токена. Проверенные токены хранятся в кэше
+    до истечения их срока годности, поэтому повторные запросы с тем же токеном не декодируют его
     :param token: JWT токен
-    :return: Возвращает модель пользователя или None
+    :return: Возвращает данные пользователя из токена или None, если токен недействителен
     """
-    user = None
+    claims = token_cache.get(token)
+    if claims is not None:
+        return models.TokenClaims.construct(**claims)
+
     try:
         decoded_jwt = jwt.decode(token, JWT_HASH_KEY, algorithms=CRYPT_ALGORITHM)
-        user = models.BaseUserModel.parse_obj(decoded_jwt)
+        user = models.TokenClaims(login=decoded_jwt['sub'], role=decoded_jwt.get('role', models.Role.USER),
+                                  expires_at=decoded_jwt['exp'])
+    except (JWTError, ExpiredSignatureError, KeyError, ValueError):
+        # Токены старого формата без sub и exp тоже недействительны
+        return None
 
-    except (JWTError, ExpiredSignatureError):
-        raise HTTPException(detail={'message': 'Пользователь не авторизован'}, status_code=401)
-    finally:
-        return user
+    token_cache.set(token, user.dict(), expires_at=user.expires_at)
+    return user
 
 
-async def send_websocket_message(chat_id: str, message: models.Message, websocket: Optional[WebSocket]):
+def encode_cursor(value, key: str = 'seq') -> str:
     """
-    Сохраняет сообщение в коллекции чата, а также, если передан объект websocket - отправляет
-    созданное сообщение пользователю
-    :param chat_id: Уникальный идентификатор чата
-    :param message: Объект сообщения
-    :param websocket: Объект соединения websocket с пользователем
-    :return:
+    Формирует непрозрачный токен курсора для постраничной выдачи
+    :param value: Значение поля сортировки последнего элемента страницы
+    (по умолчанию - порядковый номер сообщения в чате)
+    :param key: Имя поля сортировки
+    :return: Строка токена
     """
-    websocket_message = models.WebSocketMessage(
-        type=models.MessageType.MESSAGE,
-        content=message,
-    )
+    return encode_cursor_fields({key: value})
 
-    response_message = models.ResponseMessage(
-        message=websocket_message,
-        chat_id=chat_id
-    )
 
-    if websocket:
-        await websocket.send_json(response_message.dict())
-    return websocket_message
+def encode_cursor_fields(values: dict) -> str:
+    """
+    Формирует токен курсора из значений нескольких полей сортировки последнего элемента страницы
+    :param values: Словарь {поле сортировки: значение}
+    :return: Строка токена
+    """
+    payload = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
 
 
-async def send_websocket_notification(user_ref, notification: models.Notification, websocket: Optional[WebSocket]):
+def decode_cursor(token: str, key: str = 'seq', kind: type = int):
     """
-    Сохраняет уведомление в коллекции уведомлений пользователя, а также, если передан объект websocket - отправляет
-    созданное уведомление пользователю
-    :param user_ref: Ссылка на документ пользователя в базе данных
-    :param notification: Объект уведомления
-    :param websocket: Объект соединения websocket с пользователем
-    :return:
+    Разбирает токен курсора
+    :param token: Строка токена
+    :param key: Имя поля сортировки
+    :param kind: Тип значения поля
+    :return: Значение поля сортировки (по умолчанию - порядковый номер сообщения в чате)
     """
-    sent_notification_info = user_ref.collection('notifications').add(notification.dict())
+    return decode_cursor_fields(token, {key: kind})[key]
 
-    websocket_message = models.WebSocketMessage(
-        type=models.MessageType.NOTIFICATION,
-        content=notification
-    )
 
-    if websocket:
-        await websocket.send_json(websocket_message.dict())
-    return sent_notification_info
+def decode_cursor_fields(token: str, kinds: Dict[str, type]) -> dict:
+    """
+    Разбирает токен курсора с несколькими полями сортировки
+    :param token: Строка токена
+    :param kinds: Словарь {поле сортировки: тип значения}
+    :return: Словарь {поле сортировки: значение}
+    """
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        values = {key: payload[key] for key in kinds}
+        for key, kind in kinds.items():
+            if not isinstance(values[key], kind):
+                raise TypeError(key)
+        return values
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(detail={'message': 'Некорректный курсор'}, status_code=400)
+
+
+async def get_user_chats(user_ref, limit: int = CHATS_PAGE_SIZE,
+                         cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+    """
+    Страница метаданных чатов пользователя, начиная с недавно активных
+    :param user_ref: Ссылка на документ пользователя
+    :param limit: Размер страницы
+    :param cursor: Токен курсора из предыдущей страницы
+    :return: Список метаданных чатов и токен курсора следующей страницы (None, если страниц больше нет)
+    """
+    # Идентификатор чата различает чаты с одинаковым до миллисекунды временем активности на границе страниц
+    query = user_ref.collection('chats').order_by('last_activity_at', direction=DESCENDING) \
+        .order_by('chat_id', direction=DESCENDING)
+    if cursor:
+        query = query.start_after(decode_cursor_fields(cursor, {'last_activity_at': int, 'chat_id': str}))
+
+    chats = [chat_doc.to_dict() async for chat_doc in query.limit(limit + 1).stream()]
+    has_more = len(chats) > limit
+    chats = chats[:limit]
+    for chat in chats:
+        chat['unread'] = unread_count(chat)
+    next_cursor = encode_cursor_fields({'last_activity_at': chats[-1]['last_activity_at'],
+                                        'chat_id': chats[-1]['chat_id']}) if has_more else None
+    return chats, next_cursor
+
+
+async def get_notifications(user_ref, limit: int = NOTIFICATIONS_PAGE_SIZE,
+                            cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+    """
+    Страница уведомлений пользователя, начиная с новых
+    :param user_ref: Ссылка на документ пользователя
+    :param limit: Размер страницы
+    :param cursor: Токен курсора из предыдущей страницы
+    :return: Список уведомлений и токен курсора следующей страницы (None, если страниц больше нет)
+    """
+    # Уведомления одного события получают одинаковое время: на границе страниц их различает идентификатор
+    query = user_ref.collection('notifications').order_by('received_at', direction=DESCENDING) \
+        .order_by(DOCUMENT_ID, direction=DESCENDING)
+    if cursor:
+        values = decode_cursor_fields(cursor, {'received_at': int, 'id': str})
+        query = query.start_after({'received_at': values['received_at'], DOCUMENT_ID: values['id']})
+
+    notifications = []
+    async for notification_doc in query.limit(limit + 1).stream():
+        notification_obj = {'id': notification_doc.id}
+        notification_obj.update(notification_doc.to_dict())
+        notifications.append(notification_obj)
+    has_more = len(notifications) > limit
+    notifications = notifications[:limit]
+    next_cursor = encode_cursor_fields({'received_at': notifications[-1]['received_at'],
+                                        'id': notifications[-1]['id']}) if has_more else None
+    return notifications, next_cursor
+
+
+async def get_chat_messages(chat_ref, limit: int = MESSAGES_PAGE_SIZE,
+                            before: Optional[str] = None, after: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+    """
+    Получение страницы сообщений чата по порядковым номерам. Без курсоров возвращает последние limit сообщений,
+    с курсором before - сообщения старше курсора, с курсором after - новее курсора.
+    Сообщения всегда возвращаются в хронологическом порядке. Последняя страница берется из кэша чатов,
+    если в нем есть все ее сообщения и в базе нет более новых (cached_tail_current),
+    а прочитанная из базы добавляется в кэш
+    :param chat_ref: Ссылка на документ чата
+    :param limit: Размер страницы
+    :param before: Токен курсора, до которого нужно получить сообщения
+    :param after: Токен курсора, после которого нужно получить сообщения
+    :return: Список сообщений и токен курсора следующей страницы в том же направлении (None, если страниц больше нет)
+    """
+    if before and after:
+        raise HTTPException(detail={'message': 'Нельзя одновременно передать before и after'}, status_code=400)
+
+    latest_page = not before and not after
+    if latest_page:
+        cached = chat_cache.latest(chat_ref.id, limit)
+        if cached is not None and await cached_tail_current(chat_ref):
+            cached_messages, has_more = cached
+            messages = [dict(message.dict(), id=document_id) for document_id, message in cached_messages]
+            return messages, encode_cursor(messages[0]['seq']) if has_more else None
+
+    query = chat_ref.collection('messages').order_by('seq', direction=ASCENDING if after else DESCENDING)
+
+    cursor_token = after or before
+    if cursor_token:
+        query = query.start_after({'seq': decode_cursor(cursor_token)})
+
+    # Лишний документ показывает, есть ли следующая страница
+    message_docs = [message_doc async for message_doc in query.limit(limit + 1).stream()]
+    has_more = len(message_docs) > limit
+    message_docs = message_docs[:limit]
+
+    messages = []
+    for message_doc in message_docs:
+        message_obj = message_doc.to_dict()
+        message_obj['id'] = message_doc.id
+        messages.append(message_obj)
+
+    next_cursor = encode_cursor(messages[-1]['seq']) if has_more else None
+
+    if not after:
+        messages.reverse()
+
+    if latest_page:
+        chat_cache.fill(chat_ref.id, [(message['id'], models.Message(**message)) for message in messages],
+                        complete=next_cursor is None)
+
+    return messages, next_cursor
+
+
+async def cached_tail_current(chat_ref) -> bool:
+    """
+    Проверяет, что в кэше чатов есть последние сообщения чата. Если конец буфера давно не сверялся с базой,
+    из базы читается последнее сообщение чата
+    :param chat_ref: Ссылка на документ чата
+    :return: True, если в базе нет сообщений новее буфера
+    """
+    if chat_cache.current(chat_ref.id):
+        return True
+    query = chat_ref.collection('messages').order_by('seq', direction=DESCENDING).limit(1)
+    stored_seq = 0
+    async for message_doc in query.stream():
+        stored_seq = message_doc.to_dict()['seq']
+    return chat_cache.confirm(chat_ref.id, stored_seq)
+
+
+async def get_chat_document(database, chat_id: str) -> Optional[dict]:
+    """
+    Получение документа чата через кэш чатов
+    :param database: Объект базы Firestore
+    :param chat_id: Идентификатор чата
+    :return: Словарь документа чата или None, если чата нет. Словарь общий с кэшем и не изменяется
+    """
+    members_version = chat_membership.version(chat_id)
+    chat_dict = chat_cache.get_chat(chat_id, members_version)
+    if chat_dict is not None:
+        return chat_dict
+
+    chat_doc = await database.collection('chats').document(chat_id).get()
+    if not chat_doc.exists:
+        return None
+
+    chat_dict = chat_doc.to_dict()
+    chat_cache.set_chat(chat_id, chat_dict, members_version)
+    return chat_dict
+
+
+class SequenceAllocator:
+    """
+    Выдает возрастающие порядковые номера сообщений в пределах чата. Последний номер чата
+    читается из базы один раз при первом обращении, дальше номера выдаются из памяти процесса.
+    Если номер уже занят сообщением, записанным другим воркером, счетчик сбрасывается через reset
+    """
+
+    def __init__(self):
+        self._last_seq: Dict[str, int] = {}
+        # Номера, выданные до сброса: при отложенной записи они могут еще не дойти до базы
+        self._floor: Dict[str, int] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    async def next(self, chat_ref) -> int:
+        """
+        Следующий порядковый номер сообщения в чате
+        :param chat_ref: Ссылка на документ чата
+        :return: Порядковый номер
+        """
+        chat_id = chat_ref.id
+
+        if chat_id not in self._last_seq:
+            lock = self._locks.setdefault(chat_id, asyncio.Lock())
+            async with lock:
+                if chat_id not in self._last_seq:
+                    last_seq = 0
+                    query = chat_ref.collection('messages').order_by('seq', direction=DESCENDING).limit(1)
+                    async for message_doc in query.stream():
+                        last_seq = message_doc.to_dict()['seq']
+                    self._last_seq[chat_id] = max(last_seq, self._floor.pop(chat_id, 0))
+            self._locks.pop(chat_id, None)
+
+        self._last_seq[chat_id] += 1
+        return self._last_seq[chat_id]
+
+    def reset(self, chat_id: str):
+        """
+        Забывает последний номер чата, следующий вызов next перечитает его из базы.
+        Уже выданные номера повторно не выдаются
+        :param chat_id: Идентификатор чата
+        """
+        if chat_id in self._last_seq:
+            self._floor[chat_id] = self._last_seq.pop(chat_id)
+
+
+sequence_allocator = SequenceAllocator()
+
+
+def message_document_id(seq: int) -> str:
+    """
+    Идентификатор документа сообщения по его номеру. Номер дополняется нулями,
+    чтобы порядок идентификаторов совпадал с порядком номеров
+    """
+    return f'{seq:012d}'
+
+
+chat_activity_writer = ChatActivityWriter(
+    DataBaseConnector().db,
+    flush_interval=config.get('chats', 'activity_flush_interval', 0.5),
+    max_pending=config.get('chats', 'activity_max_pending', 5000),
+    retry_backoff=config.get('chats', 'activity_retry_backoff', 1.0),
+    preview_length=config.get('chats', 'preview_length', 100),
+)
+
+notification_pipeline = NotificationPipeline(
+    DataBaseConnector().db,
+    websocket_manager,
+    coalesce_window=config.get('notifications', 'coalesce_window', 5.0),
+    max_pending=config.get('notifications', 'max_pending', 10000),
+    retry_backoff=config.get('notifications', 'retry_backoff', 1.0),
+    message_notifications=config.get('notifications', 'messages', True),
+)
+
+chat_cache = ChatCache(
+    length=config.get('chat_cache', 'length', 200),
+    memory_budget=config.get('chat_cache', 'memory_budget', 64 * 1024 * 1024),
+    tail_ttl=config.get('chat_cache', 'tail_ttl', 2.0),
+)
+
+# Тип сообщения шины с сообщением чата, отправленным через другой воркер
+CHAT_MESSAGE_BUS_TYPE = 'chat_message'
+# Тип сообщения шины с новым номером сообщения, сохраненного отложенной записью
+CHAT_RENUMBER_BUS_TYPE = 'chat_message_renumbered'
+
+
+def cache_sent_message(chat_id: str, chat: models.Chat, members_version: int, message: models.Message,
+                       document_id: str):
+    """
+    Добавляет отправленное сообщение в кэш чатов этого воркера и остальных воркеров
+    :param chat_id: Идентификатор чата
+    :param chat: Чат
+    :param members_version: Версия состава участников, по которой получен chat
+    :param message: Сообщение с номером
+    :param document_id: Идентификатор документа сообщения
+    """
+    chat_cache.append(chat_id, chat, members_version, message, document_id)
+    bus = websocket_manager.bus
+    if bus and bus.has_peers():
+        bus.publish_all({'type': CHAT_MESSAGE_BUS_TYPE, 'chat_id': chat_id, 'message': message.dict(),
+                         'id': document_id})
+
+
+def _on_chat_message(message: dict):
+    chat_cache.append_remote(message['chat_id'], models.Message(**message['message']), message['id'])
+
+
+def _on_chat_message_renumbered(message: dict):
+    chat_cache.renumber(message['chat_id'], message['previous_seq'], models.Message(**message['message']),
+                        message['id'])
+
+
+def _on_bus_messages_lost(message: dict):
+    chat_cache.mark_stale()
+
+
+websocket_manager.bus_handlers[CHAT_MESSAGE_BUS_TYPE] = _on_chat_message
+websocket_manager.bus_handlers[CHAT_RENUMBER_BUS_TYPE] = _on_chat_message_renumbered
+websocket_manager.bus_handlers[LOST_MESSAGE_TYPE] = _on_bus_messages_lost
+
+# Количество сообщений одного чата в ответе на переподключение и количество чатов в запросе
+RESUME_MAX_MESSAGES = config.get('replay', 'max_messages', MESSAGES_PAGE_MAX_SIZE)
+RESUME_MAX_CHATS = CHATS_PAGE_MAX_SIZE
+
+presence_service = PresenceService(
+    DataBaseConnector().db,
+    websocket_manager,
+    debounce=config.get('presence', 'debounce', 5.0),
+    away_after=config.get('presence', 'away_after', 300.0),
+    flush_interval=config.get('presence', 'flush_interval', 30.0),
+    audience_limit=config.get('presence', 'audience_limit', 5000),
+    audience_chats=config.get('presence', 'audience_chats', 200),
+    audience_ttl=config.get('presence', 'audience_ttl', 300.0),
+    audience_cache_size=config.get('presence', 'audience_cache_size', 10000),
+)
+
+message_writer = WriteBehindBuffer(
+    DataBaseConnector().db,
+    batch_size=config.get('messages', 'batch_size', 200),
+    flush_interval=config.get('messages', 'flush_interval', 0.05),
+    buffer_size=config.get('messages', 'buffer_size', 10000),
+    retry_backoff=config.get('messages', 'retry_backoff', 0.1),
+    max_retry_backoff=config.get('messages', 'max_retry_backoff', 5.0),
+    shutdown_timeout=config.get('messages', 'shutdown_timeout', 30.0),
+) if config.get('messages', 'write_behind', False) else None
+
+
+async def _create_message(chat_ref, message: models.Message):
+    while True:
+        message.seq = await sequence_allocator.next(chat_ref)
+        message_ref = chat_ref.collection('messages').document(message_document_id(message.seq))
+        try:
+            await message_ref.create(message.dict())
+            return message_ref
+        except AlreadyExists:
+            sequence_allocator.reset(chat_ref.id)
+
+
+async def save_message(chat_ref, message: models.Message):
+    """
+    Назначает сообщению следующий номер в чате и записывает его в документ с идентификатором
+    из этого номера. Создание документа не проходит, если номер уже занят сообщением другого воркера,
+    тогда номер перечитывается из базы и запись повторяется.
+    Если в секции [messages] включен write_behind, сообщение ставится в буфер отложенной записи
+    и функция возвращается сразу (или ждет места в заполненном буфере). Сообщение, номер которого
+    к моменту записи оказался занят, сохраняется под следующим свободным номером, а участники чата,
+    кэш чатов и метаданные чатов узнают новый номер (_message_renumbered)
+    :param chat_ref: Ссылка на документ чата
+    :param message: Сообщение, поле seq заполняется
+    :return: Ссылка на документ сообщения
+    """
+    if message_writer is None:
+        return await _create_message(chat_ref, message)
+
+    message.seq = await sequence_allocator.next(chat_ref)
+    message_ref = chat_ref.collection('messages').document(message_document_id(message.seq))
+
+    async def renumber():
+        # Чат читается до записи: при ошибке запись повторяется целиком, и сообщение не сохраняется дважды
+        chat_dict = await get_chat_document(DataBaseConnector().db, chat_ref.id)
+        sequence_allocator.reset(chat_ref.id)
+        renumbered = message.copy()
+        renumbered_ref = await _create_message(chat_ref, renumbered)
+        if chat_dict is not None:
+            _message_renumbered(chat_ref.id, models.Chat(**chat_dict), message.seq, renumbered, renumbered_ref.id)
+
+    await message_writer.put(message_ref, message.dict(), on_conflict=renumber)
+    return message_ref
+
+
+def _message_renumbered(chat_id: str, chat: models.Chat, previous_seq: int, message: models.Message,
+                        document_id: str):
+    """
+    Сообщает о новом номере сообщения участникам чата, кэшу чатов всех воркеров и метаданным чатов
+    """
+    chat_cache.renumber(chat_id, previous_seq, message, document_id)
+    bus = websocket_manager.bus
+    if bus and bus.has_peers():
+        bus.publish_all({'type': CHAT_RENUMBER_BUS_TYPE, 'chat_id': chat_id, 'previous_seq': previous_seq,
+                         'message': message.dict(), 'id': document_id})
+    chat_activity_writer.message_renumbered(chat, previous_seq, message)
+    websocket_manager.broadcast(chat.members, models.EncodedFrame(models.ResponseMessage(
+        message=models.WebSocketMessage(type=models.MessageType.RENUMBER,
+                                        content=models.Renumber(previous_seq=previous_seq, message=message)),
+        chat_id=chat_id,
+    ).dict()))
+
+
+class ChatMembership:
+    """
+    Версии состава участников чатов в процессе. Сессии WebSocket хранят участников чата у себя
+    и перечитывают документ чата, только когда версия его состава изменилась
+    """
+
+    def __init__(self):
+        self._versions: Dict[str, int] = {}
+
+    def version(self, chat_id: str) -> int:
+        return self._versions.get(chat_id, 0)
+
+    def changed(self, chat_id: str):
+        """
+        Отмечает изменение состава чата. Вызывается при любой записи поля members
+        :param chat_id: Идентификатор чата
+        """
+        self._versions[chat_id] = self.version(chat_id) + 1
+
+
+chat_membership = ChatMembership()
+
+
+async def resume_chats(database, login: str, chats: Dict[str, int]) -> List[dict]:
+    """
+    Пропущенные пользователем сообщения чатов после переподключения. Сообщения берутся
+    из кэша чатов (chat_cache), а из базы читаются, только если в кэше есть не все: в буфере пропуск
+    или в базе есть сообщения новее буфера (cached_tail_current). Участники чатов, которых нет в буфере, читаются одним get_all.
+    Чаты, которых нет или в которых пользователь не состоит, пропускаются
+    :param database: Объект базы Firestore
+    :param login: Логин пользователя
+    :param chats: Словарь {идентификатор чата: номер последнего полученного сообщения}
+    :return: Кадры MessageType.RESUME, по одному на чат
+    """
+    if len(chats) > RESUME_MAX_CHATS:
+        raise HTTPException(detail={'message': f"Не больше {RESUME_MAX_CHATS} чатов за запрос"}, status_code=400)
+
+    chats_collection = database.collection('chats')
+    members = {chat_id: chat_cache.members(chat_id, chat_membership.version(chat_id)) for chat_id in chats}
+    unknown = [chat_id for chat_id, chat_members in members.items() if chat_members is None]
+    if unknown:
+        chat_dicts = await document_loader(database).load_many([chats_collection.document(chat_id)
+                                                                for chat_id in unknown])
+        for chat_id, chat_dict in zip(unknown, chat_dicts):
+            members[chat_id] = frozenset(chat_dict['members']) if chat_dict else frozenset()
+            if chat_dict:
+                chat_cache.set_chat(chat_id, chat_dict, chat_membership.version(chat_id))
+
+    async def replay(chat_id: str, after_seq: int) -> dict:
+        chat_ref = chats_collection.document(chat_id)
+        messages = chat_cache.since(chat_id, after_seq)
+        truncated = False
+        if messages is None or not await cached_tail_current(chat_ref):
+            # Из базы читаются все пропущенные сообщения или только новее последнего в буфере
+            messages = messages or []
+            last_seq = messages[-1].seq if messages else after_seq
+            stored, next_cursor = await get_chat_messages(chat_ref, RESUME_MAX_MESSAGES,
+                                                          after=encode_cursor(last_seq))
+            messages = messages + [models.Message(**message) for message in stored]
+            truncated = next_cursor is not None
+        if len(messages) > RESUME_MAX_MESSAGES:
+            messages = messages[:RESUME_MAX_MESSAGES]
+            truncated = True
+        last_seq = messages[-1].seq if messages else after_seq
+        return models.ResponseMessage(
+            message=models.WebSocketMessage(
+                type=models.MessageType.RESUME,
+                content=models.Resume(chats={chat_id: last_seq}, messages=messages, truncated=truncated),
+            ),
+            chat_id=chat_id,
+        ).dict()
+
+    return list(await asyncio.gather(*(replay(chat_id, after_seq) for chat_id, after_seq in chats.items()
+                                       if login in members[chat_id])))
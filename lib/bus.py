@@ -0,0 +1,362 @@
+"""
+Шина сообщений между процессами-воркерами.
+
+Каждый воркер держит соединения WebSocket только своих пользователей. Шина доставляет кадры
+воркеру, к которому подключен получатель, а реестр присутствия хранит соответствие
+логин -> воркер. Реализации:
+- LocalBus - один процесс, доставка только локальным соединениям;
+- UnixSocketBus - воркеры одного хоста, каждый слушает Unix-сокет в общем каталоге socket_dir.
+Реализация выбирается параметром backend в секции [bus] файла настроек.
+
+Сообщения к каждому воркеру нумеруются подряд, включая отброшенные при переполнении очереди.
+Получатель, заметивший пропуск в номерах, передает обработчику сообщение {'type': LOST_MESSAGE_TYPE,
+'count': количество потерянных}: подсистемы, которые держат копии данных других воркеров, по нему
+перестают доверять своим копиям.
+"""
+import asyncio
+import glob
+import logging
+import os
+import struct
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+import orjson
+
+log = logging.getLogger('bus')
+
+FRAME_HEADER = struct.Struct('>I')
+
+# Размер очереди исходящих сообщений к одному воркеру
+PEER_QUEUE_SIZE = 10000
+
+# Тип сообщения, которое получает обработчик, когда сообщения другого воркера потерялись
+LOST_MESSAGE_TYPE = 'lost'
+
+Handler = Callable[[dict], Optional[Awaitable[None]]]
+
+
+class PresenceRegistry:
+    """
+    Соответствие логинов пользователей воркерам, к которым они подключены
+    """
+
+    def __init__(self):
+        self._workers: Dict[str, str] = {}
+
+    def get(self, login: str) -> Optional[str]:
+        return self._workers.get(login)
+
+    def set(self, login: str, worker_id: str):
+        self._workers[login] = worker_id
+
+    def remove(self, login: str, worker_id: str):
+        """
+        Удаляет запись, только если пользователь все еще числится за этим воркером
+        """
+        if self._workers.get(login) == worker_id:
+            del self._workers[login]
+
+    def remove_worker(self, worker_id: str):
+        for login in self.logins_of(worker_id):
+            del self._workers[login]
+
+    def logins_of(self, worker_id: str) -> List[str]:
+        return [login for login, worker in self._workers.items() if worker == worker_id]
+
+    def __len__(self):
+        return len(self._workers)
+
+
+class MessageBus:
+    """
+    Интерфейс шины. Методы публикации не ждут отправки: сообщения ставятся в очередь
+    """
+
+    def __init__(self, worker_id: str):
+        self.worker_id = worker_id
+        self.presence = PresenceRegistry()
+        self.published = 0
+        self.received = 0
+        self.dropped = 0
+        self.lost = 0
+
+    async def start(self, handler: Handler):
+        raise NotImplementedError
+
+    async def stop(self):
+        raise NotImplementedError
+
+    def publish(self, worker_id: str, message: dict):
+        """
+        Отправляет сообщение конкретному воркеру
+        """
+        raise NotImplementedError
+
+    def publish_all(self, message: dict):
+        """
+        Отправляет сообщение всем остальным воркерам
+        """
+        raise NotImplementedError
+
+    def announce(self, login: str, online: bool):
+        """
+        Сообщает остальным воркерам о подключении или отключении пользователя
+        """
+        raise NotImplementedError
+
+    def has_peers(self) -> bool:
+        """
+        Есть ли другие воркеры
+        """
+        raise NotImplementedError
+
+    def route(self, logins: Iterable[str]) -> Dict[str, List[str]]:
+        """
+        Группирует логины по удаленным воркерам, к которым подключены пользователи
+        :param logins: Логины получателей, не подключенных к текущему воркеру
+        :return: Словарь воркер -> список логинов
+        """
+        routes: Dict[str, List[str]] = {}
+        for login in logins:
+            worker_id = self.presence.get(login)
+            if worker_id and worker_id != self.worker_id:
+                routes.setdefault(worker_id, []).append(login)
+        return routes
+
+    def stats(self) -> dict:
+        return {
+            'backend': type(self).__name__,
+            'worker_id': self.worker_id,
+            'known_logins': len(self.presence),
+            'published': self.published,
+            'received': self.received,
+            'dropped': self.dropped,
+            'lost': self.lost,
+        }
+
+
+class LocalBus(MessageBus):
+    """
+    Шина для одного процесса: других воркеров нет, поэтому публиковать некуда
+    """
+
+    def __init__(self):
+        super().__init__(f'local-{os.getpid()}')
+
+    async def start(self, handler: Handler):
+        pass
+
+    async def stop(self):
+        pass
+
+    def publish(self, worker_id: str, message: dict):
+        self.dropped += 1
+
+    def publish_all(self, message: dict):
+        pass
+
+    def has_peers(self) -> bool:
+        return False
+
+    def announce(self, login: str, online: bool):
+        if online:
+            self.presence.set(login, self.worker_id)
+        else:
+            self.presence.remove(login, self.worker_id)
+
+
+class _Peer:
+    """
+    Исходящее соединение к другому воркеру с собственной очередью и задачей-писателем
+    """
+
+    def __init__(self, bus: 'UnixSocketBus', worker_id: str):
+        self.bus = bus
+        self.worker_id = worker_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=PEER_QUEUE_SIZE)
+        self.task = asyncio.ensure_future(self._write())
+
+    async def _write(self):
+        try:
+            _, writer = await asyncio.open_unix_connection(self.bus.socket_path(self.worker_id))
+        except OSError:
+            self.bus.forget_peer(self.worker_id)
+            return
+        try:
+            while True:
+                number, message = await self.queue.get()
+                payload = orjson.dumps({**message, 'sender': self.bus.worker_id, 'number': number})
+                writer.write(FRAME_HEADER.pack(len(payload)) + payload)
+                await writer.drain()
+        except (OSError, ConnectionError):
+            self.bus.forget_peer(self.worker_id)
+        finally:
+            writer.close()
+
+    def send(self, number: int, message: dict) -> bool:
+        try:
+            self.queue.put_nowait((number, message))
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def close(self):
+        self.task.cancel()
+
+
+class UnixSocketBus(MessageBus):
+    """
+    Шина между воркерами одного хоста через Unix-сокеты. Воркер слушает сокет
+    socket_dir/<worker_id>.sock, других воркеров находит по файлам сокетов в каталоге,
+    а о подключениях пользователей рассылает сообщения online/offline всем воркерам
+    """
+
+    def __init__(self, socket_dir: str):
+        super().__init__(f'w{os.getpid()}')
+        self.socket_dir = socket_dir
+        self._server = None
+        self._handler: Optional[Handler] = None
+        self._peers: Dict[str, _Peer] = {}
+        self._known_peers: Set[str] = set()
+        # Номер последнего сообщения, отправленного каждому воркеру и полученного от каждого воркера.
+        # Номера не сбрасываются при переподключении, поэтому сообщения из очереди оборванного
+        # соединения тоже видны получателю как пропуск
+        self._sent_numbers: Dict[str, int] = {}
+        self._received_numbers: Dict[str, int] = {}
+
+    def socket_path(self, worker_id: str) -> str:
+        return os.path.join(self.socket_dir, f'{worker_id}.sock')
+
+    async def start(self, handler: Handler):
+        self._handler = handler
+        os.makedirs(self.socket_dir, exist_ok=True)
+        path = self.socket_path(self.worker_id)
+        if os.path.exists(path):
+            os.unlink(path)
+        self._server = await asyncio.start_unix_server(self._serve, path=path)
+
+        for peer_path in glob.glob(os.path.join(self.socket_dir, '*.sock')):
+            worker_id = os.path.basename(peer_path)[:-len('.sock')]
+            if worker_id != self.worker_id:
+                self._known_peers.add(worker_id)
+                self.publish(worker_id, {'type': 'hello', 'worker': self.worker_id})
+
+    async def stop(self):
+        for worker_id in list(self._known_peers):
+            self.publish(worker_id, {'type': 'bye', 'worker': self.worker_id})
+        # Даем писателям отправить прощальные сообщения
+        await asyncio.sleep(0.05)
+        for peer in self._peers.values():
+            peer.close()
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        path = self.socket_path(self.worker_id)
+        if os.path.exists(path):
+            os.unlink(path)
+
+    def forget_peer(self, worker_id: str):
+        peer = self._peers.pop(worker_id, None)
+        if peer:
+            peer.close()
+        self._known_peers.discard(worker_id)
+        self.presence.remove_worker(worker_id)
+
+    def publish(self, worker_id: str, message: dict):
+        peer = self._peers.get(worker_id)
+        if peer is None:
+            peer = self._peers[worker_id] = _Peer(self, worker_id)
+        number = self._sent_numbers[worker_id] = self._sent_numbers.get(worker_id, 0) + 1
+        if peer.send(number, message):
+            self.published += 1
+        else:
+            self.dropped += 1
+
+    def publish_all(self, message: dict):
+        for worker_id in list(self._known_peers):
+            self.publish(worker_id, message)
+
+    def has_peers(self) -> bool:
+        return bool(self._known_peers)
+
+    def announce(self, login: str, online: bool):
+        if online:
+            self.presence.set(login, self.worker_id)
+        else:
+            self.presence.remove(login, self.worker_id)
+        self.publish_all({'type': 'online' if online else 'offline', 'login': login, 'worker': self.worker_id})
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                header = await reader.readexactly(FRAME_HEADER.size)
+                payload = await reader.readexactly(FRAME_HEADER.unpack(header)[0])
+                self.received += 1
+                message = orjson.loads(payload)
+                await self._check_number(message.pop('sender', None), message.pop('number', None))
+                await self._dispatch(message)
+        except (asyncio.IncompleteReadError, asyncio.CancelledError):
+            # Воркер-отправитель отключился или текущий воркер останавливается
+            pass
+        except Exception:
+            log.exception('Ошибка обработки сообщения шины')
+        finally:
+            writer.close()
+
+    async def _check_number(self, worker_id: Optional[str], number: Optional[int]):
+        if worker_id is None or number is None:
+            return
+        missed = number - self._received_numbers.get(worker_id, 0) - 1
+        self._received_numbers[worker_id] = number
+        # Меньший номер бывает у воркера, перезапущенного с тем же идентификатором
+        if missed > 0:
+            self.lost += missed
+            if self._handler:
+                result = self._handler({'type': LOST_MESSAGE_TYPE, 'worker': worker_id, 'count': missed})
+                if asyncio.iscoroutine(result):
+                    await result
+
+    async def _dispatch(self, message: dict):
+        message_type = message.get('type')
+        worker_id = message.get('worker')
+
+        if message_type == 'hello':
+            self._known_peers.add(worker_id)
+            self.publish(worker_id, {
+                'type': 'snapshot',
+                'worker': self.worker_id,
+                'logins': self.presence.logins_of(self.worker_id),
+            })
+        elif message_type == 'snapshot':
+            self._known_peers.add(worker_id)
+            for login in message['logins']:
+                self.presence.set(login, worker_id)
+        elif message_type == 'online':
+            self.presence.set(message['login'], worker_id)
+        elif message_type == 'offline':
+            self.presence.remove(message['login'], worker_id)
+        elif message_type == 'bye':
+            self.forget_peer(worker_id)
+        elif self._handler:
+            result = self._handler(message)
+            if asyncio.iscoroutine(result):
+                await result
+
+    def stats(self) -> dict:
+        result = super().stats()
+        result['peers'] = sorted(self._known_peers)
+        return result
+
+
+def create_bus(config) -> MessageBus:
+    """
+    Создает шину по параметрам секции [bus] файла настроек
+    :param config: Объект конфигурации
+    :return: Экземпляр шины
+    """
+    backend = config.get('bus', 'backend', 'local')
+    if backend == 'unix':
+        return UnixSocketBus(config.get('bus', 'socket_dir', '/tmp/messenger-bus'))
+    if backend != 'local':
+        raise ValueError(f'Неизвестная шина {backend}')
+    return LocalBus()
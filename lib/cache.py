@@ -0,0 +1,108 @@
+import time
+
+from cachetools import TLRUCache, TTLCache
+from typing import Any, Dict, Hashable, Optional
+
+
+class CacheRegistry:
+    """
+    Реестр кэшей процесса для выдачи статистики
+    """
+
+    def __init__(self):
+        self._caches: Dict[str, 'TTLLRUCache'] = {}
+
+    def register(self, cache: 'TTLLRUCache'):
+        self._caches[cache.name] = cache
+
+    def stats(self) -> Dict[str, dict]:
+        return {name: cache.stats() for name, cache in self._caches.items()}
+
+
+registry = CacheRegistry()
+
+
+class TTLLRUCache:
+    """
+    Кэш с ограничением количества записей (вытесняются давно не использованные)
+    и временем жизни записей, считающий попадания и промахи.
+    Значения - словари документов, наружу отдаются их копии
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self._data = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        registry.register(self)
+
+    def get(self, key: Hashable) -> Optional[Dict[str, Any]]:
+        """
+        Получение записи из кэша
+        :param key: Ключ записи
+        :return: Копия значения или None, если записи нет или срок ее жизни истек
+        """
+        value = self._data.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return dict(value)
+
+    def set(self, key: Hashable, value: Dict[str, Any]):
+        self._data[key] = dict(value)
+
+    def invalidate(self, key: Hashable):
+        """
+        Удаляет запись, например после изменения документа в базе
+        :param key: Ключ записи
+        """
+        if self._data.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'max_size': self._data.maxsize,
+            'ttl': getattr(self._data, 'ttl', None),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / requests, 4) if requests else None,
+            'invalidations': self.invalidations,
+        }
+
+
+class ExpiringLRUCache(TTLLRUCache):
+    """
+    Кэш, в котором у каждой записи свой срок жизни - момент времени (секунды от начала эпохи),
+    после которого запись перестает отдаваться. При переполнении вытесняются давно не использованные
+    """
+
+    def __init__(self, name: str, maxsize: int):
+        self.name = name
+        self._data = TLRUCache(maxsize=maxsize, ttu=lambda key, value, now: value[0], timer=time.time)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        registry.register(self)
+
+    def get(self, key: Hashable) -> Optional[Dict[str, Any]]:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return dict(item[1])
+
+    def set(self, key: Hashable, value: Dict[str, Any], expires_at: float = 0):
+        """
+        :param key: Ключ записи
+        :param value: Значение
+        :param expires_at: Момент истечения срока жизни записи в секундах от начала эпохи
+        """
+        self._data[key] = (expires_at, dict(value))
@@ -0,0 +1,213 @@
+"""
+Счетчики непрочитанных сообщений, время последней активности и последнее сообщение
+в метаданных чатов участников.
+
+Метаданные чата хранятся у каждого участника в users/{login}/chats/{id}. Каждое сообщение
+увеличивает unread у всех участников кроме отправителя, сдвигает last_activity_at и заменяет
+last_message - отправителя, начало текста и время сообщения, чтобы список чатов показывался
+одним запросом без чтения истории каждого чата.
+Запись при каждом сообщении умножала бы его стоимость на число участников, поэтому изменения
+накапливаются в памяти и отправляются пакетами раз в flush_interval секунд: десять сообщений
+за это время превращаются в одно обновление документа каждого участника с Increment(10).
+Отметка о прочтении сбрасывает накопленное увеличение, записывает unread = 0 и время отметки read_at.
+Увеличение, накопленное другим воркером до отметки, может быть записано уже после нее и вернуть
+счетчик. Поэтому непрочитанные считаются по unread_count: если после отметки в чате не было
+сообщений, непрочитанных нет. Если после отметки пришло новое сообщение, такое запоздавшее
+увеличение остается в счетчике до следующей отметки.
+Счетчик изменяется через Increment, а время - через Maximum, поэтому записи разных воркеров
+не перетирают друг друга. Последнее сообщение записывается целиком: если сообщения одного чата
+одновременно приходят на разные воркеры, до следующего сообщения в нем может остаться предыдущее.
+"""
+import logging
+from typing import Any, Dict, List, Optional
+
+from database import MAX_BATCH_WRITES, Increment, Maximum, NotFound
+from database.models import Chat, Message, MessagePreview, timestamp_ms
+from lib.coalescing import CoalescingWriter
+
+PREVIEW_ELLIPSIS = '…'
+
+
+def message_preview(message: Message, length: int) -> MessagePreview:
+    """
+    Последнее сообщение для метаданных чата: текст обрезается до length символов
+    """
+    content = message.content
+    if len(content) > length:
+        content = content[:length - len(PREVIEW_ELLIPSIS)].rstrip() + PREVIEW_ELLIPSIS
+    return MessagePreview(creator_login=message.creator_login, content=content,
+                          created_at=message.created_at, seq=message.seq)
+
+
+def unread_count(meta: dict) -> int:
+    """
+    Количество непрочитанных сообщений по документу метаданных чата: счетчик не учитывается,
+    если последнее сообщение пришло не позже отметки о прочтении
+    :param meta: Документ метаданных чата участника
+    """
+    read_at = meta.get('read_at')
+    last_activity_at = meta.get('last_activity_at')
+    if read_at is not None and last_activity_at is not None and last_activity_at <= read_at:
+        return 0
+    return meta.get('unread', 0)
+
+
+def meta_document_id(chat: Chat, member_login: str) -> str:
+    """
+    Идентификатор документа метаданных чата у участника: у диалога - логин собеседника,
+    у группового чата - его название
+    :param chat: Чат
+    :param member_login: Логин участника
+    """
+    if chat.chat_name:
+        return chat.chat_name
+    return next((login for login in chat.members if login != member_login), member_login)
+
+
+class PendingActivity:
+    """
+    Накопленные изменения метаданных чата одного участника
+    """
+    __slots__ = ('reference', 'unread', 'reset', 'read_at', 'last_activity_at', 'last_message')
+
+    def __init__(self, reference):
+        self.reference = reference
+        self.unread = 0
+        self.reset = False
+        self.read_at: Optional[int] = None
+        self.last_activity_at: Optional[int] = None
+        self.last_message: Optional[MessagePreview] = None
+
+    def set_last_message(self, preview: MessagePreview):
+        if self.last_message is None or preview.created_at >= self.last_message.created_at:
+            self.last_message = preview
+
+    def merge_older(self, older: 'PendingActivity'):
+        """
+        Добавляет изменения, накопленные раньше этих, например после неудачной записи
+        """
+        if not self.reset:
+            self.unread += older.unread
+            self.reset = older.reset
+        if older.read_at is not None:
+            self.read_at = max(self.read_at or 0, older.read_at)
+        if older.last_activity_at is not None:
+            self.last_activity_at = max(self.last_activity_at or 0, older.last_activity_at)
+        if older.last_message is not None:
+            self.set_last_message(older.last_message)
+
+    def fields(self) -> Dict[str, Any]:
+        fields = {}
+        if self.reset:
+            fields['unread'] = self.unread
+        elif self.unread:
+            fields['unread'] = Increment(self.unread)
+        if self.read_at is not None:
+            fields['read_at'] = Maximum(self.read_at)
+        if self.last_activity_at is not None:
+            fields['last_activity_at'] = Maximum(self.last_activity_at)
+        if self.last_message is not None:
+            fields['last_message'] = self.last_message.dict()
+        return fields
+
+
+class ChatActivityWriter(CoalescingWriter):
+    """
+    Накопитель изменений метаданных чатов с отложенной пакетной записью (lib.coalescing)
+    :param database: Клиент базы
+    :param flush_interval: Через сколько секунд после первого изменения накопленное отправляется в базу
+    :param max_pending: Количество документов, при котором запись начинается не дожидаясь интервала
+    :param retry_backoff: Задержка повторной записи после ошибки
+    :param preview_length: Количество символов текста в последнем сообщении
+    """
+
+    log = logging.getLogger('chat_activity')
+
+    def __init__(self, database, flush_interval: float = 0.5, max_pending: int = 5000,
+                 retry_backoff: float = 1.0, preview_length: int = 100):
+        super().__init__(flush_interval, max_pending, retry_backoff)
+        self.database = database
+        self.preview_length = preview_length
+
+    def _entry(self, member_login: str, meta_id: str) -> PendingActivity:
+        reference = self.database.collection('users').document(member_login).collection('chats').document(meta_id)
+        entry = self._pending.get(reference.path)
+        if entry is None:
+            entry = self._pending[reference.path] = PendingActivity(reference)
+        return entry
+
+    def message_sent(self, chat: Chat, message: Message):
+        """
+        Учитывает новое сообщение: непрочитанное у всех участников кроме отправителя
+        и последнее сообщение чата у всех
+        :param chat: Чат сообщения
+        :param message: Сообщение с номером и временем
+        """
+        self.events += 1
+        preview = message_preview(message, self.preview_length)
+        for member_login in chat.members:
+            entry = self._entry(member_login, meta_document_id(chat, member_login))
+            if member_login != message.creator_login:
+                entry.unread += 1
+            entry.last_activity_at = max(entry.last_activity_at or 0, message.created_at)
+            entry.set_last_message(preview)
+        self._schedule()
+
+    def message_renumbered(self, chat: Chat, previous_seq: int, message: Message):
+        """
+        Исправляет номер в еще не записанном последнем сообщении, если сообщение сохранено под другим номером.
+        Непрочитанные уже учтены при отправке
+        :param chat: Чат сообщения
+        :param previous_seq: Номер, под которым сообщение было разослано
+        :param message: Сообщение с номером, под которым оно записано
+        """
+        preview = message_preview(message, self.preview_length)
+        for member_login in chat.members:
+            entry = self._pending.get(self.database.collection('users').document(member_login)
+                                      .collection('chats').document(meta_document_id(chat, member_login)).path)
+            last_message = entry.last_message if entry is not None else None
+            if last_message is not None and last_message.seq == previous_seq \
+                    and (last_message.creator_login, last_message.created_at) == (message.creator_login, message.created_at):
+                entry.last_message = preview
+
+    def mark_read(self, chat: Chat, member_login: str):
+        """
+        Отмечает все сообщения чата прочитанными участником
+        :param chat: Чат
+        :param member_login: Логин участника
+        """
+        self.events += 1
+        entry = self._entry(member_login, meta_document_id(chat, member_login))
+        entry.unread = 0
+        entry.reset = True
+        entry.read_at = timestamp_ms()
+        self._schedule()
+
+    async def _write(self, pending: Dict[str, PendingActivity]):
+        entries = list(pending.values())
+        for start in range(0, len(entries), MAX_BATCH_WRITES):
+            await self._commit(entries[start:start + MAX_BATCH_WRITES], pending)
+
+    async def _commit(self, entries: List[PendingActivity], pending: Dict[str, PendingActivity]):
+        """
+        Записывает пакет изменений и убирает записанные из pending
+        """
+        batch = self.database.batch()
+        for entry in entries:
+            batch.update(entry.reference, entry.fields())
+        try:
+            await batch.commit()
+            self.batches += 1
+            self.written += len(entries)
+        except NotFound:
+            # У кого-то из участников нет метаданных чата: остальные записываются по одному
+            for entry in entries:
+                try:
+                    await entry.reference.update(entry.fields())
+                    self.written += 1
+                except NotFound:
+                    self.missing += 1
+                pending.pop(entry.reference.path)
+            return
+        for entry in entries:
+            pending.pop(entry.reference.path)
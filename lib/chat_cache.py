@@ -0,0 +1,345 @@
+"""
+Кэш популярных чатов: документ чата и его последние сообщения в памяти воркера.
+
+Для каждого чата хранится документ чата, названия диалога у его участников и кольцевой буфер
+из последних length сообщений вместе с идентификаторами их документов: у сообщений, перенесенных
+из старой схемы, идентификатор не совпадает с номером. Буфер пополняется при отправке сообщения (запись через кэш)
+и при чтении последней страницы истории из базы. Поэтому открытие популярного чата
+(GET /chats/{chat_id}) и досылка пропущенного после переподключения (lib.resume_chats) обходятся
+без обращения к базе. Документ чата после создания не изменяется и хранится без срока жизни.
+Размер кэша ограничен оценкой занимаемой памяти memory_budget, при превышении вытесняются
+давно не использованные чаты.
+При нескольких воркерах отправленное сообщение рассылается остальным через шину и добавляется
+в их кэш, если чат там есть. Сообщение шины теряется при переполнении очереди, поэтому
+кэш проверяет, что номера сообщений идут без пропусков. Пропажу последних сообщений чата
+так не заметить, а с другого хоста сообщения не приходят вовсе, поэтому конец буфера считается
+актуальным не дольше tail_ttl секунд после сверки с базой (current). Потом перед выдачей
+буфера номер последнего сообщения сверяется с базой чтением одного документа (confirm).
+Если шина сообщила о потерянных сообщениях (mark_stale), сверка нужна для всех чатов сразу.
+"""
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from database.models import Chat, Message
+
+# Оценка памяти на объект сообщения и на документ чата без учета строк
+MESSAGE_OVERHEAD = 400
+CHAT_OVERHEAD = 1000
+
+
+def _message_size(message: Message) -> int:
+    return MESSAGE_OVERHEAD + len(message.content) + len(message.creator_login)
+
+
+def _contiguous(messages: Iterable[Message], first_seq: int) -> bool:
+    return all(message.seq == seq for seq, message in enumerate(messages, start=first_seq))
+
+
+class CachedChat:
+    """
+    Документ чата и последние сообщения, упорядоченные по номерам.
+    ids - идентификаторы документов сообщений буфера по номерам,
+    complete - в буфере есть самое первое сообщение чата,
+    checked_at - время (time.monotonic) последней сверки конца буфера с базой
+    """
+    __slots__ = ('chat', 'messages', 'ids', 'complete', 'checked_at', 'members', 'members_version',
+                 'dialog_names', 'size')
+
+    def __init__(self, length: int):
+        self.chat: Optional[dict] = None
+        self.messages: Deque[Message] = deque(maxlen=length)
+        self.ids: Dict[int, str] = {}
+        self.complete = False
+        self.checked_at: Optional[float] = None
+        self.members: FrozenSet[str] = frozenset()
+        self.members_version = None
+        self.dialog_names: Dict[str, str] = {}
+        self.size = CHAT_OVERHEAD
+
+    def set_chat(self, chat: dict, members_version: int):
+        members = frozenset(chat['members'])
+        self.size += sum(len(login) for login in members) - sum(len(login) for login in self.members)
+        self.chat = chat
+        self.members = members
+        self.members_version = members_version
+
+    def add(self, message: Message, document_id: str):
+        messages = self.messages
+        if not messages or message.seq > messages[-1].seq:
+            if len(messages) == messages.maxlen:
+                self.size -= _message_size(messages[0])
+                del self.ids[messages[0].seq]
+                self.complete = False
+            messages.append(message)
+            self.ids[message.seq] = document_id
+            self.size += _message_size(message)
+            return
+        # Сообщения одного чата, сохраненные одновременно, могут прийти не по порядку номеров
+        if message.seq in self.ids:
+            return
+        self._replace(sorted([*messages, message], key=lambda stored: stored.seq),
+                      {**self.ids, message.seq: document_id})
+
+    def remove(self, seq: int, message: Message):
+        """
+        Убирает сообщение с номером seq, если под этим номером хранится именно это сообщение
+        """
+        ordered = [stored for stored in self.messages if stored.seq != seq
+                   or (stored.creator_login, stored.created_at) != (message.creator_login, message.created_at)]
+        if len(ordered) != len(self.messages):
+            self._replace(ordered, self.ids)
+
+    def _replace(self, ordered: List[Message], ids: Dict[int, str]):
+        if len(ordered) > self.messages.maxlen:
+            ordered = ordered[-self.messages.maxlen:]
+            self.complete = False
+        self.size += sum(_message_size(message) for message in ordered) \
+            - sum(_message_size(message) for message in self.messages)
+        self.messages.clear()
+        self.messages.extend(ordered)
+        self.ids = {message.seq: ids[message.seq] for message in ordered}
+
+
+class ChatCache:
+    """
+    Кэш чатов с вытеснением давно не использованных по объему памяти
+    :param length: Количество последних сообщений одного чата
+    :param memory_budget: Оценка памяти на весь кэш в байтах
+    :param tail_ttl: Сколько секунд конец буфера считается актуальным после сверки с базой
+    """
+
+    def __init__(self, length: int = 200, memory_budget: int = 64 * 1024 * 1024, tail_ttl: float = 2.0):
+        self.length = length
+        self.memory_budget = memory_budget
+        self.tail_ttl = tail_ttl
+        # Сверки раньше этого времени не в счет: после них терялись сообщения шины
+        self._stale_before = float('-inf')
+        self._chats: 'OrderedDict[str, CachedChat]' = OrderedDict()
+        self.size = 0
+
+        self.appended = 0
+        self.evicted = 0
+        self.open_hits = 0
+        self.open_misses = 0
+        self.replay_hits = 0
+        self.replay_misses = 0
+        self.tail_checks = 0
+        self.stale_tails = 0
+
+    def _entry(self, chat_id: str, create: bool = False) -> Optional[CachedChat]:
+        entry = self._chats.get(chat_id)
+        if entry is not None:
+            self._chats.move_to_end(chat_id)
+        elif create:
+            entry = self._chats[chat_id] = CachedChat(self.length)
+            self.size += entry.size
+        return entry
+
+    def _update(self, entry: CachedChat, previous_size: int):
+        self.size += entry.size - previous_size
+        # Текущий чат последний в порядке использования и вытесняется только если он один больше бюджета
+        while self.size > self.memory_budget and len(self._chats) > 1:
+            _, evicted = self._chats.popitem(last=False)
+            self.size -= evicted.size
+            self.evicted += 1
+
+    def append(self, chat_id: str, chat: Chat, members_version: int, message: Message, document_id: str):
+        """
+        Добавляет отправленное через этот воркер сообщение
+        :param chat_id: Идентификатор чата
+        :param chat: Чат
+        :param members_version: Версия состава участников (lib.chat_membership)
+        :param message: Сообщение с номером
+        :param document_id: Идентификатор документа сообщения
+        """
+        entry = self._entry(chat_id, create=True)
+        previous_size = entry.size
+        if entry.chat is None or entry.members_version != members_version:
+            entry.set_chat(chat.dict(), members_version)
+        entry.add(message, document_id)
+        self.appended += 1
+        self._update(entry, previous_size)
+
+    def append_remote(self, chat_id: str, message: Message, document_id: str):
+        """
+        Добавляет сообщение, отправленное через другой воркер, если чат есть в кэше
+        """
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            return
+        previous_size = entry.size
+        entry.add(message, document_id)
+        self.appended += 1
+        self._update(entry, previous_size)
+
+    def renumber(self, chat_id: str, previous_seq: int, message: Message, document_id: str):
+        """
+        Переносит сообщение, разосланное под номером previous_seq, на номер, под которым оно записано.
+        Чужое сообщение с номером previous_seq попадает в буфер при следующем чтении из базы,
+        до этого пропуск в номерах не дает отдавать буфер
+        """
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            return
+        previous_size = entry.size
+        entry.remove(previous_seq, message)
+        entry.add(message, document_id)
+        self._update(entry, previous_size)
+
+    def get_chat(self, chat_id: str, members_version: int) -> Optional[dict]:
+        """
+        Документ чата, если состав участников не менялся с момента, когда он попал в кэш
+        """
+        entry = self._entry(chat_id)
+        if entry is None or entry.members_version != members_version:
+            return None
+        return entry.chat
+
+    def set_chat(self, chat_id: str, chat: dict, members_version: int):
+        entry = self._entry(chat_id, create=True)
+        previous_size = entry.size
+        entry.set_chat(chat, members_version)
+        self._update(entry, previous_size)
+
+    def members(self, chat_id: str, members_version: int) -> Optional[FrozenSet[str]]:
+        """
+        Участники чата, если состав не менялся с момента, когда документ чата попал в кэш
+        """
+        entry = self._chats.get(chat_id)
+        if entry is None or entry.chat is None or entry.members_version != members_version:
+            return None
+        return entry.members
+
+    def dialog_name(self, chat_id: str, login: str) -> Optional[str]:
+        entry = self._chats.get(chat_id)
+        return entry.dialog_names.get(login) if entry is not None else None
+
+    def set_dialog_name(self, chat_id: str, login: str, name: str):
+        entry = self._chats.get(chat_id)
+        if entry is not None:
+            previous_size = entry.size
+            entry.dialog_names[login] = name
+            entry.size += len(login) + len(name)
+            self._update(entry, previous_size)
+
+    def fill(self, chat_id: str, documents: List[Tuple[str, Message]], complete: bool):
+        """
+        Добавляет последнюю страницу истории, прочитанную из базы
+        :param chat_id: Идентификатор чата
+        :param documents: Идентификаторы документов и сообщения страницы в хронологическом порядке
+        :param complete: Страница начинается с первого сообщения чата
+        """
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            return
+        previous_size = entry.size
+        messages = [message for _, message in documents]
+        ids = {**entry.ids, **{message.seq: document_id for document_id, message in documents}}
+        # Страница из базы заменяет буфер, из буфера остаются сообщения новее нее, идущие без пропусков
+        ordered = list(messages)
+        next_seq = messages[-1].seq + 1 if messages else None
+        for message in entry.messages:
+            if next_seq is None:
+                next_seq = message.seq
+            if message.seq < next_seq:
+                continue
+            if message.seq != next_seq:
+                break
+            ordered.append(message)
+            next_seq += 1
+        entry._replace(ordered, ids)
+        entry.checked_at = time.monotonic()
+        # Первое сообщение чата могло не поместиться в буфер вместе с более новыми
+        entry.complete = complete and (not messages or entry.messages[0].seq == messages[0].seq)
+        self._update(entry, previous_size)
+
+    def latest(self, chat_id: str, limit: int) -> Optional[Tuple[List[Tuple[str, Message]], bool]]:
+        """
+        Последние limit сообщений чата
+        :return: Идентификаторы документов и сообщения в хронологическом порядке и признак того,
+        что есть более старые, или None, если в кэше нет всех нужных сообщений
+        """
+        entry = self._entry(chat_id)
+        if entry is not None and entry.messages and entry.messages[0].seq == 1:
+            # Сообщения нумеруются с единицы, буфер начинается с первого сообщения чата
+            entry.complete = True
+        if entry is None or entry.chat is None or not (len(entry.messages) >= limit or entry.complete) \
+                or not _contiguous(entry.messages, entry.messages[0].seq if entry.messages else 0):
+            self.open_misses += 1
+            return None
+        self.open_hits += 1
+        messages = list(entry.messages)
+        return [(entry.ids[message.seq], message) for message in messages[-limit:]], \
+            len(messages) > limit or not entry.complete
+
+    def current(self, chat_id: str) -> bool:
+        """
+        Сверялся ли конец буфера с базой в последние tail_ttl секунд
+        """
+        entry = self._chats.get(chat_id)
+        return entry is not None and entry.checked_at is not None and entry.checked_at > self._stale_before \
+            and time.monotonic() - entry.checked_at < self.tail_ttl
+
+    def mark_stale(self):
+        """
+        Требует сверки с базой для всех чатов: сообщения шины с новыми сообщениями могли потеряться
+        """
+        self._stale_before = time.monotonic()
+
+    def confirm(self, chat_id: str, stored_seq: int) -> bool:
+        """
+        Сверяет конец буфера с номером последнего сообщения чата в базе
+        :param chat_id: Идентификатор чата
+        :param stored_seq: Номер последнего записанного сообщения (0, если сообщений нет)
+        :return: True, если в базе нет сообщений новее буфера. Сообщения буфера, еще не записанные
+        отложенной записью, могут быть новее базы
+        """
+        entry = self._chats.get(chat_id)
+        self.tail_checks += 1
+        last_seq = entry.messages[-1].seq if entry is not None and entry.messages else 0
+        if entry is None or stored_seq > last_seq:
+            self.stale_tails += 1
+            return False
+        entry.checked_at = time.monotonic()
+        return True
+
+    def since(self, chat_id: str, after_seq: int) -> Optional[List[Message]]:
+        """
+        Сообщения чата с номерами больше after_seq
+        :return: Список сообщений или None, если в кэше есть не все такие сообщения
+        """
+        entry = self._chats.get(chat_id)
+        if entry is None or not entry.messages or entry.messages[0].seq > after_seq + 1:
+            self.replay_misses += 1
+            return None
+
+        messages = [message for message in entry.messages if message.seq > after_seq]
+        if not _contiguous(messages, after_seq + 1):
+            # Пропуск в номерах: сообщение не было сохранено или сообщение шины потерялось
+            self.replay_misses += 1
+            return None
+        self.replay_hits += 1
+        self._chats.move_to_end(chat_id)
+        return messages
+
+    def stats(self) -> dict:
+        opens = self.open_hits + self.open_misses
+        replays = self.replay_hits + self.replay_misses
+        return {
+            'chats': len(self._chats),
+            'length': self.length,
+            'size': self.size,
+            'memory_budget': self.memory_budget,
+            'appended': self.appended,
+            'evicted': self.evicted,
+            'open_hits': self.open_hits,
+            'open_misses': self.open_misses,
+            'open_hit_ratio': round(self.open_hits / opens, 4) if opens else None,
+            'replay_hits': self.replay_hits,
+            'replay_misses': self.replay_misses,
+            'replay_hit_ratio': round(self.replay_hits / replays, 4) if replays else None,
+            'tail_ttl': self.tail_ttl,
+            'tail_checks': self.tail_checks,
+            'stale_tails': self.stale_tails,
+        }
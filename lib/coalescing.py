@@ -0,0 +1,108 @@
+"""
+Общая часть накопителей с отложенной пакетной записью (lib.chat_activity, lib.notifications).
+
+Изменения накапливаются в словаре по ключу документа, первое изменение запускает таймер
+на interval секунд, по нему накопленное целиком уходит в запись. Одновременно идет только одна
+запись: изменения, пришедшие во время нее, отправляются следующей. Если запись не удалась,
+незаписанное возвращается в накопитель, объединяется с более новыми изменениями тех же ключей
+и повторяется через retry_backoff секунд.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Hashable, Optional
+
+
+class CoalescingWriter:
+    """
+    Накопитель изменений с отложенной записью. Наследник реализует _write, а элементы накопителя -
+    метод merge_older(older), который добавляет изменения, накопленные раньше
+    :param interval: Через сколько секунд после первого изменения накопленное отправляется в базу
+    :param max_pending: Количество ключей, при котором запись начинается не дожидаясь интервала
+    :param retry_backoff: Задержка повторной записи после ошибки
+    """
+
+    log = logging.getLogger('coalescing')
+
+    def __init__(self, interval: float, max_pending: int, retry_backoff: float):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.retry_backoff = retry_backoff
+        self._pending: Dict[Hashable, Any] = {}
+        self._flush_handle: Optional[asyncio.Handle] = None
+        self._flushing: Optional[asyncio.Future] = None
+
+        self.events = 0
+        self.written = 0
+        self.batches = 0
+        self.missing = 0
+        self.failures = 0
+        self.last_flush_ms = None
+
+    def _schedule(self, delay: float = None):
+        if len(self._pending) >= self.max_pending:
+            delay = 0
+        if self._flush_handle is not None:
+            if delay != 0:
+                return
+            self._flush_handle.cancel()
+        loop = asyncio.get_event_loop()
+        self._flush_handle = loop.call_later(self.interval if delay is None else delay,
+                                             lambda: asyncio.ensure_future(self.flush()))
+
+    async def flush(self):
+        """
+        Отправляет накопленные изменения в базу
+        """
+        self._flush_handle = None
+        while self._flushing is not None:
+            # Запись уже идет: накопленное после нее отправляется следующей
+            await self._flushing
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, {}
+        self._flushing = asyncio.get_event_loop().create_future()
+        started = time.perf_counter()
+        try:
+            await self._write(pending)
+        except Exception:
+            self.failures += 1
+            self.log.exception('Не удалось записать накопленные изменения, повтор через %s с', self.retry_backoff)
+            for key, entry in pending.items():
+                newer = self._pending.get(key)
+                if newer is None:
+                    self._pending[key] = entry
+                else:
+                    newer.merge_older(entry)
+            self._schedule(self.retry_backoff)
+        finally:
+            self.last_flush_ms = round((time.perf_counter() - started) * 1000, 3)
+            self._flushing.set_result(None)
+            self._flushing = None
+
+    async def _write(self, pending: Dict[Hashable, Any]):
+        """
+        Записывает накопленное и убирает записанное из pending: то, что осталось в нем
+        после ошибки, будет записано повторно
+        """
+        raise NotImplementedError
+
+    async def stop(self):
+        """
+        Дописывает накопленные изменения, вызывается при остановке приложения
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            'events': self.events,
+            'pending': len(self._pending),
+            'written': self.written,
+            'batches': self.batches,
+            'missing': self.missing,
+            'failures': self.failures,
+            'last_flush_ms': self.last_flush_ms,
+        }
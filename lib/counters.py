@@ -0,0 +1,82 @@
+"""
+Счетчики подписчиков и подписок пользователя.
+
+Поля followers_count и following_count хранятся в документе пользователя и изменяются
+преобразованием Increment в том же пакете записи, что и документы подписки, поэтому счетчики
+не расходятся с коллекциями followers и following и не требуют чтения перед записью.
+
+Один документ Firestore выдерживает около одной записи в секунду. У популярного аккаунта
+подписки приходят чаще, поэтому, когда followers_count достигает порога celebrity_threshold,
+в документе пользователя выставляется поле counter_shards, и дальнейшие изменения счетчиков
+распределяются по документам users/{login}/counter_shards/{0..N-1}. Значение счетчика -
+поле документа пользователя плюс сумма по шардам.
+Для уже существующих пользователей счетчики считаются командой
+    python -m database.count_follows
+"""
+import random
+from typing import Dict, Optional
+
+from config import Configuration
+from database import Increment
+
+config = Configuration()
+config.read()
+
+FOLLOWERS_FIELD = 'followers_count'
+FOLLOWING_FIELD = 'following_count'
+FIELDS = (FOLLOWERS_FIELD, FOLLOWING_FIELD)
+
+SHARDS_FIELD = 'counter_shards'
+SHARDS_COLLECTION = 'counter_shards'
+
+# Количество подписчиков, после которого счетчики пользователя распределяются по шардам
+CELEBRITY_THRESHOLD = config.get('counters', 'celebrity_threshold', 10000)
+SHARDS = config.get('counters', 'shards', 16)
+
+
+def shard_count(user_dict: Optional[dict]) -> int:
+    return int((user_dict or {}).get(SHARDS_FIELD) or 1)
+
+
+def shard_reference(user_ref, shard: int):
+    return user_ref.collection(SHARDS_COLLECTION).document(str(shard))
+
+
+def increment(batch, user_ref, user_dict: dict, field: str, amount: int):
+    """
+    Добавляет в пакет записи изменение счетчика пользователя
+    :param batch: Пакет записи
+    :param user_ref: Ссылка на документ пользователя
+    :param user_dict: Прочитанный документ пользователя, по нему выбирается шард
+    :param field: Поле счетчика
+    :param amount: Величина изменения
+    """
+    shards = shard_count(user_dict)
+    if shards > 1:
+        batch.set(shard_reference(user_ref, random.randrange(shards)), {field: Increment(amount)}, merge=True)
+        return
+
+    fields = {field: Increment(amount)}
+    if field == FOLLOWERS_FIELD and SHARDS > 1 and (user_dict.get(field) or 0) + amount >= CELEBRITY_THRESHOLD:
+        fields[SHARDS_FIELD] = SHARDS
+    batch.update(user_ref, fields)
+
+
+async def read(database, user_ref, user_dict: dict) -> Dict[str, int]:
+    """
+    Значения счетчиков пользователя
+    :param database: Объект базы Firestore
+    :param user_ref: Ссылка на документ пользователя
+    :param user_dict: Прочитанный документ пользователя
+    :return: Словарь {поле счетчика: значение}
+    """
+    counts = {field: user_dict.get(field) or 0 for field in FIELDS}
+    shards = shard_count(user_dict)
+    if shards > 1:
+        references = [shard_reference(user_ref, shard) for shard in range(shards)]
+        async for shard_doc in database.get_all(references):
+            if shard_doc.exists:
+                shard_dict = shard_doc.to_dict()
+                for field in FIELDS:
+                    counts[field] += shard_dict.get(field) or 0
+    return counts
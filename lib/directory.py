@@ -0,0 +1,112 @@
+"""
+Каталог пользователей и поиск по префиксу логина, имени и фамилии.
+
+Для каждого пользователя в коллекции user_directory хранится документ с публичными полями
+(login, name, surname) и списком prefixes - префиксами нормализованных слов этих полей.
+Поиск - один запрос array_contains по префиксу, упорядоченный по логину, поэтому он не
+читает документы пользователей и не зависит от размера коллекции users.
+Документ каталога записывается вместе с документом пользователя (lib.set_user_document),
+для уже существующих пользователей каталог строится командой
+    python -m database.build_user_directory
+"""
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from database import FieldFilter
+
+DIRECTORY_COLLECTION = 'user_directory'
+
+# Поля пользователя, которые отдаются в каталоге и поиске
+PUBLIC_FIELDS = ('login', 'name', 'surname')
+
+# Префиксы длиннее этого не хранятся: более длинный запрос ищется по префиксу такой длины
+# и дополнительно проверяется по полям документа
+PREFIX_MAX_LENGTH = 20
+
+WORD_SEPARATORS = re.compile(r'[\s\-_.@]+')
+
+
+def normalize(text: Optional[str]) -> str:
+    """
+    Приводит строку к виду для поиска: без регистра, ё -> е, пробелы схлопнуты
+    """
+    if not text:
+        return ''
+    return ' '.join(text.casefold().replace('ё', 'е').split())
+
+
+def _words(user_dict: Dict[str, Any]) -> List[str]:
+    words = []
+    for field in PUBLIC_FIELDS:
+        value = normalize(user_dict.get(field))
+        if value:
+            words.append(value)
+            words.extend(word for word in WORD_SEPARATORS.split(value) if word and word != value)
+    full_name = normalize(f"{user_dict.get('name') or ''} {user_dict.get('surname') or ''}")
+    if ' ' in full_name:
+        words.append(full_name)
+    return words
+
+
+def prefixes(user_dict: Dict[str, Any]) -> List[str]:
+    """
+    Все префиксы нормализованных слов публичных полей пользователя
+    """
+    result = set()
+    for word in _words(user_dict):
+        for length in range(1, min(len(word), PREFIX_MAX_LENGTH) + 1):
+            result.add(word[:length])
+    return sorted(result)
+
+
+def public_fields(user_dict: Dict[str, Any]) -> Dict[str, Any]:
+    return {field: user_dict.get(field) for field in PUBLIC_FIELDS}
+
+
+def directory_entry(user_dict: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Документ каталога для пользователя
+    :param user_dict: Документ пользователя
+    """
+    entry = public_fields(user_dict)
+    entry['prefixes'] = prefixes(user_dict)
+    return entry
+
+
+def _matches(entry: Dict[str, Any], query: str) -> bool:
+    return any(word.startswith(query) for word in _words(entry))
+
+
+async def search(database, query: Optional[str], limit: int, after_login: Optional[str] = None,
+                 exclude_login: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Страница каталога пользователей в порядке логинов
+    :param database: Объект базы Firestore
+    :param query: Префикс логина, имени или фамилии. Без него выдается весь каталог
+    :param limit: Количество пользователей на странице
+    :param after_login: Логин, после которого начинается страница
+    :param exclude_login: Логин, который не попадает в выдачу (текущий пользователь)
+    :return: Пара (публичные поля пользователей, логин для следующей страницы или None)
+    """
+    normalized = normalize(query)
+    directory_query = database.collection(DIRECTORY_COLLECTION)
+    if normalized:
+        directory_query = directory_query.where(
+            filter=FieldFilter('prefixes', 'array_contains', normalized[:PREFIX_MAX_LENGTH])
+        )
+    directory_query = directory_query.order_by('login')
+    if after_login is not None:
+        directory_query = directory_query.start_after({'login': after_login})
+
+    # Исключаемый логин встречается не больше одного раза, поэтому читается на один документ больше
+    fetch = limit + 1 if exclude_login is None else limit + 2
+    entries = [entry_doc.to_dict() async for entry_doc in directory_query.limit(fetch).stream()]
+    entries = [entry for entry in entries if entry['login'] != exclude_login]
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    next_login = entries[-1]['login'] if has_more else None
+
+    if len(normalized) > PREFIX_MAX_LENGTH:
+        entries = [entry for entry in entries if _matches(entry, normalized)]
+
+    return [public_fields(entry) for entry in entries], next_login
@@ -0,0 +1,201 @@
+"""
+Подписка на пользователей и отписка, по одному и списком.
+
+Подписка - пара документов users/{login}/followers/{follower} и users/{follower}/following/{login}
+и счетчики обоих пользователей (lib.counters). Все это записывается одним пакетом, а проверки
+перенесены в условия записи: документы подписки создаются через create(), который отклоняет
+пакет, если подписка уже есть, а при отписке удаляются с условием exists=True. Поэтому обычная
+операция - чтение документов пользователей (чаще всего из кэша профилей) и одна запись пакета,
+и сбой не может оставить подписку только с одной стороны.
+Если пакет отклонен, документы подписок читаются одним get_all и пакет повторяется без
+пользователей, для которых операция уже выполнена.
+"""
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from fastapi.exceptions import HTTPException
+
+from database import MAX_BATCH_WRITES, AlreadyExists, NotFound
+from database.models import Subscription
+from lib import counters, document_loader, user_cache, notification_pipeline
+from lib.loader import DocumentLoader
+
+FOLLOWED = 'followed'
+ALREADY_FOLLOWING = 'already_following'
+UNFOLLOWED = 'unfollowed'
+NOT_FOLLOWING = 'not_following'
+NOT_FOUND = 'not_found'
+SELF = 'self'
+
+# На одного пользователя в пакете приходится три операции, еще одна - счетчик подписчика
+USERS_PER_BATCH = (MAX_BATCH_WRITES - 1) // 3
+
+# Количество пользователей в одном запросе на массовую подписку
+BULK_MAX_SIZE = 1000
+
+# Количество попыток записи пакета, если подписки изменились параллельно
+MAX_ATTEMPTS = 3
+
+
+def _chunks(items: List[str], size: int):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _edges(database, follower_login: str, login: str):
+    """
+    :return: Пара ссылок (подписчик у пользователя, подписка у подписчика)
+    """
+    users = database.collection('users')
+    return (users.document(login).collection('followers').document(follower_login),
+            users.document(follower_login).collection('following').document(login))
+
+
+async def _load_users(database, loader: DocumentLoader, follower_login: str,
+                      logins: Iterable[str]) -> Tuple[dict, Dict[str, Optional[dict]]]:
+    logins = list(dict.fromkeys(login for login in logins if login != follower_login))
+    users = database.collection('users')
+    follower_dict, *user_dicts = await loader.load_many(
+        [users.document(follower_login)] + [users.document(login) for login in logins]
+    )
+    if follower_dict is None:
+        raise HTTPException(detail={'message': f"The user {follower_login} doesn't exist"}, status_code=400)
+    return follower_dict, dict(zip(logins, user_dicts))
+
+
+async def _read_edges(database, follower_login: str, logins: List[str]) -> Dict[str, Tuple[bool, bool]]:
+    """
+    Какие документы подписки существуют, одним обращением к базе
+    :return: Словарь {логин: (есть подписчик у пользователя, есть подписка у подписчика)}
+    """
+    references = [reference for login in logins for reference in _edges(database, follower_login, login)]
+    existing = {snapshot.reference.path async for snapshot in database.get_all(references) if snapshot.exists}
+    return {
+        login: tuple(reference.path in existing for reference in _edges(database, follower_login, login))
+        for login in logins
+    }
+
+
+def _invalidate_cache(logins: Iterable[str]):
+    # Счетчики изменены преобразованием Increment, их значения знает только база: документы перечитываются
+    for login in logins:
+        user_cache.invalidate(login)
+
+
+async def _commit_follows(database, follower_login: str, follower_dict: dict, targets: Dict[str, dict],
+                          subscription_dict: dict):
+    users = database.collection('users')
+    batch = database.batch()
+    for login, user_dict in targets.items():
+        follower_ref, following_ref = _edges(database, follower_login, login)
+        batch.create(follower_ref, subscription_dict)
+        batch.create(following_ref, subscription_dict)
+        counters.increment(batch, users.document(login), user_dict, counters.FOLLOWERS_FIELD, 1)
+    counters.increment(batch, users.document(follower_login), follower_dict,
+                       counters.FOLLOWING_FIELD, len(targets))
+    await batch.commit()
+    _invalidate_cache([follower_login, *targets])
+
+
+async def _commit_unfollows(database, follower_login: str, follower_dict: dict, targets: Dict[str, dict],
+                            edges: Dict[str, Tuple[bool, bool]]):
+    users = database.collection('users')
+    exists = database.write_option(exists=True)
+    batch = database.batch()
+    updated = []
+    following_removed = 0
+    for login, user_dict in targets.items():
+        follower_ref, following_ref = _edges(database, follower_login, login)
+        has_follower, has_following = edges[login]
+        if has_follower:
+            batch.delete(follower_ref, option=exists)
+            counters.increment(batch, users.document(login), user_dict, counters.FOLLOWERS_FIELD, -1)
+            updated.append(login)
+        if has_following:
+            batch.delete(following_ref, option=exists)
+            following_removed += 1
+    if following_removed:
+        counters.increment(batch, users.document(follower_login), follower_dict,
+                           counters.FOLLOWING_FIELD, -following_removed)
+        updated.append(follower_login)
+    await batch.commit()
+    _invalidate_cache(updated)
+
+
+async def follow(database, follower_login: str, logins: Iterable[str], loader: Optional[DocumentLoader] = None,
+                 subscription_dict: Optional[dict] = None) -> Dict[str, str]:
+    """
+    Подписывает пользователя на других пользователей
+    :param database: Объект базы Firestore
+    :param follower_login: Логин пользователя который подписывается
+    :param logins: Логины пользователей на которых подписываются
+    :param loader: Загрузчик документов запроса
+    :param subscription_dict: Документ подписки, по умолчанию - Subscription с текущим временем
+    :return: Словарь {логин: результат} с результатами FOLLOWED, ALREADY_FOLLOWING, NOT_FOUND, SELF
+    """
+    logins = list(logins)
+    subscription_dict = subscription_dict or Subscription().dict()
+    follower_dict, user_dicts = await _load_users(database, loader or document_loader(database), follower_login, logins)
+    results = {login: SELF for login in logins if login == follower_login}
+    results.update((login, NOT_FOUND) for login, user_dict in user_dicts.items() if user_dict is None)
+
+    for chunk in _chunks([login for login, user_dict in user_dicts.items() if user_dict is not None], USERS_PER_BATCH):
+        targets = {login: user_dicts[login] for login in chunk}
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                await _commit_follows(database, follower_login, follower_dict, targets, subscription_dict)
+                break
+            except AlreadyExists:
+                if attempt == MAX_ATTEMPTS - 1:
+                    raise
+            edges = await _read_edges(database, follower_login, list(targets))
+            for login, present in edges.items():
+                # Подписка, существующая хотя бы с одной стороны, считается оформленной
+                if any(present):
+                    results[login] = ALREADY_FOLLOWING
+                    del targets[login]
+            if not targets:
+                break
+
+        results.update((login, FOLLOWED) for login in targets)
+        notification_pipeline.followed(follower_login, targets)
+
+    return results
+
+
+async def unfollow(database, follower_login: str, logins: Iterable[str],
+                   loader: Optional[DocumentLoader] = None) -> Dict[str, str]:
+    """
+    Отписывает пользователя от других пользователей
+    :param database: Объект базы Firestore
+    :param follower_login: Логин пользователя который отписывается
+    :param logins: Логины пользователей от которых отписываются
+    :param loader: Загрузчик документов запроса
+    :return: Словарь {логин: результат} с результатами UNFOLLOWED, NOT_FOLLOWING, NOT_FOUND, SELF
+    """
+    logins = list(logins)
+    follower_dict, user_dicts = await _load_users(database, loader or document_loader(database), follower_login, logins)
+    results = {login: SELF for login in logins if login == follower_login}
+    results.update((login, NOT_FOUND) for login, user_dict in user_dicts.items() if user_dict is None)
+
+    for chunk in _chunks([login for login, user_dict in user_dicts.items() if user_dict is not None], USERS_PER_BATCH):
+        targets = {login: user_dicts[login] for login in chunk}
+        # Сначала предполагается, что подписка есть с обеих сторон
+        edges = {login: (True, True) for login in targets}
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                await _commit_unfollows(database, follower_login, follower_dict, targets, edges)
+                break
+            except NotFound:
+                if attempt == MAX_ATTEMPTS - 1:
+                    raise
+            edges = await _read_edges(database, follower_login, list(targets))
+            for login, present in edges.items():
+                if not any(present):
+                    results[login] = NOT_FOLLOWING
+                    del targets[login]
+            if not targets:
+                break
+
+        results.update((login, UNFOLLOWED) for login in targets)
+
+    return results
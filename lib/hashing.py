@@ -0,0 +1,152 @@
+"""
+Хэширование паролей bcrypt вне event loop.
+
+Один вызов bcrypt занимает сотни миллисекунд процессорного времени. Если выполнять его
+в event loop, на это время останавливаются все запросы и соединения WebSocket воркера.
+Поэтому хэширование и проверка паролей выполняются в пуле потоков или процессов, а
+количество одновременных вызовов ограничено. Вызовы сверх лимита ждут в очереди, время
+ожидания попадает в статистику.
+"""
+import asyncio
+import functools
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from passlib.context import CryptContext
+
+# Количество последних вызовов, по которым считаются перцентили времени
+STATS_WINDOW = 1000
+
+_contexts: Dict[int, CryptContext] = {}
+
+
+def _context(rounds: int) -> CryptContext:
+    """
+    Контекст passlib с заданной стоимостью bcrypt. Хэши с другой стоимостью считаются устаревшими
+    """
+    if rounds not in _contexts:
+        _contexts[rounds] = CryptContext(
+            schemes=['bcrypt'],
+            deprecated='auto',
+            bcrypt__default_rounds=rounds,
+            bcrypt__min_rounds=rounds,
+            bcrypt__max_rounds=rounds,
+        )
+    return _contexts[rounds]
+
+
+# Функции уровня модуля, чтобы их можно было передать в пул процессов
+
+def _hash(password: str, rounds: int) -> str:
+    return _context(rounds).hash(password)
+
+
+def _verify_and_update(password: str, hashed_password: str, rounds: int) -> Tuple[bool, Optional[str]]:
+    return _context(rounds).verify_and_update(password, hashed_password)
+
+
+def _percentile(values, fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))], 3)
+
+
+class PasswordHasher:
+    """
+    Хэширование паролей в пуле исполнителей с ограничением параллельности
+    :param rounds: Стоимость bcrypt (логарифм количества раундов)
+    :param executor: "thread" - пул потоков (bcrypt отпускает GIL), "process" - пул процессов
+    :param workers: Размер пула
+    :param max_concurrency: Количество одновременно выполняемых вызовов, остальные ждут в очереди
+    """
+
+    def __init__(self, rounds: int = 12, executor: str = 'thread', workers: int = 2, max_concurrency: int = None):
+        if executor not in ('thread', 'process'):
+            raise ValueError(f'Неизвестный пул {executor}')
+        self.rounds = rounds
+        self.executor_type = executor
+        self.workers = workers
+        self.max_concurrency = max_concurrency or workers
+        self._executor: Optional[Executor] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+        self.calls = 0
+        self.waiting = 0
+        self.running = 0
+        self.rehashed = 0
+        self._queue_ms = deque(maxlen=STATS_WINDOW)
+        self._run_ms = deque(maxlen=STATS_WINDOW)
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.executor_type == 'process':
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='bcrypt')
+        return self._executor
+
+    async def _run(self, func, *args):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.calls += 1
+        queued = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        started = time.perf_counter()
+        self._queue_ms.append((started - queued) * 1000)
+        self.running += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), functools.partial(func, *args))
+        finally:
+            self.running -= 1
+            self._semaphore.release()
+            self._run_ms.append((time.perf_counter() - started) * 1000)
+
+    async def hash(self, password: str) -> str:
+        """
+        Хэширует пароль с текущей стоимостью bcrypt
+        :param password: Исходный пароль
+        :return: Захэшированный пароль
+        """
+        return await self._run(_hash, password, self.rounds)
+
+    async def verify_and_update(self, password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        """
+        Проверяет пароль и, если хэш получен с другой стоимостью bcrypt, возвращает новый хэш
+        :param password: Пароль, введенный пользователем
+        :param hashed_password: Хэш из базы
+        :return: Пара (пароль верный, новый хэш или None)
+        """
+        verified, new_hash = await self._run(_verify_and_update, password, hashed_password, self.rounds)
+        if new_hash:
+            self.rehashed += 1
+        return verified, new_hash
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def stats(self) -> dict:
+        queue_ms = list(self._queue_ms)
+        run_ms = list(self._run_ms)
+        return {
+            'executor': self.executor_type,
+            'workers': self.workers,
+            'max_concurrency': self.max_concurrency,
+            'rounds': self.rounds,
+            'calls': self.calls,
+            'running': self.running,
+            'waiting': self.waiting,
+            'rehashed': self.rehashed,
+            'queue_ms': {'p50': _percentile(queue_ms, 0.5), 'p95': _percentile(queue_ms, 0.95),
+                         'max': round(max(queue_ms), 3) if queue_ms else None},
+            'hash_ms': {'p50': _percentile(run_ms, 0.5), 'p95': _percentile(run_ms, 0.95)},
+        }
@@ -0,0 +1,100 @@
+"""
+Загрузчик документов на время одного запроса.
+
+Обработчик запрашивает документы по ссылкам через load/load_many, а загрузчик собирает
+все ссылки, запрошенные в одной итерации event loop, и читает их одним вызовом get_all.
+Повторные запросы того же документа в пределах загрузчика не обращаются к базе.
+Документы пользователей берутся из кэша профилей, прочитанные попадают в него.
+"""
+import asyncio
+from typing import Dict, Iterable, List, Optional
+
+from lib.cache import TTLLRUCache
+
+
+class DocumentLoader:
+    """
+    :param database: Клиент базы
+    :param user_cache: Кэш профилей пользователей, ключ - логин
+    """
+
+    def __init__(self, database, user_cache: Optional[TTLLRUCache] = None):
+        self.database = database
+        self.user_cache = user_cache
+        self._results: Dict[str, asyncio.Future] = {}
+        self._pending: Dict[str, object] = {}
+        self.round_trips = 0
+
+    @staticmethod
+    def _user_login(reference) -> Optional[str]:
+        collection_path, _, document_id = reference.path.rpartition('/')
+        return document_id if collection_path == 'users' else None
+
+    def load(self, reference) -> asyncio.Future:
+        """
+        Запрашивает документ
+        :param reference: Ссылка на документ
+        :return: Future со словарем документа или None, если документа нет
+        """
+        path = reference.path
+        if path in self._results:
+            return self._results[path]
+
+        loop = asyncio.get_event_loop()
+        future = self._results[path] = loop.create_future()
+
+        login = self._user_login(reference)
+        if login is not None and self.user_cache is not None:
+            user_dict = self.user_cache.get(login)
+            if user_dict is not None:
+                future.set_result(user_dict)
+                return future
+
+        if not self._pending:
+            loop.call_soon(lambda: asyncio.ensure_future(self._dispatch()))
+        self._pending[path] = reference
+        return future
+
+    async def load_many(self, references: Iterable) -> List[Optional[dict]]:
+        """
+        Данные нескольких документов за одно обращение к базе
+        :param references: Ссылки на документы
+        :return: Словари документов в том же порядке, None для несуществующих
+        """
+        return list(await asyncio.gather(*(self.load(reference) for reference in references)))
+
+    async def exists(self, reference) -> bool:
+        return (await self.load(reference)) is not None
+
+    def forget(self, reference):
+        """
+        Убирает документ из результатов загрузчика, например после его изменения
+        """
+        self._results.pop(reference.path, None)
+
+    async def _dispatch(self):
+        pending, self._pending = self._pending, {}
+        self.round_trips += 1
+        try:
+            snapshots = {snapshot.reference.path: snapshot
+                         async for snapshot in self.database.get_all(list(pending.values()))}
+        except Exception as err:
+            for path in pending:
+                future = self._results.pop(path, None)
+                if future is not None:
+                    future.set_exception(err)
+            return
+
+        for path, reference in pending.items():
+            snapshot = snapshots.get(path)
+            future = self._results.get(path)
+            if future is None:
+                continue
+            if snapshot is None or not snapshot.exists:
+                future.set_result(None)
+                continue
+            data = snapshot.to_dict()
+            login = self._user_login(reference)
+            if login is not None and self.user_cache is not None:
+                self.user_cache.set(login, data)
+            future.set_result(data)
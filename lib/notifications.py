@@ -0,0 +1,263 @@
+"""
+Уведомления пользователей: новые сообщения в чатах, новые подписчики и произвольные уведомления.
+
+Уведомление хранится в users/{login}/notifications, а количество непрочитанных - в поле
+notifications_unread документа пользователя. События не записываются по одному: первое событие
+запускает окно coalesce_window секунд, и все события окна записываются вместе пакетами.
+События одного вида в одном чате у одного пользователя за окно объединяются в одно уведомление
+с количеством: пять сообщений - «5 новых сообщений в чате X», а не пять уведомлений.
+После записи уведомление отправляется пользователю кадром MessageType.NOTIFICATION,
+если он подключен к какому-либо воркеру.
+"""
+import logging
+from typing import Dict, Iterable, List, Optional, Tuple
+from uuid import uuid4
+
+from database import MAX_BATCH_WRITES, FieldFilter, Increment, NotFound, run_transaction
+from database.models import Chat, Message, Notification, NotificationItem, ResponseMessage, WebSocketMessage, \
+    MessageType, EncodedFrame, timestamp_ms
+from lib.coalescing import CoalescingWriter
+
+MESSAGES = 'messages'
+FOLLOWERS = 'followers'
+
+UNREAD_FIELD = 'notifications_unread'
+
+# На уведомление в пакете записи приходится две операции: уведомление и счетчик его получателя
+NOTIFICATIONS_PER_BATCH = MAX_BATCH_WRITES // 2
+
+# Отметки о прочтении в одном пакете, еще одна операция - счетчик пользователя
+MARK_READ_PER_BATCH = MAX_BATCH_WRITES - 1
+
+
+def plural(count: int, one: str, few: str, many: str) -> str:
+    """
+    Форма слова для количества: 1 сообщение, 2 сообщения, 5 сообщений
+    """
+    if count % 10 == 1 and count % 100 != 11:
+        return one
+    if 2 <= count % 10 <= 4 and not 12 <= count % 100 <= 14:
+        return few
+    return many
+
+
+class PendingNotification:
+    """
+    События одного вида, накопленные для пользователя за окно объединения
+    """
+    __slots__ = ('login', 'kind', 'chat_id', 'chat_name', 'user', 'count', 'received_at', 'description')
+
+    def __init__(self, login: str, kind: str, chat_id: Optional[str] = None, chat_name: Optional[str] = None,
+                 description: Optional[str] = None):
+        self.login = login
+        self.kind = kind
+        self.chat_id = chat_id
+        self.chat_name = chat_name
+        self.description = description
+        self.user = None
+        self.count = 0
+        self.received_at = 0
+
+    def add(self, user: str, received_at: int, count: int = 1):
+        self.count += count
+        if received_at >= self.received_at:
+            self.received_at = received_at
+            self.user = user
+
+    def merge_older(self, older: 'PendingNotification'):
+        """
+        Добавляет события, накопленные раньше этих, например до неудачной записи
+        """
+        self.add(older.user, older.received_at, older.count)
+
+    def notification(self) -> Notification:
+        if self.description is not None:
+            description = self.description
+        elif self.kind == MESSAGES:
+            words = plural(self.count, 'новое сообщение', 'новых сообщения', 'новых сообщений')
+            place = f'в чате {self.chat_name}' if self.chat_name else f'от {self.user}'
+            description = f'{self.count} {words} {place}'
+        elif self.count == 1:
+            description = f'{self.user} подписался на вас'
+        else:
+            words = plural(self.count, 'новый подписчик', 'новых подписчика', 'новых подписчиков')
+            description = f'{self.count} {words}'
+        return Notification(description=description, received_at=self.received_at, user=self.user,
+                            chat_id=self.chat_id, kind=self.kind, count=self.count)
+
+
+class NotificationPipeline(CoalescingWriter):
+    """
+    Накопитель уведомлений с объединением событий и отложенной пакетной записью (lib.coalescing)
+    :param database: Клиент базы
+    :param websocket_manager: Менеджер соединений для отправки записанных уведомлений
+    :param coalesce_window: Через сколько секунд после первого события накопленное записывается в базу
+    :param max_pending: Количество уведомлений, при котором запись начинается не дожидаясь окна
+    :param retry_backoff: Задержка повторной записи после ошибки
+    :param message_notifications: Уведомлять ли о новых сообщениях участников, не открывших чат
+    """
+
+    log = logging.getLogger('notifications')
+
+    def __init__(self, database, websocket_manager, coalesce_window: float = 5.0, max_pending: int = 10000,
+                 retry_backoff: float = 1.0, message_notifications: bool = True):
+        super().__init__(coalesce_window, max_pending, retry_backoff)
+        self.database = database
+        self.websocket_manager = websocket_manager
+        self.message_notifications = message_notifications
+        self.pushed = 0
+
+    def _entry(self, login: str, kind: str, key: str, **fields) -> PendingNotification:
+        entry = self._pending.get((login, kind, key))
+        if entry is None:
+            entry = self._pending[(login, kind, key)] = PendingNotification(login, kind, **fields)
+        return entry
+
+    def message_sent(self, chat_id: str, chat: Chat, message: Message):
+        """
+        Уведомляет участников чата, кроме отправителя и тех, у кого этот чат открыт
+        :param chat_id: Идентификатор чата
+        :param chat: Чат
+        :param message: Сообщение
+        """
+        if not self.message_notifications:
+            return
+        for login in chat.members:
+            if login == message.creator_login:
+                continue
+            opened_connection = self.websocket_manager[login]
+            if opened_connection and opened_connection.user_status \
+                    and opened_connection.user_status.chat_id == chat_id:
+                continue
+            self.events += 1
+            self._entry(login, MESSAGES, chat_id, chat_id=chat_id, chat_name=chat.chat_name) \
+                .add(message.creator_login, message.created_at)
+        self._schedule()
+
+    def followed(self, follower_login: str, logins: Iterable[str]):
+        """
+        Уведомляет пользователей о новом подписчике
+        :param follower_login: Логин подписавшегося
+        :param logins: Логины пользователей, на которых он подписался
+        """
+        received_at = timestamp_ms()
+        for login in logins:
+            self.events += 1
+            self._entry(login, FOLLOWERS, '').add(follower_login, received_at)
+        self._schedule()
+
+    def notify(self, logins: Iterable[str], notification: Notification):
+        """
+        Ставит произвольное уведомление в очередь записи без объединения с другими
+        :param logins: Логины получателей
+        :param notification: Уведомление
+        """
+        for login in logins:
+            self.events += 1
+            self._entry(login, notification.kind, uuid4().hex, chat_id=notification.chat_id,
+                        description=notification.description).add(notification.user, notification.received_at)
+        self._schedule()
+
+    async def _write(self, pending: Dict[Tuple[str, str, str], PendingNotification]):
+        """
+        Записывает накопленные уведомления и отправляет их подключенным получателям
+        """
+        keys = list(pending)
+        for start in range(0, len(keys), NOTIFICATIONS_PER_BATCH):
+            chunk = keys[start:start + NOTIFICATIONS_PER_BATCH]
+            written = await self._commit([pending[key] for key in chunk])
+            # Записанное убирается до отправки, чтобы ошибка отправки не привела к повторной записи
+            for key in chunk:
+                del pending[key]
+            self._push(written)
+
+    async def _commit(self, entries: List[PendingNotification]) -> List[Tuple[str, NotificationItem]]:
+        """
+        Записывает пакет уведомлений вместе со счетчиками непрочитанных их получателей
+        :return: Записанные уведомления с логинами получателей
+        """
+        users = self.database.collection('users')
+        written = []
+        counts: Dict[str, int] = {}
+        for entry in entries:
+            reference = users.document(entry.login).collection('notifications').document()
+            written.append((entry.login, reference, entry.notification()))
+            counts[entry.login] = counts.get(entry.login, 0) + 1
+
+        batch = self.database.batch()
+        for login, reference, notification in written:
+            batch.create(reference, notification.dict())
+        for login, count in counts.items():
+            batch.update(users.document(login), {UNREAD_FIELD: Increment(count)})
+        try:
+            await batch.commit()
+            self.batches += 1
+        except NotFound:
+            # Кого-то из получателей уже нет: остальным уведомления записываются по одному
+            delivered = []
+            for login, reference, notification in written:
+                batch = self.database.batch()
+                batch.create(reference, notification.dict())
+                batch.update(users.document(login), {UNREAD_FIELD: Increment(1)})
+                try:
+                    await batch.commit()
+                    delivered.append((login, reference, notification))
+                except NotFound:
+                    self.missing += 1
+            written = delivered
+
+        self.written += len(written)
+        return [(login, NotificationItem(id=reference.id, **notification.dict()))
+                for login, reference, notification in written]
+
+    def _push(self, notifications: List[Tuple[str, NotificationItem]]):
+        for login, notification in notifications:
+            self.pushed += self.websocket_manager.broadcast([login], EncodedFrame(ResponseMessage(
+                message=WebSocketMessage(type=MessageType.NOTIFICATION, content=notification),
+                chat_id=notification.chat_id,
+            ).dict()))
+
+    def stats(self) -> dict:
+        result = super().stats()
+        result['pushed'] = self.pushed
+        return result
+
+
+async def mark_read(database, login: str, ids: Iterable[str] = (), all_notifications: bool = False) -> int:
+    """
+    Отмечает уведомления прочитанными и уменьшает счетчик непрочитанных. Флаги read читаются
+    в той же транзакции, что и записываются, поэтому одновременные запросы не уменьшают счетчик
+    дважды за одно уведомление
+    :param database: Объект базы Firestore
+    :param login: Логин пользователя
+    :param ids: Идентификаторы уведомлений, читаются одним get_all
+    :param all_notifications: Отметить все непрочитанные уведомления
+    :return: Количество отмеченных уведомлений
+    """
+    user_ref = database.collection('users').document(login)
+    notifications = user_ref.collection('notifications')
+    marked = 0
+
+    async def commit(transaction, references) -> int:
+        unread = [snapshot.reference async for snapshot in database.get_all(references, transaction=transaction)
+                  if snapshot.exists and not snapshot.to_dict().get('read')]
+        for reference in unread:
+            transaction.update(reference, {'read': True})
+        if unread:
+            transaction.update(user_ref, {UNREAD_FIELD: Increment(-len(unread))})
+        return len(unread)
+
+    ids = list(dict.fromkeys(ids))
+    for start in range(0, len(ids), MARK_READ_PER_BATCH):
+        references = [notifications.document(notification_id)
+                      for notification_id in ids[start:start + MARK_READ_PER_BATCH]]
+        marked += await run_transaction(database, commit, references)
+
+    while all_notifications:
+        query = notifications.where(filter=FieldFilter('read', '==', False)).limit(MARK_READ_PER_BATCH)
+        unread = [snapshot.reference async for snapshot in query.stream()]
+        if unread:
+            marked += await run_transaction(database, commit, unread)
+        all_notifications = len(unread) == MARK_READ_PER_BATCH
+
+    return marked
@@ -0,0 +1,340 @@
+"""
+Присутствие пользователей: в сети, отошел, не в сети.
+
+Каждый воркер знает состояние своих подключенных пользователей, а объявленные состояния всех
+пользователей хранит в памяти и получает от остальных воркеров через шину (сообщения 'presence').
+Изменение объявляется не сразу, а через debounce секунд, и только если к этому моменту
+состояние действительно отличается от объявленного: переподключение в пределах нескольких секунд,
+в том числе к другому воркеру, не рассылает ни «не в сети», ни «в сети».
+Объявление рассылается кадром MessageType.PRESENCE подписчикам пользователя и участникам его чатов.
+Этот список читается из базы только перед рассылкой и хранится audience_ttl секунд, поэтому
+частые переподключения, изменения которых погашены задержкой, не читают его вовсе.
+Время последней активности записывается в поле last_seen_at документа пользователя не при каждом
+отключении, а пакетами раз в flush_interval секунд.
+"""
+import asyncio
+import logging
+from typing import Dict, Iterable, List, Optional, Set
+
+from database import MAX_BATCH_WRITES, DESCENDING, Maximum, NotFound
+from database.models import Presence, PresenceStatus, ResponseMessage, WebSocketMessage, MessageType, \
+    EncodedFrame, timestamp_ms
+from lib.cache import TTLLRUCache
+
+log = logging.getLogger('presence')
+
+# Тип сообщения шины с объявленным состоянием пользователя
+BUS_MESSAGE_TYPE = 'presence'
+
+
+class LocalPresence:
+    """
+    Состояние пользователя, подключенного к текущему воркеру
+    """
+    __slots__ = ('status', 'manual', 'last_active_at')
+
+    def __init__(self):
+        self.status = PresenceStatus.ONLINE
+        # Статус «отошел» выставлен клиентом, а не по бездействию
+        self.manual = False
+        self.last_active_at = timestamp_ms()
+
+
+class PresenceService:
+    """
+    Присутствие пользователей с отложенной рассылкой изменений и пакетной записью last_seen_at
+    :param database: Клиент базы
+    :param websocket_manager: Менеджер соединений текущего воркера
+    :param debounce: Через сколько секунд после изменения состояние объявляется, если не вернулось обратно
+    :param away_after: Через сколько секунд без кадров от клиента пользователь считается отошедшим
+    :param flush_interval: Период записи last_seen_at и проверки бездействия
+    :param audience_limit: Сколько подписчиков пользователя получают изменения его состояния
+    :param audience_chats: Из скольких последних чатов пользователя берутся участники
+    :param audience_ttl: Сколько секунд хранится прочитанный список получателей
+    :param audience_cache_size: Для скольких пользователей хранятся списки получателей
+    """
+
+    def __init__(self, database, websocket_manager, debounce: float = 5.0, away_after: float = 300.0,
+                 flush_interval: float = 30.0, audience_limit: int = 5000, audience_chats: int = 200,
+                 audience_ttl: float = 300.0, audience_cache_size: int = 10000):
+        self.database = database
+        self.websocket_manager = websocket_manager
+        self.debounce = debounce
+        self.away_after = away_after
+        self.flush_interval = flush_interval
+        self.audience_limit = audience_limit
+        self.audience_chats = audience_chats
+
+        self._local: Dict[str, LocalPresence] = {}
+        # Объявленные состояния: логин -> (статус, время последней активности для не в сети)
+        self._announced: Dict[str, Presence] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._last_seen: Dict[str, int] = {}
+        self._task: Optional[asyncio.Future] = None
+        self._audiences = TTLLRUCache('presence_audience', maxsize=audience_cache_size, ttl=audience_ttl)
+        # Чтения списков получателей, которые уже идут: одновременные объявления ждут одно чтение
+        self._audience_loads: Dict[str, asyncio.Future] = {}
+
+        self.announcements = 0
+        self.suppressed = 0
+        self.frames = 0
+        self.audience_loads = 0
+        self.last_seen_written = 0
+        self.last_seen_missing = 0
+        self.failures = 0
+
+        websocket_manager.bus_handlers[BUS_MESSAGE_TYPE] = self._on_bus_message
+
+    def connected(self, login: str):
+        """
+        Пользователь подключился к текущему воркеру
+        """
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        state = self._local.get(login)
+        if state is None:
+            state = self._local[login] = LocalPresence()
+        state.status = PresenceStatus.ONLINE
+        state.manual = False
+        state.last_active_at = timestamp_ms()
+        self._changed(login)
+
+    def disconnected(self, login: str):
+        """
+        Соединение пользователя закрылось. Если он уже переподключился к этому воркеру, ничего не меняется
+        """
+        if self.websocket_manager[login] is not None:
+            return
+        state = self._local.get(login)
+        if state is not None:
+            state.last_active_at = timestamp_ms()
+        self._changed(login)
+
+    def touch(self, login: str):
+        """
+        От клиента пришел кадр: пользователь активен и, если отошел по бездействию, снова в сети
+        """
+        state = self._local.get(login)
+        if state is None:
+            return
+        state.last_active_at = timestamp_ms()
+        if state.status == PresenceStatus.AWAY and not state.manual:
+            state.status = PresenceStatus.ONLINE
+            self._changed(login)
+
+    def set_status(self, login: str, status: PresenceStatus):
+        """
+        Клиент сам выставил статус «в сети» или «отошел»
+        """
+        state = self._local.get(login)
+        if state is None:
+            return
+        state.status = status
+        state.manual = status == PresenceStatus.AWAY
+        state.last_active_at = timestamp_ms()
+        self._changed(login)
+
+    def get_many(self, logins: Iterable[str]) -> Dict[str, dict]:
+        """
+        Состояния пользователей из памяти, без обращения к базе. Пользователь, о котором
+        воркеру ничего не известно, считается не в сети без времени последней активности.
+        Пользователь остановившегося воркера считается не в сети, даже если объявить это было некому
+        """
+        result = {}
+        for login in logins:
+            presence = self._announced.get(login)
+            if presence is None:
+                presence = Presence(status=PresenceStatus.OFFLINE, login=login)
+            elif presence.status != PresenceStatus.OFFLINE and self._current(login) == PresenceStatus.OFFLINE \
+                    and login not in self._timers:
+                presence = Presence(status=PresenceStatus.OFFLINE, login=login)
+            result[login] = presence.dict()
+        return result
+
+    def _current(self, login: str) -> Optional[PresenceStatus]:
+        """
+        Текущее состояние пользователя с точки зрения этого воркера.
+        None - пользователь подключен к другому воркеру, и объявлять его состояние должен тот
+        """
+        state = self._local.get(login)
+        if self.websocket_manager[login] is not None and state is not None:
+            return state.status
+        bus = self.websocket_manager.bus
+        if bus and bus.presence.get(login) not in (None, bus.worker_id):
+            return None
+        return PresenceStatus.OFFLINE
+
+    def _changed(self, login: str):
+        timer = self._timers.pop(login, None)
+        if timer is not None:
+            timer.cancel()
+        announced = self._announced.get(login)
+        if announced is not None and announced.status == self._current(login):
+            # Состояние вернулось к объявленному раньше, чем изменение было разослано
+            if timer is not None:
+                self.suppressed += 1
+            return
+        self._timers[login] = asyncio.get_event_loop().call_later(
+            self.debounce, lambda: asyncio.ensure_future(self._announce(login))
+        )
+
+    async def _announce(self, login: str):
+        self._timers.pop(login, None)
+        status = self._current(login)
+        announced = self._announced.get(login)
+        state = self._local.get(login)
+        if status is None or (announced is not None and announced.status == status) \
+                or (announced is None and status == PresenceStatus.OFFLINE):
+            self.suppressed += 1
+            if status in (None, PresenceStatus.OFFLINE):
+                self._local.pop(login, None)
+            return
+
+        last_seen_at = state.last_active_at if state is not None else timestamp_ms()
+        presence = Presence(
+            status=status,
+            login=login,
+            last_seen_at=last_seen_at if status == PresenceStatus.OFFLINE else None,
+        )
+        self._announced[login] = presence
+        self.announcements += 1
+        if self.websocket_manager.bus:
+            self.websocket_manager.bus.publish_all({'type': BUS_MESSAGE_TYPE, 'presence': presence.dict()})
+
+        if state is not None:
+            audience = await self._audience(login)
+            self.frames += self.websocket_manager.broadcast(audience, EncodedFrame(ResponseMessage(
+                message=WebSocketMessage(type=MessageType.PRESENCE, content=presence),
+            ).dict()))
+
+        if status == PresenceStatus.OFFLINE:
+            self._local.pop(login, None)
+            self._last_seen[login] = max(self._last_seen.get(login, 0), last_seen_at)
+
+    def _on_bus_message(self, message: dict):
+        presence = Presence(**message['presence'])
+        self._announced[presence.login] = presence
+
+    async def _audience(self, login: str) -> Set[str]:
+        """
+        Получатели изменений состояния пользователя: из кэша или из базы
+        """
+        cached = self._audiences.get(login)
+        if cached is not None:
+            return cached['logins']
+        load = self._audience_loads.get(login)
+        if load is None:
+            load = self._audience_loads[login] = asyncio.ensure_future(self._load_audience(login))
+            load.add_done_callback(lambda _: self._audience_loads.pop(login, None))
+        return await asyncio.shield(load)
+
+    async def _load_audience(self, login: str) -> Set[str]:
+        """
+        Подписчики пользователя и участники его последних чатов
+        """
+        user_ref = self.database.collection('users').document(login)
+        try:
+            self.audience_loads += 1
+            audience = {doc.id async for doc in user_ref.collection('followers').limit(self.audience_limit).stream()}
+            metas = user_ref.collection('chats').order_by('last_activity_at', direction=DESCENDING) \
+                .limit(self.audience_chats)
+            chat_refs = [self.database.collection('chats').document(doc.to_dict()['chat_id'])
+                         async for doc in metas.stream()]
+            if chat_refs:
+                async for snapshot in self.database.get_all(chat_refs):
+                    if snapshot.exists:
+                        audience.update(snapshot.to_dict().get('members', []))
+            audience.discard(login)
+        except Exception:
+            log.exception('Не удалось получить получателей состояния пользователя %s', login)
+            return set()
+        self._audiences.set(login, {'logins': audience})
+        return audience
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self._mark_idle()
+                await self.flush()
+            except Exception:
+                log.exception('Ошибка периодической обработки присутствия')
+
+    def _mark_idle(self):
+        idle_since = timestamp_ms() - int(self.away_after * 1000)
+        for login, state in list(self._local.items()):
+            if state.status == PresenceStatus.ONLINE and state.last_active_at < idle_since \
+                    and self.websocket_manager[login] is not None:
+                state.status = PresenceStatus.AWAY
+                self._changed(login)
+
+    async def flush(self):
+        """
+        Записывает накопленное время последней активности в документы пользователей
+        """
+        if not self._last_seen:
+            return
+        pending, self._last_seen = self._last_seen, {}
+        users = self.database.collection('users')
+        logins = list(pending)
+        try:
+            for start in range(0, len(logins), MAX_BATCH_WRITES):
+                chunk = logins[start:start + MAX_BATCH_WRITES]
+                await self._commit([(users.document(login), pending[login]) for login in chunk])
+                for login in chunk:
+                    del pending[login]
+        except Exception:
+            self.failures += 1
+            log.exception('Не удалось записать время последней активности, повтор при следующей записи')
+            for login, last_seen_at in pending.items():
+                self._last_seen[login] = max(self._last_seen.get(login, 0), last_seen_at)
+
+    async def _commit(self, entries: List[tuple]):
+        batch = self.database.batch()
+        for reference, last_seen_at in entries:
+            batch.update(reference, {'last_seen_at': Maximum(last_seen_at)})
+        try:
+            await batch.commit()
+            self.last_seen_written += len(entries)
+        except NotFound:
+            # Пользователь удален: остальные записываются по одному
+            for reference, last_seen_at in entries:
+                try:
+                    await reference.update({'last_seen_at': Maximum(last_seen_at)})
+                    self.last_seen_written += 1
+                except NotFound:
+                    self.last_seen_missing += 1
+
+    async def stop(self):
+        """
+        Сохраняет время последней активности, в том числе подключенных пользователей.
+        Вызывается при остановке приложения
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        now = timestamp_ms()
+        for login in self._local:
+            self._last_seen[login] = max(self._last_seen.get(login, 0), now)
+        await self.flush()
+
+    def stats(self) -> dict:
+        counts = {status.value: 0 for status in PresenceStatus}
+        for presence in self._announced.values():
+            counts[presence.status.value] += 1
+        return {
+            'local': len(self._local),
+            'announced': counts,
+            'pending_announcements': len(self._timers),
+            'announcements': self.announcements,
+            'suppressed': self.suppressed,
+            'frames': self.frames,
+            'audience_loads': self.audience_loads,
+            'last_seen_pending': len(self._last_seen),
+            'last_seen_written': self.last_seen_written,
+            'last_seen_missing': self.last_seen_missing,
+            'failures': self.failures,
+        }
@@ -0,0 +1,162 @@
+"""
+Отложенная пакетная запись документов (write-behind).
+
+Сообщения чатов подтверждаются и рассылаются сразу, а в базу уходят пакетами: пакет
+отправляется, когда набралось batch_size записей или прошло flush_interval секунд с первой
+записи в пакете. Буфер ограничен: когда он заполнен, отправитель ждет свободного места.
+При ошибке записи пакет повторяется с экспоненциальной задержкой, при остановке приложения
+буфер дописывается до конца.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional
+
+from database import MAX_BATCH_WRITES, AlreadyExists
+
+log = logging.getLogger('write_behind')
+
+
+class PendingWrite(NamedTuple):
+    """
+    Отложенное создание документа. on_conflict вызывается, если документ уже существует
+    """
+    reference: Any
+    data: Dict[str, Any]
+    on_conflict: Optional[Callable[[], Awaitable[Any]]] = None
+
+
+class WriteBehindBuffer:
+    """
+    Буфер отложенных записей с задачей, которая пакетами отправляет их в базу
+    """
+
+    def __init__(self, database, batch_size: int = 200, flush_interval: float = 0.05,
+                 buffer_size: int = 10000, retry_backoff: float = 0.1, max_retry_backoff: float = 5.0,
+                 shutdown_timeout: float = 30.0):
+        self.database = database
+        self.batch_size = min(batch_size, MAX_BATCH_WRITES)
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self.shutdown_timeout = shutdown_timeout
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.written = 0
+        self.batches = 0
+        self.retries = 0
+        self.conflicts = 0
+        self.backpressure_waits = 0
+        self.last_flush_ms = None
+
+    def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.buffer_size)
+            self._task = asyncio.ensure_future(self._run())
+
+    async def put(self, reference, data: Dict[str, Any], on_conflict: Callable[[], Awaitable[Any]] = None):
+        """
+        Ставит создание документа в буфер. Если буфер заполнен, ждет, пока запись освободит место
+        :param reference: Ссылка на создаваемый документ
+        :param data: Данные документа
+        :param on_conflict: Корутина, вызываемая вместо записи, если документ уже существует
+        """
+        self.start()
+        write = PendingWrite(reference, data, on_conflict)
+        if self._queue.full():
+            self.backpressure_waits += 1
+        await self._queue.put(write)
+
+    async def stop(self):
+        """
+        Дописывает буфер и останавливает задачу записи
+        """
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), self.shutdown_timeout)
+        except asyncio.TimeoutError:
+            log.error(f'Не записано документов при остановке: {self._queue.qsize()}')
+        self._task.cancel()
+        self._task = None
+
+    async def _collect(self) -> List[PendingWrite]:
+        writes = [await self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(writes) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                writes.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return writes
+
+    async def _run(self):
+        while True:
+            writes = await self._collect()
+            await self._flush(list(writes))
+            for _ in writes:
+                self._queue.task_done()
+
+    async def _flush(self, writes: List[PendingWrite]):
+        backoff = self.retry_backoff
+        one_by_one = False
+        while writes:
+            started = time.monotonic()
+            try:
+                if one_by_one:
+                    await self._write_one_by_one(writes)
+                else:
+                    await self._commit(writes)
+                    self.written += len(writes)
+                    writes.clear()
+                self.batches += 1
+                self.last_flush_ms = round((time.monotonic() - started) * 1000, 3)
+            except AlreadyExists:
+                # Пакет применяется целиком, поэтому конфликтующие записи ищем по одной
+                one_by_one = True
+            except Exception:
+                self.retries += 1
+                log.exception(f'Ошибка записи {len(writes)} документов, повтор через {backoff} с')
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_retry_backoff)
+
+    async def _commit(self, writes: List[PendingWrite]):
+        batch = self.database.batch()
+        for write in writes:
+            batch.create(write.reference, write.data)
+        await batch.commit()
+
+    async def _write_one_by_one(self, writes: List[PendingWrite]):
+        """
+        Записывает документы по одному, удаляя записанные из списка,
+        чтобы при повторе после ошибки не записывать их снова
+        """
+        while writes:
+            write = writes[0]
+            try:
+                await write.reference.create(write.data)
+            except AlreadyExists:
+                self.conflicts += 1
+                if write.on_conflict:
+                    await write.on_conflict()
+            writes.pop(0)
+            self.written += 1
+
+    def stats(self) -> dict:
+        return {
+            'buffered': self._queue.qsize() if self._queue else 0,
+            'buffer_size': self.buffer_size,
+            'batch_size': self.batch_size,
+            'flush_interval': self.flush_interval,
+            'written': self.written,
+            'batches': self.batches,
+            'retries': self.retries,
+            'conflicts': self.conflicts,
+            'backpressure_waits': self.backpressure_waits,
+            'last_flush_ms': self.last_flush_ms,
+        }
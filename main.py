@@ -1,17 +1,23 @@
-from fastapi import FastAPI, Depends, status, Request
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Depends, status, Request, Query
+from fastapi.responses import ORJSONResponse
 from fastapi.exceptions import HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordRequestForm
 
-from database.models import User, Subscription, BaseUserModel, Token, WebSocketManager
+from typing import Optional
+
+from database.models import UserProfile, Relationship, Subscription, BaseUserModel, Token, WebSocketManager
 from database import DataBaseConnector
 from config import Configuration
 
-from routers import posts, followers, following, chats, ws_communication
+from routers import posts, followers, following, chats, ws_communication, service, presence, notifications
 from dependencies import authenticate_user, create_access_token, get_password_hash
 
-from lib import root_collection_item_exist, get_token_from_request, get_user_from_token
+from lib import root_collection_item_exist, get_token_from_request, get_user_from_token, \
+    get_user_document, set_user_document, message_writer, chat_activity_writer, presence_service, password_hasher, \
+    notification_pipeline, document_loader, wants_ndjson, ndjson_response, encode_cursor, decode_cursor, USERS_PAGE_SIZE, USERS_PAGE_MAX_SIZE
+from lib import directory, counters, follows
+from lib.bus import create_bus
 
 config = Configuration()
 config.read()
@@ -23,7 +29,8 @@ CRYPT_ALGORITHM = config['crypt_settings']['algorithm']
 app = FastAPI(
     title='Touch',
     description="The description",
-    version='062023.1'
+    version='062023.1',
+    default_response_class=ORJSONResponse,
 )
 allow_all = ['*']
 app.add_middleware(
@@ -45,135 +52,185 @@ app.include_router(followers.router)
 app.include_router(following.router)
 app.include_router(chats.router)
 app.include_router(ws_communication.router)
+app.include_router(service.router)
+app.include_router(presence.router)
+app.include_router(notifications.router)
+
+
+@app.on_event('startup')
+async def start_bus():
+    await websocket_manager.attach_bus(create_bus(config))
+
+
+@app.on_event('shutdown')
+async def save_last_seen():
+    await presence_service.stop()
+
+
+@app.on_event('shutdown')
+async def stop_bus():
+    await websocket_manager.detach_bus()
+
+
+@app.on_event('shutdown')
+async def flush_messages():
+    if message_writer:
+        await message_writer.stop()
+
+
+@app.on_event('shutdown')
+async def flush_chat_activity():
+    await chat_activity_writer.stop()
+
+
+@app.on_event('shutdown')
+async def flush_notifications():
+    await notification_pipeline.stop()
+
+
+@app.on_event('shutdown')
+async def stop_password_hasher():
+    password_hasher.shutdown()
 
 
 @app.get('/users')
-async def get_users(request: Request):
+async def get_users(request: Request,
+                    limit: int = Query(USERS_PAGE_SIZE, ge=1, le=USERS_PAGE_MAX_SIZE),
+                    cursor: Optional[str] = None, q: Optional[str] = None):
+    """
+    Каталог пользователей кроме текущего: постраничная выдача в порядке логинов
+    и поиск по началу логина, имени или фамилии. Отдаются только публичные поля
+    :param request: Объект запроса. С заголовком Accept: application/x-ndjson страница отдается потоком,
+    курсор следующей страницы - в заголовке X-Next-Cursor
+    :param limit: Количество пользователей на странице
+    :param cursor: Курсор следующей страницы из предыдущего ответа
+    :param q: Строка поиска
+    :return:
+    """
     try:
-        users = []
-
         token = get_token_from_request(request)
         user_model = get_user_from_token(token)
 
-        for user in database.collection('users').stream():
-            if user_model.login != user.id:
-                user_obj = user.to_dict()
-                user_model = BaseUserModel(**user_obj)
+        after_login = decode_cursor(cursor, 'login', str) if cursor else None
+        users, next_login = await directory.search(database, q, limit, after_login, exclude_login=user_model.login)
+        next_cursor = encode_cursor(next_login, 'login') if next_login else None
 
-                users.append(user_model.dict())
+        if wants_ndjson(request):
+            async def documents():
+                for user in users:
+                    yield user
 
-        return JSONResponse(content={'users': users}, status_code=200)
+            return ndjson_response(documents(), headers={'X-Next-Cursor': next_cursor} if next_cursor else None)
+        return ORJSONResponse(content={'users': users, 'next_cursor': next_cursor}, status_code=200)
+    except HTTPException as err:
+        return err
     except Exception as err:
         return HTTPException(500, f'error: {err}')
 
 
 @app.get('/{user_login}',
-         response_model=User,
+         response_model=UserProfile,
          summary='Получение основной информации о пользователе'
          )
 async def get_user(user_login):
     """
-    Возвращает информацию о пользователе
+    Возвращает информацию о пользователе вместе с количеством подписчиков и подписок
     :param user_login: Логин пользователя
     :return:
     """
     try:
-        doc_ref = database.collection('users').document(user_login)
-        user_doc = doc_ref.get()
+        user_dict = await get_user_document(database, user_login)
 
-        if user_doc.exists:
-            user_obj = User.parse_obj(user_doc.to_dict())
-            return JSONResponse(content={'user': user_obj.dict()}, status_code=200)
+        if user_dict:
+            user_ref = database.collection('users').document(user_login)
+            counts = await counters.read(database, user_ref, user_dict)
+            user_obj = UserProfile.parse_obj({**user_dict, **counts})
+            return ORJSONResponse(content={'user': user_obj.dict()}, status_code=200)
 
         return HTTPException(detail={'message': f"The user {user_login} doesn't exist"}, status_code=400)
     except:
         return HTTPException(detail={'message': "Internal Error"}, status_code=500)
 
 
+@app.get('/{user_login}/relationship/{other_login}',
+         response_model=Relationship,
+         summary='Отношение подписки между двумя пользователями'
+         )
+async def get_relationship(user_login, other_login):
+    """
+    Проверяет, подписан ли пользователь на другого, подписан ли другой на него и взаимна ли подписка.
+    Обе записи о подписке читаются одним обращением к базе, документы пользователей не читаются
+    :param user_login: Логин пользователя
+    :param other_login: Логин другого пользователя
+    :return:
+    """
+    try:
+        user_ref = database.collection('users').document(user_login)
+        follows, followed_by = await document_loader(database).load_many([
+            user_ref.collection('following').document(other_login),
+            user_ref.collection('followers').document(other_login),
+        ])
+        relationship = Relationship(
+            follows=follows is not None,
+            followed_by=followed_by is not None,
+            mutual=follows is not None and followed_by is not None,
+        )
+        return ORJSONResponse(content=relationship.dict(), status_code=200)
+    except:
+        return HTTPException(detail={'message': "Internal Error"}, status_code=500)
+
+
 @app.post('/{user_login}/follow',
           response_model=Subscription,
           summary='Подписывается на конкретного пользователя'
           )
 async def follow(user_login, follower_login: str):
     """
-    Подписывается на конкретного пользователя
+    Подписывается на конкретного пользователя.
+    Записи о подписке и счетчики обоих пользователей записываются одним пакетом
     :param user_login: Логин пользователя на которого подписываются
     :param follower_login: Логин пользователя который подписывается
     :return:
     """
     try:
-        following_user_ref = database.collection('users').document(user_login)
-        following_user_doc = following_user_ref.get()
-
-        if following_user_doc.exists:
-            follower_user_ref = database.collection('users').document(follower_login)
-            follower_user_doc = follower_user_ref.get()
-
-            if follower_user_doc.exists:
-
-                follower_ref = following_user_ref.collection('followers').document(follower_login)
-                follower_doc = follower_ref.get()
-
-                following_ref = follower_user_ref.collection('following').document(user_login)
-                following_doc = following_ref.get()
-
-                if follower_doc.exists or following_doc.exists:
-                    return HTTPException(detail={'message': f"You're already subscribers"}, status_code=400)
-
-                subscription = Subscription()
-                subscription_dict = subscription.dict()
-
-                follower_ref.set(subscription_dict)
-                following_ref.set(subscription_dict)
-
-                return JSONResponse(content=subscription_dict, status_code=200)
-
-            else:
-                return HTTPException(detail={'message': f"The user {user_login} {user_login} doesn't exist"}, status_code=400)
-        else:
-            return HTTPException(detail={'message': f"The user {user_login} {follower_login} doesn't exist"}, status_code=400)
+        subscription_dict = Subscription().dict()
+        result = (await follows.follow(database, follower_login, [user_login],
+                                       subscription_dict=subscription_dict))[user_login]
+
+        if result == follows.FOLLOWED:
+            return ORJSONResponse(content=subscription_dict, status_code=200)
+        if result == follows.ALREADY_FOLLOWING:
+            raise HTTPException(detail={'message': f"You're already subscribers"}, status_code=400)
+        if result == follows.SELF:
+            raise HTTPException(detail={'message': "You can't follow yourself"}, status_code=400)
+        raise HTTPException(detail={'message': f"The user {user_login} doesn't exist"}, status_code=400)
+    except HTTPException:
+        raise
     except:
-        return HTTPException(detail={'message': "Internal Error"}, status_code=500)
+        raise HTTPException(detail={'message': "Internal Error"}, status_code=500)
 
 
 @app.delete('/{user_login}/unfollow', summary="Отписывается от конкретного пользователя",)
 async def unfollow(user_login, follower_login: str):
     """
-    Отписывается от конкретного пользователя
+    Отписывается от конкретного пользователя.
+    Записи о подписке удаляются и счетчики обоих пользователей изменяются одним пакетом
     :param user_login: Логин пользователя от которого отписываются
     :param follower_login: Логин пользователя который отписывается
     :return:
     """
     try:
-        following_user_ref = database.collection('users').document(user_login)
-        following_user_doc = following_user_ref.get()
-
-        if following_user_doc.exists:
-            follower_user_ref = database.collection('users').document(follower_login)
-            follower_user_doc = follower_user_ref.get()
-
-            if follower_user_doc.exists:
-
-                follower_ref = following_user_ref.collection('followers').document(follower_login)
-                follower_doc = follower_ref.get()
-
-                following_ref = follower_user_ref.collection('following').document(user_login)
-                following_doc = following_ref.get()
-
-                if not (follower_doc.exists or following_doc.exists):
-                    return HTTPException(detail={'message': f"You're not a subscribers"}, status_code=400)
-
-                following_ref.delete()
-                follower_ref.delete()
-
-                return JSONResponse(content={'message': 'successfully unfollow'}, status_code=200)
-
-            else:
-                return HTTPException(detail={'message': f"The user {user_login} doesn't exist"}, status_code=400)
-        else:
-            return HTTPException(detail={'message': f"The user {user_login} {follower_login} doesn't exist"}, status_code=400)
+        result = (await follows.unfollow(database, follower_login, [user_login]))[user_login]
+
+        if result == follows.UNFOLLOWED:
+            return ORJSONResponse(content={'message': 'successfully unfollow'}, status_code=200)
+        if result in (follows.NOT_FOLLOWING, follows.SELF):
+            raise HTTPException(detail={'message': f"You're not a subscribers"}, status_code=400)
+        raise HTTPException(detail={'message': f"The user {user_login} doesn't exist"}, status_code=400)
+    except HTTPException:
+        raise
     except:
-        return HTTPException(detail={'message': "Internal Error"}, status_code=500)
+        raise HTTPException(detail={'message': "Internal Error"}, status_code=500)
 
 
 @app.post('/signup', summary="Регистрация пользователя")
@@ -184,21 +241,19 @@ async def signup(user: BaseUserModel):
     :return:
     """
     try:
-        if root_collection_item_exist(database, 'users', user.login):
+        if await root_collection_item_exist(database, 'users', user.login):
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail=f"User {user.login} already exist"
             )
-        doc_ref = database.collection('users').document(user.login)
-
-        user.password = get_password_hash(user.password)
+        user.password = await get_password_hash(user.password)
         user_db_model: BaseUserModel = BaseUserModel(**user.dict())
         user_db_model_dict = user_db_model.dict()
 
-        doc_ref.set(user_db_model_dict)
+        await set_user_document(database, user.login, user_db_model_dict)
 
         token_model = create_access_token(user_db_model)
-        response = JSONResponse(content=token_model.dict(), status_code=200)
+        response = ORJSONResponse(content=token_model.dict(), status_code=200)
 
         return response
     except:
@@ -210,7 +265,7 @@ async def signup(user: BaseUserModel):
           summary='Аутентификация пользователя'
           )
 async def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = authenticate_user(form_data.username, form_data.password)
+    user = await authenticate_user(form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -218,6 +273,6 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):
             headers={"WWW-Authenticate": "Bearer"}
         )
     token_model = create_access_token(user)
-    response = JSONResponse(content=token_model.dict(), status_code=200)
+    response = ORJSONResponse(content=token_model.dict(), status_code=200)
 
     return response
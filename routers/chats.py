@@ -1,13 +1,12 @@
-from fastapi import APIRouter, Request, WebSocket, WebSocketDisconnect
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Request, WebSocket, WebSocketDisconnect, Query
+from fastapi.responses import ORJSONResponse
 from fastapi.exceptions import HTTPException
-from google.cloud.firestore_v1 import FieldFilter
 
 import lib
 import json
-from database import DataBaseConnector
+from database import DataBaseConnector, FieldFilter
 from database.models import *
-from typing import List
+from typing import List, Optional
 from config import Configuration
 
 router = APIRouter(
@@ -29,12 +28,16 @@ CRYPT_ALGORITHM = config['crypt_settings']['algorithm']
 
 
 @router.get('/')
-async def get_all_user_chats(request: Request):
+async def get_all_user_chats(request: Request,
+                             limit: int = Query(lib.CHATS_PAGE_SIZE, ge=1, le=lib.CHATS_PAGE_MAX_SIZE),
+                             cursor: Optional[str] = None):
+    """
+    Получение чатов пользователя, начиная с недавно активных, с количеством непрочитанных сообщений
+    :param request: Объект запроса
+    :param limit: Количество чатов на странице
+    :param cursor: Курсор следующей страницы из предыдущего ответа
+    :return:
     """
-        Получение всех чатов пользователя
-        :param request: Объект запроса
-        :return:
-        """
     try:
         token_from_request = lib.get_token_from_request(request)
         user = lib.get_user_from_token(token_from_request)
@@ -42,27 +45,31 @@ async def get_all_user_chats(request: Request):
         if not user:
             return HTTPException(detail={'message': f"Пользователь не авторизован"}, status_code=401)
 
-        user_ref = lib.root_collection_item_exist(database, 'users', user.login)
+        user_ref = await lib.root_collection_item_exist(database, 'users', user.login)
 
         if not user_ref:
             return HTTPException(detail={'message': f"Пользователь не существует"}, status_code=400)
 
-        user_chats = []
-        for chat in user_ref.collection('chats').stream():
-            # подумай как изменить это
-            chat_model = chat.to_dict()
-            user_chats.append(chat_model)
-        return JSONResponse(content={'chats': user_chats}, status_code=200)
+        user_chats, next_cursor = await lib.get_user_chats(user_ref, limit, cursor)
+        return ORJSONResponse(content={'chats': user_chats, 'next_cursor': next_cursor}, status_code=200)
+    except HTTPException as err:
+        return err
     except:
         return HTTPException(detail={'message': "Internal Error"}, status_code=500)
 
 
 @router.get('/{chat_id}')
-async def get_user_chat(request: Request, chat_id: str):
+async def get_user_chat(request: Request, chat_id: str,
+                        limit: int = Query(lib.MESSAGES_PAGE_SIZE, ge=1, le=lib.MESSAGES_PAGE_MAX_SIZE),
+                        before: Optional[str] = None, after: Optional[str] = None):
     """
     Получение конкретного чата/диалога пользователя по идентификатору чата
+    с постраничной выдачей истории сообщений
     :param request: Объект запроса
     :param chat_id: Идентификатор чата
+    :param limit: Количество сообщений на странице
+    :param before: Курсор для получения более старых сообщений
+    :param after: Курсор для получения более новых сообщений
     :return:
     """
     try:
@@ -72,52 +79,56 @@ async def get_user_chat(request: Request, chat_id: str):
         if not user:
             return HTTPException(detail={'message': f"Пользователь не авторизован"}, status_code=401)
 
-        user_ref = lib.root_collection_item_exist(database, 'users', user.login)
+        user_ref = await lib.root_collection_item_exist(database, 'users', user.login)
 
         if not user_ref:
             return HTTPException(detail={'message': f"Пользователь не существует"}, status_code=400)
 
-        chat_ref = lib.root_collection_item_exist(database, 'chats', chat_id)
+        # Документ чата и последняя страница сообщений популярного чата берутся из кэша
+        chat_dict = await lib.get_chat_document(database, chat_id)
 
-        if not chat_ref:
+        if chat_dict is None:
             return HTTPException(detail={'message': f"Чата {chat_id} не существует"}, status_code=404)
 
-        chat_dict = chat_ref.get().to_dict()
+        chat_dict = dict(chat_dict)
         chat_model = Chat(**chat_dict)
 
         if user.login not in chat_model.members:
             return HTTPException(detail={'message': f"Пользователь {user.login} не является участником чата"},
                                  status_code=403)
 
-        messages = []
+        messages, next_cursor = await lib.get_chat_messages(database.collection('chats').document(chat_id),
+                                                            limit, before, after)
 
-        messages_query = chat_ref.collection('messages').order_by('created_at')
+        if not chat_model.chat_name:
+            # Название диалога у каждого участника свое, из метаданных чата оно читается один раз
+            chat_name = lib.chat_cache.dialog_name(chat_id, user.login)
 
-        for message_doc in messages_query.stream():
-            message_obj = message_doc.to_dict()
-            messages.append(message_obj)
+            if chat_name is None:
+                user_ref_chats_meta_ref = user_ref.collection('chats')
+                user_ref_chats_meta = (
+                    user_ref_chats_meta_ref
+                    .where(filter=FieldFilter(
+                        'chat_id', '==', chat_id
+                    ))
+                    .stream()
+                )
 
-        if not chat_model.chat_name:
-            user_ref_chats_meta_ref = user_ref.collection('chats')
-            user_ref_chats_meta = (
-                user_ref_chats_meta_ref
-                .where(filter=FieldFilter(
-                    'chat_id', '==', chat_id
-                ))
-                .stream()
-            )
+                chat_name = ''
 
-            chat_name = ''
+                async for chat_meta in user_ref_chats_meta:
+                    chat_meta_doc = chat_meta.to_dict()
+                    chat_name = chat_meta_doc['chat_name']
 
-            for chat_meta in user_ref_chats_meta:
-                chat_meta_doc = chat_meta.to_dict()
-                chat_name = chat_meta_doc['chat_name']
+                lib.chat_cache.set_dialog_name(chat_id, user.login, chat_name)
 
             chat_dict.update({'chat_name': chat_name})
 
-        chat_dict.update({'messages': messages})
+        chat_dict.update({'messages': messages, 'next_cursor': next_cursor})
 
-        return JSONResponse(content=chat_dict, status_code=200)
+        return ORJSONResponse(content=chat_dict, status_code=200)
+    except HTTPException as err:
+        return err
     except Exception as err:
         return HTTPException(500, f'error: {err}')
 
@@ -138,28 +149,33 @@ async def create_chat(request: Request, chat_request_model: ChatModelRequest):
         if not creator:
             return HTTPException(detail={'message': f"Пользователь не авторизован"}, status_code=401)
 
-        user_ref = lib.root_collection_item_exist(database, 'users', creator.login)
+        chat_members_login = list(set(filter(lambda member: member != creator.login, chat_request_model.members_login)))
 
-        if not user_ref:
-            return HTTPException(detail={'message': f"Пользователь не существует"}, status_code=400)
+        # Создатель и все участники читаются одним обращением к базе
+        loader = lib.document_loader(database)
+        users = database.collection('users')
+        user_ref = users.document(creator.login)
+        creator_dict, *member_dicts = await loader.load_many(
+            [user_ref] + [users.document(member) for member in chat_members_login]
+        )
 
-        chat_members_login = list(set(filter(lambda member: member != creator.login, chat_request_model.members_login)))
+        if creator_dict is None:
+            return HTTPException(detail={'message': f"Пользователь не существует"}, status_code=400)
 
-        for member in chat_members_login:
-            member_ref = lib.root_collection_item_exist(database, 'users', member)
-            if not member_ref:
+        for member, member_dict in zip(chat_members_login, member_dicts):
+            if member_dict is None:
                 return HTTPException(detail={'message': f"Пользователь {member} не существует"}, status_code=404)
 
         if len(chat_members_login) == 1:
-            member_ref = lib.root_collection_item_exist(database, 'users', chat_request_model.members_login[0])
-            chat, member_chat_meta = lib.create_dialog(database, user_ref, member_ref)
+            member_ref = users.document(chat_members_login[0])
+            chat, member_chat_meta = await lib.create_dialog(database, user_ref, member_ref, loader)
             websocket_message = WebSocketMessage(
                 type=MessageType.UPDATE_CHATS,
                 content=member_chat_meta
             )
         elif len(chat_members_login) > 1:
             chat_members_login.append(creator.login)
-            chat = lib.create_chat(database, chat_members_login, chat_request_model.name)
+            chat = await lib.create_chat(database, chat_members_login, chat_request_model.name)
             websocket_message = WebSocketMessage(
                 type=MessageType.UPDATE_CHATS,
                 content=chat
@@ -174,15 +190,12 @@ async def create_chat(request: Request, chat_request_model: ChatModelRequest):
             chat_id=chat.chat_id
         )
 
-        for member in chat_members_login:
-            if member == creator.login:
-                continue
-
-            active_member = websocket_manager[member]
-            if active_member:
-                await active_member.connection.send_json(response_message.dict())
+        websocket_manager.broadcast(
+            [member for member in chat_members_login if member != creator.login],
+            response_message.dict()
+        )
 
-        response = JSONResponse(content=chat.dict(), status_code=200)
+        response = ORJSONResponse(content=chat.dict(), status_code=200)
         return response
 
     except HTTPException as err:
@@ -1,8 +1,9 @@
-from fastapi import APIRouter
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Request
 from fastapi.exceptions import HTTPException
 from database import DataBaseConnector
 
+from lib import root_collection_item_exist, list_response
+
 router = APIRouter(
     prefix='/{user_login}/followers',
     tags=['followers'],
@@ -14,24 +15,24 @@ database = connection.db
 
 
 @router.get('/')
-async def get_user_followers(user_login):
+async def get_user_followers(request: Request, user_login):
     """
     Получение всех подписчиков пользователя
+    :param request: Объект запроса. С заголовком Accept: application/x-ndjson список отдается потоком
     :param user_login: Логин пользователя
     :return:
     """
     try:
-        doc_ref = database.collection('users').document(user_login)
-        user_doc = doc_ref.get()
+        doc_ref = await root_collection_item_exist(database, 'users', user_login)
+
+        if doc_ref:
+            async def documents():
+                async for follower in doc_ref.collection('followers').stream():
+                    follower_obj = {'id': follower.id}
+                    follower_obj.update(follower.to_dict())
+                    yield follower_obj
 
-        if user_doc.exists:
-            user_obj = user_doc.to_dict()
-            user_followers = []
-            for follower in doc_ref.collection('followers').stream():
-                follower_obj = {'id': follower.id}
-                follower_obj.update(follower.to_dict())
-                user_followers.append(follower_obj)
-            return JSONResponse(content={'followers': user_followers}, status_code=200)
+            return await list_response(request, 'followers', documents())
         else:
             return HTTPException(detail={'message': f"The user {user_login} doesn't exist"}, status_code=400)
     except:
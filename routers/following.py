@@ -1,7 +1,11 @@
-from fastapi import APIRouter
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Request
+from fastapi.responses import ORJSONResponse
 from fastapi.exceptions import HTTPException
 from database import DataBaseConnector
+from database.models import BulkFollowRequest
+
+from lib import root_collection_item_exist, list_response, get_token_from_request, get_user_from_token
+from lib import follows
 
 router = APIRouter(
     prefix='/{user_login}/following',
@@ -14,24 +18,59 @@ database = connection.db
 
 
 @router.get('/')
-async def get_user_followers(user_login):
+async def get_user_followers(request: Request, user_login):
     """
     Получение всех подписок пользователя
+    :param request: Объект запроса. С заголовком Accept: application/x-ndjson список отдается потоком
     :param user_login: Логин пользователя
     :return:
     """
     try:
-        doc_ref = database.collection('users').document(user_login)
-        user_doc = doc_ref.get()
-
-        if user_doc.exists:
-            user_following = []
-            for following in doc_ref.collection('following').stream():
-                follower_obj = {'id': following.id}
-                follower_obj.update(following.to_dict())
-                user_following.append(follower_obj)
-            return JSONResponse(content={'following': user_following}, status_code=200)
+        doc_ref = await root_collection_item_exist(database, 'users', user_login)
+
+        if doc_ref:
+            async def documents():
+                async for following in doc_ref.collection('following').stream():
+                    follower_obj = {'id': following.id}
+                    follower_obj.update(following.to_dict())
+                    yield follower_obj
+
+            return await list_response(request, 'following', documents())
         else:
             return HTTPException(detail={'message': f"The user {user_login} doesn't exist"}, status_code=400)
     except:
-        return HTTPException(detail={'message': "Internal Error"}, status_code=500)
\ No newline at end of file
+        return HTTPException(detail={'message': "Internal Error"}, status_code=500)
+
+
+@router.post('/bulk')
+async def bulk_follow(request: Request, user_login, body: BulkFollowRequest):
+    """
+    Подписка на список пользователей и отписка от списка пользователей, например при импорте контактов.
+    Пользователи читаются одним обращением к базе, подписки записываются пакетами
+    по follows.USERS_PER_BATCH пользователей
+    :param request: Объект запроса
+    :param user_login: Логин пользователя, чьи подписки изменяются. Должен совпадать с пользователем токена
+    :param body: Логины для подписки и для отписки
+    :return: Результат для каждого логина
+    """
+    try:
+        user = get_user_from_token(get_token_from_request(request))
+
+        if not user or user.login != user_login:
+            return HTTPException(detail={'message': f"Пользователь не авторизован"}, status_code=401)
+
+        if len(body.follow) + len(body.unfollow) > follows.BULK_MAX_SIZE:
+            return HTTPException(detail={'message': f"Не больше {follows.BULK_MAX_SIZE} пользователей за запрос"},
+                                 status_code=400)
+
+        results = {}
+        if body.follow:
+            results['follow'] = await follows.follow(database, user_login, body.follow)
+        if body.unfollow:
+            results['unfollow'] = await follows.unfollow(database, user_login, body.unfollow)
+
+        return ORJSONResponse(content=results, status_code=200)
+    except HTTPException as err:
+        return err
+    except:
+        return HTTPException(detail={'message': "Internal Error"}, status_code=500)
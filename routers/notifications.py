@@ -1,9 +1,14 @@
-from fastapi import APIRouter
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Request, Query
+from fastapi.responses import ORJSONResponse
 from fastapi.exceptions import HTTPException
 from database import DataBaseConnector
+from database.models import NotificationsReadRequest
 
-from lib import root_collection_item_exist
+from typing import Optional
+
+from lib import root_collection_item_exist, get_token_from_request, get_user_from_token, get_notifications, \
+    wants_ndjson, ndjson_response, NOTIFICATIONS_PAGE_SIZE, NOTIFICATIONS_PAGE_MAX_SIZE
+from lib import notifications
 
 router = APIRouter(
     prefix='/{user_login}/notifications',
@@ -16,23 +21,73 @@ database = connection.db
 
 
 @router.get('/')
-async def all_notifications(user_login):
+async def all_notifications(request: Request, user_login,
+                            limit: int = Query(NOTIFICATIONS_PAGE_SIZE, ge=1, le=NOTIFICATIONS_PAGE_MAX_SIZE),
+                            cursor: Optional[str] = None):
     """
-    Получение всех оповещений пользователя
-    :param user_login: Логин пользователя
+    Получение уведомлений пользователя, начиная с новых, и количества непрочитанных
+    :param request: Объект запроса. С заголовком Accept: application/x-ndjson страница отдается потоком,
+    курсор следующей страницы - в заголовке X-Next-Cursor, количество непрочитанных - в X-Unread-Count
+    :param user_login: Логин пользователя. Должен совпадать с пользователем токена
+    :param limit: Количество уведомлений на странице
+    :param cursor: Курсор следующей страницы из предыдущего ответа
     :return:
     """
     try:
-        user_ref = root_collection_item_exist(database, 'users', user_login)
+        user = get_user_from_token(get_token_from_request(request))
+
+        if not user or user.login != user_login:
+            return HTTPException(detail={'message': f"Пользователь не авторизован"}, status_code=401)
+
+        user_ref = await root_collection_item_exist(database, 'users', user_login)
 
         if user_ref:
-            user_notifications = []
-            for notification in user_ref.collection('notifications').stream():
-                notification_obj = {'id': notification.id}
-                notification_obj.update(notification.to_dict())
-                user_notifications.append(notification_obj)
-            return JSONResponse(content={'notifications': user_notifications}, status_code=200)
+            items, next_cursor = await get_notifications(user_ref, limit, cursor)
+            # Счетчик читается из документа, а не из кэша профилей: он меняется при каждой записи уведомлений
+            user_dict = (await user_ref.get()).to_dict() or {}
+            unread = user_dict.get(notifications.UNREAD_FIELD, 0)
+
+            if wants_ndjson(request):
+                async def documents():
+                    for item in items:
+                        yield item
+
+                headers = {'X-Unread-Count': str(unread)}
+                if next_cursor:
+                    headers['X-Next-Cursor'] = next_cursor
+                return ndjson_response(documents(), headers=headers)
+            return ORJSONResponse(content={
+                'notifications': items,
+                'next_cursor': next_cursor,
+                'unread': unread,
+            }, status_code=200)
         else:
             return HTTPException(detail={'message': f"The user {user_login} doesn't exist"}, status_code=400)
+    except HTTPException as err:
+        return err
+    except:
+        return HTTPException(detail={'message': "Internal Error"}, status_code=500)
+
+
+@router.post('/read')
+async def mark_notifications_read(request: Request, user_login, body: NotificationsReadRequest):
+    """
+    Отмечает уведомления прочитанными: перечисленные в ids или все непрочитанные при all = true
+    :param request: Объект запроса
+    :param user_login: Логин пользователя. Должен совпадать с пользователем токена
+    :param body: Идентификаторы уведомлений
+    :return: Количество отмеченных уведомлений
+    """
+    try:
+        user = get_user_from_token(get_token_from_request(request))
+
+        if not user or user.login != user_login:
+            return HTTPException(detail={'message': f"Пользователь не авторизован"}, status_code=401)
+
+        marked = await notifications.mark_read(database, user_login, body.ids, body.all)
+
+        return ORJSONResponse(content={'marked': marked}, status_code=200)
+    except HTTPException as err:
+        return err
     except:
         return HTTPException(detail={'message': "Internal Error"}, status_code=500)
@@ -1,9 +1,11 @@
 from fastapi import APIRouter, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from fastapi.exceptions import HTTPException
 from database import DataBaseConnector
 from database.models import Post
 
+from lib import root_collection_item_exist
+
 router = APIRouter(
     prefix='/posts',
     tags=['posts'],
@@ -38,16 +40,15 @@ async def get_user_posts(request: Request, user_login):
 @router.get('/{post_id}')
 async def get_user_post(user_login, post_id):
     try:
-        doc_ref = database.collection('users').document(user_login)
-        user_doc = doc_ref.get()
+        doc_ref = await root_collection_item_exist(database, 'users', user_login)
 
-        if user_doc.exists:
+        if doc_ref:
             post_ref = doc_ref.collection('posts').document(post_id)
-            post_doc = post_ref.get()
+            post_doc = await post_ref.get()
 
             if post_doc.exists:
                 post_obj = post_doc.to_dict()
-                return JSONResponse(content=post_obj, status_code=200)
+                return ORJSONResponse(content=post_obj, status_code=200)
             else:
                 return HTTPException(detail={'message': "This post doesn't exist"}, status_code=400)
         else:
@@ -59,14 +60,13 @@ async def get_user_post(user_login, post_id):
 @router.post('/')
 async def create_user_post(user_login, post: Post):
     try:
-        doc_ref = database.collection('users').document(user_login)
-        user_doc = doc_ref.get()
+        doc_ref = await root_collection_item_exist(database, 'users', user_login)
 
-        if user_doc.exists:
+        if doc_ref:
             post_obj_dict = post.dict()
             post_obj_dict.update({'created_at': post.created_at})
-            post_ref = doc_ref.collection('posts').add(post_obj_dict)
-            return JSONResponse({'post': post_ref.id}, status_code=200)
+            update_time, post_ref = await doc_ref.collection('posts').add(post_obj_dict)
+            return ORJSONResponse({'post': post_ref.id}, status_code=200)
 
         return HTTPException(detail={'message': f"The user {user_login} doesn't exist"}, status_code=400)
     except:
@@ -0,0 +1,42 @@
+from fastapi import APIRouter, Request, Query
+from fastapi.responses import ORJSONResponse
+from fastapi.exceptions import HTTPException
+
+from typing import List
+
+import lib
+
+router = APIRouter(
+    prefix='/presence',
+    tags=['presence'],
+)
+
+# Количество пользователей в одном запросе состояний
+PRESENCE_MAX_LOGINS = 500
+
+
+@router.get('/')
+async def get_presence(request: Request, login: List[str] = Query([])):
+    """
+    Состояния пользователей (в сети, отошел, не в сети) и время последней активности.
+    Отдаются из памяти воркера без обращения к базе
+    :param request: Объект запроса
+    :param login: Логины пользователей, параметр повторяется: ?login=a&login=b
+    :return:
+    """
+    try:
+        user = lib.get_user_from_token(lib.get_token_from_request(request))
+
+        if not user:
+            return HTTPException(detail={'message': f"Пользователь не авторизован"}, status_code=401)
+
+        if len(login) > PRESENCE_MAX_LOGINS:
+            return HTTPException(detail={'message': f"Не больше {PRESENCE_MAX_LOGINS} пользователей за запрос"},
+                                 status_code=400)
+
+        return ORJSONResponse(content={'presence': lib.presence_service.get_many(dict.fromkeys(login))},
+                              status_code=200)
+    except HTTPException as err:
+        return err
+    except:
+        return HTTPException(detail={'message': "Internal Error"}, status_code=500)
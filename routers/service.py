@@ -0,0 +1,33 @@
+from fastapi import APIRouter
+from fastapi.responses import ORJSONResponse
+
+from database.models import WebSocketManager
+from lib.cache import registry as cache_registry
+from lib import message_writer, password_hasher, chat_activity_writer, presence_service, chat_cache, \
+    notification_pipeline
+
+router = APIRouter(
+    prefix='/service',
+    tags=['service'],
+)
+
+websocket_manager = WebSocketManager()
+
+
+@router.get('/metrics')
+async def metrics():
+    """
+    Счетчики внутренних компонентов процесса: кэшей, очередей и т.д.
+    :return:
+    """
+    return ORJSONResponse(content={
+        'caches': cache_registry.stats(),
+        'websocket': websocket_manager.stats(),
+        'bus': websocket_manager.bus.stats() if websocket_manager.bus else None,
+        'password_hasher': password_hasher.stats(),
+        'message_writer': message_writer.stats() if message_writer else None,
+        'chat_activity': chat_activity_writer.stats(),
+        'presence': presence_service.stats(),
+        'chat_cache': chat_cache.stats(),
+        'notifications': notification_pipeline.stats(),
+    }, status_code=200)
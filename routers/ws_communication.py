@@ -1,8 +1,10 @@
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
 from fastapi.exceptions import HTTPException
+from pydantic import ValidationError
 
 from database.models import DataBaseConnector, WebSocketManager, \
-    WebSocketMessage, MessageType, Message, UserStatus, Chat, BaseUserModel, ResponseMessage
+    WebSocketMessage, MessageType, Message, UserStatus, Chat, ResponseMessage, ReadMark, Presence, PresenceStatus, \
+    Resume, EncodedFrame, timestamp_ms
 from config import Configuration
 
 import lib
@@ -27,7 +29,7 @@ CRYPT_ALGORITHM = config['crypt_settings']['algorithm']
 @router.websocket('/ws')
 async def communication(websocket: WebSocket, auth_token):
     user_model = lib.get_user_from_token(auth_token)
-    user_ref = lib.root_collection_item_exist(database, 'users', user_model.login)
+    user_ref = await lib.root_collection_item_exist(database, 'users', user_model.login)
 
     if not user_ref:
         return HTTPException(detail={'message': f"Пользователь не авторизован"}, status_code=401)
@@ -38,52 +40,110 @@ async def communication(websocket: WebSocket, auth_token):
     chat_ref = None
     chat_model = None
     chat_id = None
+    # Участники текущего чата кроме самого пользователя и версия состава, по которой они получены
+    chat_members = frozenset()
+    chat_members_version = None
 
-    await websocket_manager.connect(user_model, websocket)
+    opened_connection = await websocket_manager.connect(user_model, websocket)
+    lib.presence_service.connected(user_model.login)
 
     try:
         while True:
-            message_obj = WebSocketMessage(**(await websocket.receive_json()))
+            received = await opened_connection.receive()
+            try:
+                message_obj = WebSocketMessage(**received)
+            except (ValidationError, TypeError):
+                # Кадр разобран, но не подходит ни под одно сообщение; TypeError - ключи словаря не строки
+                raise HTTPException(400, 'Невозможно обработать запрос')
+            lib.presence_service.touch(user_model.login)
             if message_obj.type == MessageType.UPDATE_USER_STATUS:
                 if type(message_obj.content) == UserStatus:
-                    chat_ref = lib.root_collection_item_exist(database, 'chats', message_obj.content.chat_id)
+                    chat_ref = database.collection('chats').document(message_obj.content.chat_id)
+                    chat_members_version = lib.chat_membership.version(message_obj.content.chat_id)
+                    chat_dict = await lib.get_chat_document(database, message_obj.content.chat_id)
 
-                    if not chat_ref:
+                    if chat_dict is None:
                         raise HTTPException(detail={'message': f"Чата {message_obj.content.chat_id} не существует"},
                                             status_code=404)
 
-                    chat_doc_obj = (chat_ref.get()).to_dict()
-                    chat_model = Chat(**chat_doc_obj)
+                    chat_model = Chat(**chat_dict)
                     chat_id = message_obj.content.chat_id
+                    chat_members = frozenset(chat_model.members) - {user_model.login}
 
                     websocket_manager.update_user_status(user_model, message_obj.content)
             elif message_obj.type == MessageType.MESSAGE and chat_ref and chat_model:
                 if type(message_obj.content) == Message:
                     message = message_obj.content
-                    for member in chat_model.members:
-                        if user_model.login == member:
-                            continue
-                        member_ref = lib.root_collection_item_exist(database, 'users', member)
-                        member_doc_obj = (member_ref.get()).to_dict()
-                        member_model = BaseUserModel(**member_doc_obj)
-
-                        member_connection = websocket_manager[member_model.login]
-
-                        if member_connection:
-                            member_connection = member_connection.connection
-
-                        websocket_message = await lib.send_websocket_message(chat_id, message, member_connection)
-
-                    sent_message_info = chat_ref.collection('messages').add(message.dict())
+                    message.created_at = timestamp_ms()
+                    message.creator_login = user_model.login
+                    # Номер сообщения закрепляется в базе до рассылки: сообщения одного чата могут
+                    # приходить на разные воркеры. При отложенной записи сообщение только
+                    # ставится в буфер, а отправитель ждет лишь при заполненном буфере
+                    message_ref = await lib.save_message(chat_ref, message)
+
+                    if lib.chat_membership.version(chat_id) != chat_members_version:
+                        chat_members_version = lib.chat_membership.version(chat_id)
+                        chat_model = Chat(**(await lib.get_chat_document(database, chat_id)))
+                        chat_members = frozenset(chat_model.members) - {user_model.login}
+
+                    # Счетчики непрочитанных и последнее сообщение в метаданных чатов участников
+                    lib.chat_activity_writer.message_sent(chat_model, message)
+                    # Кэш чатов: открытие чата и досылка пропущенного после переподключения без чтения из базы
+                    lib.cache_sent_message(chat_id, chat_model, chat_members_version, message, message_ref.id)
+
+                    websocket_message = WebSocketMessage(
+                        type=MessageType.MESSAGE,
+                        content=message,
+                    )
 
                     response_message = ResponseMessage(
                         message=websocket_message,
                         chat_id=chat_id
                     )
-
-                    await websocket.send_json(response_message.dict())
+                    # Кадр кодируется один раз для каждого протокола на всех получателей и отправителя
+                    frame = EncodedFrame(response_message.dict())
+
+                    websocket_manager.broadcast(chat_members, frame)
+                    # Уведомления участникам, у которых чат не открыт, объединяются и записываются пакетами
+                    lib.notification_pipeline.message_sent(chat_id, chat_model, message)
+
+                    opened_connection.send(frame)
+            elif message_obj.type == MessageType.MARK_READ and type(message_obj.content) == ReadMark:
+                read_chat_id = message_obj.content.chat_id
+                if read_chat_id == chat_id:
+                    read_chat_model = chat_model
+                else:
+                    read_chat_dict = await lib.get_chat_document(database, read_chat_id)
+                    if read_chat_dict is None:
+                        raise HTTPException(detail={'message': f"Чата {read_chat_id} не существует"}, status_code=404)
+                    read_chat_model = Chat(**read_chat_dict)
+
+                if user_model.login not in read_chat_model.members:
+                    raise HTTPException(detail={'message': f"Пользователь {user_model.login} не является участником чата"},
+                                        status_code=403)
+
+                lib.chat_activity_writer.mark_read(read_chat_model, user_model.login)
+
+                # Отметка возвращается отправителю как подтверждение. У пользователя одно соединение
+                # (WebSocketManager хранит одно на логин), другие устройства получают unread = 0 из списка чатов
+                opened_connection.send(ResponseMessage(
+                    message=message_obj,
+                    chat_id=read_chat_id
+                ).dict())
+            elif message_obj.type == MessageType.RESUME and type(message_obj.content) == Resume:
+                # Клиент переподключился и сообщает, какие сообщения чатов уже получил
+                for frame in await lib.resume_chats(database, user_model.login, message_obj.content.chats):
+                    opened_connection.send(frame)
+            elif message_obj.type == MessageType.PRESENCE and type(message_obj.content) == Presence:
+                if message_obj.content.status == PresenceStatus.OFFLINE:
+                    raise HTTPException(400, 'Статус «не в сети» выставляется отключением')
+                lib.presence_service.set_status(user_model.login, message_obj.content.status)
             else:
                 raise HTTPException(400, 'Невозможно обработать запрос')
 
     except WebSocketDisconnect:
-        websocket_manager.disconnect(user_model)
+        pass
+    finally:
+        # Соединение убирается и при ошибке обработки кадра, иначе пользователь остался бы в сети
+        websocket_manager.disconnect(user_model, opened_connection)
+        lib.presence_service.disconnected(user_model.login)
@@ -0,0 +1,16 @@
+import os
+
+import pytest
+
+# Модули приложения читают настройки при импорте, поэтому путь задается до их загрузки
+os.environ.setdefault('CONFIG_PATH', os.path.join(os.path.dirname(__file__), 'settings.toml'))
+
+from database.storage.memory import MemoryClient  # noqa: E402
+
+
+@pytest.fixture
+def database():
+    """
+    Отдельное хранилище в памяти для каждого теста
+    """
+    return MemoryClient()
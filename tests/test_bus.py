@@ -0,0 +1,43 @@
+import asyncio
+
+from lib.bus import LOST_MESSAGE_TYPE, UnixSocketBus
+
+
+def test_gap_in_message_numbers_is_reported_as_lost(tmp_path):
+    async def scenario():
+        received = []
+        bus = UnixSocketBus(str(tmp_path))
+        await bus.start(received.append)
+        for number in (1, 2, 5, 6):
+            await bus._check_number('w1', number)
+        # Воркер, перезапущенный с тем же идентификатором, нумерует сообщения заново
+        await bus._check_number('w1', 1)
+        await bus.stop()
+        return received, bus.stats()['lost']
+
+    received, lost = asyncio.run(scenario())
+    assert received == [{'type': LOST_MESSAGE_TYPE, 'worker': 'w1', 'count': 2}]
+    assert lost == 2
+
+
+def test_messages_dropped_by_the_sender_are_seen_by_the_receiver(tmp_path, monkeypatch):
+    async def scenario():
+        received = []
+        sender, receiver = UnixSocketBus(str(tmp_path)), UnixSocketBus(str(tmp_path))
+        sender.worker_id, receiver.worker_id = 'sender', 'receiver'
+        await receiver.start(received.append)
+        monkeypatch.setattr('lib.bus.PEER_QUEUE_SIZE', 1)
+        # Очередь из одного сообщения занята приветствием, пока писатель не подключился
+        await sender.start(lambda message: None)
+        for index in range(3):
+            sender.publish('receiver', {'type': 'test', 'index': index})
+        await asyncio.sleep(0.1)
+        sender.publish('receiver', {'type': 'test', 'index': 3})
+        await asyncio.sleep(0.1)
+        await sender.stop()
+        await receiver.stop()
+        return received, sender.dropped
+
+    received, dropped = asyncio.run(scenario())
+    assert dropped == 3
+    assert received == [{'type': LOST_MESSAGE_TYPE, 'worker': 'sender', 'count': 3}, {'type': 'test', 'index': 3}]
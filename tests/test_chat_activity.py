@@ -0,0 +1,101 @@
+import asyncio
+
+from database.models import Chat, Message
+from lib.chat_activity import ChatActivityWriter, PendingActivity, message_preview, unread_count
+
+CHAT = Chat(chat_name='group', members=['anna', 'boris', 'clara'])
+
+
+def preview(created_at: int, seq: int):
+    return message_preview(Message(creator_login='anna', content='hi', created_at=created_at, seq=seq), 100)
+
+
+def test_merge_older_adds_unread_and_keeps_latest_values():
+    older = PendingActivity(None)
+    older.unread = 2
+    older.last_activity_at = 3000
+    older.set_last_message(preview(3000, 3))
+
+    newer = PendingActivity(None)
+    newer.unread = 1
+    newer.last_activity_at = 2000
+    newer.set_last_message(preview(2000, 2))
+    newer.merge_older(older)
+
+    assert newer.unread == 3
+    assert not newer.reset
+    assert newer.last_activity_at == 3000
+    assert newer.last_message.seq == 3
+
+
+def test_merge_older_after_reset_ignores_older_unread():
+    older = PendingActivity(None)
+    older.unread = 5
+
+    newer = PendingActivity(None)
+    newer.reset = True
+    newer.unread = 1
+    newer.merge_older(older)
+
+    assert newer.unread == 1
+    assert newer.fields() == {'unread': 1}
+
+
+def test_older_reset_is_kept_with_newer_unread():
+    older = PendingActivity(None)
+    older.reset = True
+
+    newer = PendingActivity(None)
+    newer.unread = 2
+    newer.merge_older(older)
+
+    assert newer.reset
+    assert newer.fields() == {'unread': 2}
+
+
+def test_messages_are_flushed_as_one_update_per_member(database):
+    async def scenario():
+        users = database.collection('users')
+        for login in CHAT.members:
+            await users.document(login).collection('chats').document('group').set({'unread': 0})
+
+        writer = ChatActivityWriter(database, flush_interval=60)
+        for seq in (1, 2, 3):
+            writer.message_sent(CHAT, Message(creator_login='anna', content=f'm{seq}', created_at=1000 + seq, seq=seq))
+        writer.mark_read(CHAT, 'clara')
+        await writer.stop()
+        documents = {login: (await users.document(login).collection('chats').document('group').get()).to_dict()
+                     for login in CHAT.members}
+        return documents, writer.stats()
+
+    documents, stats = asyncio.run(scenario())
+    assert [documents[login]['unread'] for login in CHAT.members] == [0, 3, 0]
+    assert all(document['last_message']['seq'] == 3 for document in documents.values())
+    assert stats['batches'] == 1
+    assert stats['written'] == 3
+
+
+def test_late_increment_from_another_worker_does_not_restore_cleared_unread(database):
+    async def scenario():
+        reference = database.collection('users').document('boris').collection('chats').document('group')
+        await reference.set({'unread': 0})
+
+        # Сообщение учтено на другом воркере, а его запись дошла до базы после отметки о прочтении
+        other_worker = ChatActivityWriter(database, flush_interval=60)
+        other_worker.message_sent(CHAT, Message(creator_login='anna', content='m1', created_at=1001, seq=1))
+        reader_worker = ChatActivityWriter(database, flush_interval=60)
+        reader_worker.mark_read(CHAT, 'boris')
+        await reader_worker.stop()
+        await other_worker.stop()
+        after_late_write = (await reference.get()).to_dict()
+
+        newer_worker = ChatActivityWriter(database, flush_interval=60)
+        newer_worker.message_sent(CHAT, Message(creator_login='anna', content='m2',
+                                                created_at=after_late_write['read_at'] + 1, seq=2))
+        await newer_worker.stop()
+        return after_late_write, (await reference.get()).to_dict()
+
+    after_late_write, after_new_message = asyncio.run(scenario())
+    assert after_late_write['unread'] == 1
+    assert unread_count(after_late_write) == 0
+    assert unread_count(after_new_message) > 0
@@ -0,0 +1,160 @@
+import asyncio
+
+import lib
+from database.models import Chat, Message
+from lib.chat_cache import ChatCache
+
+CHAT = Chat(chat_name='group', members=['anna', 'boris'])
+
+
+def message(seq: int, creator_login: str = 'anna') -> Message:
+    return Message(seq=seq, creator_login=creator_login, content=f'message {seq}', created_at=1000 + seq)
+
+
+def documents(*seqs: int):
+    return [(f'id-{seq}', message(seq)) for seq in seqs]
+
+
+def cache_with_chat(**options) -> ChatCache:
+    cache = ChatCache(**options)
+    cache.set_chat('chat', CHAT.dict(), members_version=0)
+    return cache
+
+
+def test_latest_page_keeps_document_ids():
+    cache = cache_with_chat()
+    cache.fill('chat', documents(3, 4, 5), complete=False)
+
+    page, has_more = cache.latest('chat', 2)
+    assert [(document_id, cached.seq) for document_id, cached in page] == [('id-4', 4), ('id-5', 5)]
+    assert has_more
+
+    # Страница не полная и начала чата в буфере нет - ответ только из базы
+    assert cache.latest('chat', 5) is None
+
+
+def test_complete_chat_is_served_even_when_shorter_than_the_page():
+    cache = cache_with_chat()
+    cache.fill('chat', documents(1, 2), complete=True)
+
+    page, has_more = cache.latest('chat', 10)
+    assert [cached.seq for _, cached in page] == [1, 2]
+    assert not has_more
+
+
+def test_fill_keeps_newer_contiguous_messages_from_the_buffer():
+    cache = cache_with_chat()
+    cache.append('chat', CHAT, 0, message(6), 'id-6')
+    cache.append('chat', CHAT, 0, message(8), 'id-8')
+    cache.fill('chat', documents(4, 5), complete=False)
+
+    page, _ = cache.latest('chat', 3)
+    assert [(document_id, cached.seq) for document_id, cached in page] == [('id-4', 4), ('id-5', 5), ('id-6', 6)]
+
+
+def test_out_of_order_messages_are_sorted():
+    cache = cache_with_chat()
+    cache.fill('chat', documents(1), complete=True)
+    cache.append_remote('chat', message(3), 'id-3')
+    cache.append('chat', CHAT, 0, message(2), 'id-2')
+    cache.append('chat', CHAT, 0, message(2), 'id-2')
+
+    assert [cached.seq for cached in cache.since('chat', 0)] == [1, 2, 3]
+
+
+def test_since_misses_on_gaps_and_evicted_messages():
+    cache = cache_with_chat(length=3)
+    cache.fill('chat', documents(1, 2, 3), complete=True)
+    cache.append('chat', CHAT, 0, message(4), 'id-4')
+
+    assert [cached.seq for cached in cache.since('chat', 2)] == [3, 4]
+    # Сообщение 2 вытеснено из буфера
+    assert cache.since('chat', 0) is None
+
+    cache.append('chat', CHAT, 0, message(6), 'id-6')
+    assert cache.since('chat', 3) is None
+    assert cache.stats()['replay_misses'] == 2
+
+
+def test_renumbered_message_moves_and_leaves_a_gap_until_refilled():
+    cache = cache_with_chat()
+    cache.fill('chat', documents(1), complete=True)
+    sent = message(2)
+    cache.append('chat', CHAT, 0, sent, 'id-2')
+
+    renumbered = sent.copy(update={'seq': 3})
+    cache.renumber('chat', 2, renumbered, 'id-3')
+    assert cache.latest('chat', 10) is None
+
+    cache.fill('chat', [('id-1', message(1)), ('id-2', message(2, 'boris')), ('id-3', renumbered)], complete=True)
+    page, _ = cache.latest('chat', 10)
+    assert [(document_id, cached.seq, cached.creator_login) for document_id, cached in page] == \
+        [('id-1', 1, 'anna'), ('id-2', 2, 'boris'), ('id-3', 3, 'anna')]
+
+
+def test_least_recently_used_chat_is_evicted_over_budget():
+    cache = ChatCache(memory_budget=6000)
+    for chat_id in ('old', 'recent', 'new'):
+        cache.set_chat(chat_id, CHAT.dict(), members_version=0)
+        cache.fill(chat_id, documents(1, 2), complete=True)
+    cache.latest('recent', 1)
+    cache.set_chat('newest', CHAT.dict(), members_version=0)
+    cache.fill('newest', documents(1, 2, 3, 4), complete=True)
+
+    assert cache.get_chat('old', 0) is None
+    assert cache.get_chat('newest', 0) is not None
+    assert cache.size <= cache.memory_budget
+    assert cache.stats()['evicted'] >= 1
+
+
+def test_tail_is_current_until_ttl_expires():
+    cache = cache_with_chat(tail_ttl=60)
+    assert not cache.current('chat')
+    cache.fill('chat', documents(1, 2), complete=True)
+    assert cache.current('chat')
+
+    cache.tail_ttl = 0
+    assert not cache.current('chat')
+    # Сообщение 3 еще не записано отложенной записью - база отстает от буфера, это не пропуск
+    cache.append('chat', CHAT, 0, message(3), 'id-3')
+    assert cache.confirm('chat', 2)
+    assert not cache.confirm('chat', 4)
+    assert cache.stats()['stale_tails'] == 1
+
+
+def test_latest_page_falls_back_to_storage_when_another_host_wrote(database, monkeypatch):
+    async def scenario():
+        chat_ref = database.collection('chats').document('tail')
+        messages = chat_ref.collection('messages')
+        for seq in (1, 2):
+            await messages.document(lib.message_document_id(seq)).create(message(seq).dict())
+        lib.chat_cache.set_chat('tail', CHAT.dict(), members_version=0)
+        first, _ = await lib.get_chat_messages(chat_ref, 10)
+
+        # Сообщение записано воркером, от которого этот воркер ничего не получает
+        await messages.document(lib.message_document_id(3)).create(message(3).dict())
+        cached, _ = await lib.get_chat_messages(chat_ref, 10)
+        monkeypatch.setattr(lib.chat_cache, 'tail_ttl', 0)
+        checked, _ = await lib.get_chat_messages(chat_ref, 10)
+        return [[item['seq'] for item in page] for page in (first, cached, checked)]
+
+    assert asyncio.run(scenario()) == [[1, 2], [1, 2], [1, 2, 3]]
+
+
+def test_resume_reads_storage_only_after_messages_may_have_been_lost(database):
+    async def scenario():
+        chat_ref = database.collection('chats').document('resume')
+        messages = chat_ref.collection('messages')
+        for seq in (1, 2, 3):
+            await messages.document(lib.message_document_id(seq)).create(message(seq).dict())
+        lib.chat_cache.set_chat('resume', CHAT.dict(), lib.chat_membership.version('resume'))
+        await lib.get_chat_messages(chat_ref, 10)
+
+        # Сообщение 4 записал другой воркер, а сообщение шины о нем потерялось
+        await messages.document(lib.message_document_id(4)).create(message(4).dict())
+        replays = [await lib.resume_chats(database, 'anna', {'resume': 2})]
+        lib.chat_cache.mark_stale()
+        replays.append(await lib.resume_chats(database, 'anna', {'resume': 2}))
+        return [[cached['seq'] for cached in frames[0]['message']['content']['messages']] for frames in replays]
+
+    assert asyncio.run(scenario()) == [[3], [3, 4]]
@@ -0,0 +1,50 @@
+import asyncio
+
+from lib import counters
+
+
+async def increment(database, login: str, field: str, amount: int):
+    user_ref = database.collection('users').document(login)
+    batch = database.batch()
+    counters.increment(batch, user_ref, (await user_ref.get()).to_dict(), field, amount)
+    await batch.commit()
+
+
+async def read(database, login: str):
+    user_ref = database.collection('users').document(login)
+    user_dict = (await user_ref.get()).to_dict()
+    return user_dict, await counters.read(database, user_ref, user_dict)
+
+
+def test_counter_is_kept_on_the_user_below_the_threshold(database):
+    async def scenario():
+        await database.collection('users').document('anna').set({'login': 'anna'})
+        await increment(database, 'anna', counters.FOLLOWERS_FIELD, 1)
+        await increment(database, 'anna', counters.FOLLOWING_FIELD, 2)
+        await increment(database, 'anna', counters.FOLLOWING_FIELD, -1)
+        return await read(database, 'anna')
+
+    user_dict, counts = asyncio.run(scenario())
+    assert counts == {counters.FOLLOWERS_FIELD: 1, counters.FOLLOWING_FIELD: 1}
+    assert counters.SHARDS_FIELD not in user_dict
+
+
+def test_counter_switches_to_shards_at_the_threshold(database, monkeypatch):
+    monkeypatch.setattr(counters, 'CELEBRITY_THRESHOLD', 3)
+    monkeypatch.setattr(counters, 'SHARDS', 4)
+
+    async def scenario():
+        await database.collection('users').document('anna').set({'login': 'anna', counters.FOLLOWERS_FIELD: 2})
+        await increment(database, 'anna', counters.FOLLOWERS_FIELD, 1)
+        switched, _ = await read(database, 'anna')
+        for _ in range(5):
+            await increment(database, 'anna', counters.FOLLOWERS_FIELD, 1)
+        await increment(database, 'anna', counters.FOLLOWERS_FIELD, -2)
+        user_dict, counts = await read(database, 'anna')
+        return switched, user_dict, counts
+
+    switched, user_dict, counts = asyncio.run(scenario())
+    assert switched[counters.SHARDS_FIELD] == 4
+    # Изменения после переключения идут в шарды, поле пользователя не меняется
+    assert user_dict[counters.FOLLOWERS_FIELD] == 3
+    assert counts[counters.FOLLOWERS_FIELD] == 6
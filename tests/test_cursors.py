@@ -0,0 +1,31 @@
+import pytest
+from fastapi.exceptions import HTTPException
+
+from lib import decode_cursor, decode_cursor_fields, encode_cursor, encode_cursor_fields
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor(42)) == 42
+    assert decode_cursor(encode_cursor('anna', 'login'), 'login', str) == 'anna'
+
+
+@pytest.mark.parametrize('token', [
+    'not base64 json',
+    encode_cursor('42'),
+    encode_cursor(42, 'login'),
+])
+def test_bad_cursor_is_rejected(token):
+    with pytest.raises(HTTPException) as error:
+        decode_cursor(token)
+    assert error.value.status_code == 400
+
+
+def test_cursor_fields_round_trip():
+    values = {'last_activity_at': 1000, 'chat_id': 'abc'}
+    assert decode_cursor_fields(encode_cursor_fields(values), {'last_activity_at': int, 'chat_id': str}) == values
+
+
+def test_cursor_missing_a_field_is_rejected():
+    with pytest.raises(HTTPException) as error:
+        decode_cursor_fields(encode_cursor(1000, 'last_activity_at'), {'last_activity_at': int, 'chat_id': str})
+    assert error.value.status_code == 400
@@ -0,0 +1,157 @@
+import asyncio
+
+import orjson
+import pytest
+
+from database.models import Chat, Message, MessageType, UserStatus
+from database.storage.sqlite import SQLiteClient
+from lib import notifications
+from lib.notifications import NotificationPipeline, mark_read, plural
+
+CHAT = Chat(chat_name='group', members=['anna', 'boris', 'clara'])
+
+
+class Connection:
+    def __init__(self, chat_id=None):
+        self.user_status = UserStatus(chat_id=chat_id, auth_token='token') if chat_id else None
+
+
+class FakeWebSocketManager:
+    """
+    Подключенные пользователи и кадры, разосланные им
+    """
+
+    def __init__(self, connections=None):
+        self.connections = connections or {}
+        self.frames = []
+
+    def __getitem__(self, login):
+        return self.connections.get(login)
+
+    def broadcast(self, logins, frame):
+        self.frames.extend((login, orjson.loads(frame.json)) for login in logins)
+        return len(logins)
+
+
+@pytest.mark.parametrize('count, word', [
+    (1, 'сообщение'), (2, 'сообщения'), (5, 'сообщений'), (11, 'сообщений'),
+    (12, 'сообщений'), (21, 'сообщение'), (22, 'сообщения'), (111, 'сообщений'),
+])
+def test_plural(count, word):
+    assert plural(count, 'сообщение', 'сообщения', 'сообщений') == word
+
+
+async def create_users(database, *logins):
+    for login in logins:
+        await database.collection('users').document(login).set({'login': login})
+
+
+async def stored_notifications(database, login):
+    collection = database.collection('users').document(login).collection('notifications')
+    return [document.to_dict() async for document in collection.stream()]
+
+
+async def unread(database, login):
+    return (await database.collection('users').document(login).get()).to_dict().get(notifications.UNREAD_FIELD)
+
+
+def test_messages_in_one_window_are_coalesced(database):
+    # Клара смотрит этот чат и уведомлений о нем не получает
+    manager = FakeWebSocketManager({'boris': Connection(), 'clara': Connection('chat')})
+
+    async def scenario():
+        await create_users(database, *CHAT.members)
+        pipeline = NotificationPipeline(database, manager, coalesce_window=60)
+        for seq in range(1, 6):
+            pipeline.message_sent('chat', CHAT, Message(creator_login='anna', content='hi', created_at=1000 + seq,
+                                                        seq=seq))
+        await pipeline.stop()
+        return {login: await stored_notifications(database, login) for login in CHAT.members}, \
+            await unread(database, 'boris'), pipeline.stats()
+
+    stored, boris_unread, stats = asyncio.run(scenario())
+    assert stored['anna'] == [] and stored['clara'] == []
+    [notification] = stored['boris']
+    assert notification['description'] == '5 новых сообщений в чате group'
+    assert notification['count'] == 5
+    assert notification['received_at'] == 1005
+    assert boris_unread == 1
+    assert stats['written'] == 1 and stats['batches'] == 1
+
+    [(login, frame)] = manager.frames
+    assert login == 'boris'
+    assert frame['message']['type'] == MessageType.NOTIFICATION
+    assert frame['message']['content']['count'] == 5
+
+
+def test_missing_recipient_does_not_block_the_others(database):
+    async def scenario():
+        await create_users(database, 'anna')
+        pipeline = NotificationPipeline(database, FakeWebSocketManager(), coalesce_window=60)
+        pipeline.followed('boris', ['anna', 'deleted'])
+        pipeline.followed('clara', ['anna'])
+        await pipeline.stop()
+        return await stored_notifications(database, 'anna'), await unread(database, 'anna'), pipeline.stats()
+
+    [notification], anna_unread, stats = asyncio.run(scenario())
+    assert notification['description'] == '2 новых подписчика'
+    assert anna_unread == 1
+    assert stats['missing'] == 1
+
+
+def test_mark_read_by_ids_and_all(database):
+    async def scenario():
+        await create_users(database, 'anna')
+        pipeline = NotificationPipeline(database, FakeWebSocketManager(), coalesce_window=60)
+        for follower in ('boris', 'clara', 'dmitry'):
+            pipeline.notify(['anna'], notifications.Notification(description=follower, user=follower, chat_id=None))
+        await pipeline.stop()
+
+        collection = database.collection('users').document('anna').collection('notifications')
+        first_id = [document.id async for document in collection.stream()][0]
+        by_id = await mark_read(database, 'anna', [first_id, first_id, 'missing'])
+        again = await mark_read(database, 'anna', [first_id])
+        after_ids = await unread(database, 'anna')
+        everything = await mark_read(database, 'anna', all_notifications=True)
+        return by_id, again, after_ids, everything, await unread(database, 'anna')
+
+    assert asyncio.run(scenario()) == (1, 0, 2, 2, 0)
+
+
+def test_concurrent_mark_read_decrements_each_notification_once(tmp_path):
+    # В SQLite чтения идут через поток, поэтому запросы действительно выполняются вперемешку
+    database = SQLiteClient(str(tmp_path / 'notifications.sqlite3'))
+
+    async def scenario():
+        await create_users(database, 'anna')
+        pipeline = NotificationPipeline(database, FakeWebSocketManager(), coalesce_window=60)
+        for index in range(20):
+            pipeline.notify(['anna'], notifications.Notification(description=str(index), user='boris', chat_id=None))
+        await pipeline.stop()
+
+        ids = [document.id async for document in
+               database.collection('users').document('anna').collection('notifications').stream()]
+        marked = await asyncio.gather(mark_read(database, 'anna', all_notifications=True),
+                                      mark_read(database, 'anna', ids[:10]),
+                                      mark_read(database, 'anna', all_notifications=True))
+        return sum(marked), await unread(database, 'anna')
+
+    assert asyncio.run(scenario()) == (20, 0)
+
+
+def test_failed_push_does_not_write_notifications_twice(database):
+    class BrokenWebSocketManager(FakeWebSocketManager):
+        def broadcast(self, logins, frame):
+            raise RuntimeError('connection lost')
+
+    async def scenario():
+        await create_users(database, 'anna')
+        pipeline = NotificationPipeline(database, BrokenWebSocketManager(), coalesce_window=60, retry_backoff=60)
+        pipeline.followed('boris', ['anna'])
+        await pipeline.flush()
+        await pipeline.stop()
+        return await stored_notifications(database, 'anna'), pipeline.stats()
+
+    stored, stats = asyncio.run(scenario())
+    assert len(stored) == 1
+    assert stats['failures'] == 1 and stats['pending'] == 0
@@ -0,0 +1,59 @@
+import asyncio
+
+from database.models import PresenceStatus
+from lib.presence import PresenceService
+
+
+class FakeWebSocketManager:
+    """
+    Подключенные пользователи текущего воркера и разосланные им кадры
+    """
+
+    def __init__(self):
+        self.bus = None
+        self.bus_handlers = {}
+        self.connected = set()
+        self.frames = []
+
+    def __getitem__(self, login):
+        return object() if login in self.connected else None
+
+    def broadcast(self, logins, frame):
+        self.frames.extend(logins)
+        return len(logins)
+
+
+def test_audience_is_read_only_for_announcements_and_reused(database):
+    async def scenario():
+        users = database.collection('users')
+        await users.document('anna').set({'login': 'anna'})
+        await users.document('anna').collection('followers').document('boris').set({'login': 'boris'})
+
+        manager = FakeWebSocketManager()
+        presence = PresenceService(database, manager, debounce=0.05)
+
+        # Переподключения в пределах задержки ничего не объявляют и не читают получателей
+        for _ in range(5):
+            manager.connected.add('anna')
+            presence.connected('anna')
+            manager.connected.discard('anna')
+            presence.disconnected('anna')
+        await asyncio.sleep(0.1)
+        loads_after_reconnects = presence.stats()['audience_loads']
+
+        manager.connected.add('anna')
+        presence.connected('anna')
+        await asyncio.sleep(0.1)
+        manager.connected.discard('anna')
+        presence.disconnected('anna')
+        await asyncio.sleep(0.1)
+        await presence.stop()
+        return loads_after_reconnects, presence.stats(), manager.frames, presence.get_many(['anna'])['anna']
+
+    loads_after_reconnects, stats, frames, anna = asyncio.run(scenario())
+    assert loads_after_reconnects == 0
+    # «В сети» и «не в сети» разосланы подписчику по одному прочитанному списку
+    assert stats['announcements'] == 2
+    assert stats['audience_loads'] == 1
+    assert frames == ['boris', 'boris']
+    assert anna['status'] == PresenceStatus.OFFLINE
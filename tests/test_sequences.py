@@ -0,0 +1,37 @@
+import asyncio
+
+from lib import SequenceAllocator, message_document_id
+
+
+def test_sequence_continues_after_stored_messages(database):
+    async def scenario():
+        chat_ref = database.collection('chats').document('chat')
+        for seq in (1, 2, 3):
+            await chat_ref.collection('messages').document(message_document_id(seq)).create({'seq': seq})
+        allocator = SequenceAllocator()
+        return [await allocator.next(chat_ref) for _ in range(2)]
+
+    assert asyncio.run(scenario()) == [4, 5]
+
+
+def test_sequence_reset_rereads_storage_without_reissuing_numbers(database):
+    async def scenario():
+        chat_ref = database.collection('chats').document('chat')
+        messages = chat_ref.collection('messages')
+        allocator = SequenceAllocator()
+        issued = [await allocator.next(chat_ref) for _ in range(3)]
+
+        # Номера 1-3 еще в буфере отложенной записи, а другой воркер уже записал 10
+        await messages.document(message_document_id(10)).create({'seq': 10})
+        allocator.reset(chat_ref.id)
+        issued.append(await allocator.next(chat_ref))
+
+        # Номера, выданные до сброса, больше записанных в базе: счетчик не откатывается
+        other_ref = database.collection('chats').document('other')
+        issued.append(await allocator.next(other_ref))
+        issued.append(await allocator.next(other_ref))
+        allocator.reset(other_ref.id)
+        issued.append(await allocator.next(other_ref))
+        return issued
+
+    assert asyncio.run(scenario()) == [1, 2, 3, 11, 1, 2, 3]
@@ -0,0 +1,172 @@
+import asyncio
+
+import pytest
+
+from database import run_transaction
+from database.storage import ASCENDING, DESCENDING, DOCUMENT_ID, AlreadyExists, FieldFilter, Increment, Maximum, \
+    NotFound
+from database.storage.memory import MemoryClient
+from database.storage.sqlite import SQLiteClient
+
+USERS = {
+    'anna': {'age': 30, 'city': 'Moscow', 'tags': ['admin', 'staff'], 'score': 2.5},
+    'boris': {'age': 25, 'city': 'Kazan', 'tags': ['staff'], 'score': 7},
+    'clara': {'age': 30, 'city': 'Kazan', 'tags': [], 'score': 1},
+    'denis': {'age': 41, 'city': None, 'tags': ['guest']},
+    'elena': {'age': 25, 'city': 'Omsk', 'tags': ['staff', 'guest'], 'score': 4},
+}
+
+# Значения разных типов упорядочиваются как в Firestore: null, bool, числа, строки
+MIXED = {'a': None, 'b': True, 'c': False, 'd': 0, 'e': 1, 'f': 2.5, 'g': -3, 'h': '', 'i': 'x', 'j': 10}
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def client(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryClient()
+    return SQLiteClient(str(tmp_path / 'storage.sqlite3'))
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def fill(client, collection: str, documents: dict):
+    batch = client.batch()
+    for document_id, data in documents.items():
+        batch.set(client.collection(collection).document(document_id), data)
+    await batch.commit()
+
+
+async def ids(query):
+    return [snapshot.id async for snapshot in query.stream()]
+
+
+@pytest.mark.parametrize('field_filter, expected', [
+    (FieldFilter('city', 'in', ['Kazan', 'Omsk']), ['boris', 'clara', 'elena']),
+    (FieldFilter('city', '!=', 'Kazan'), ['anna', 'elena']),
+    (FieldFilter('tags', 'array_contains', 'staff'), ['anna', 'boris', 'elena']),
+    (FieldFilter('score', '>=', 4), ['boris', 'elena']),
+    (FieldFilter('age', '==', 30), ['anna', 'clara']),
+])
+def test_filters(client, field_filter, expected):
+    async def scenario():
+        await fill(client, 'users', USERS)
+        return await ids(client.collection('users').where(filter=field_filter))
+
+    assert run(scenario()) == expected
+
+
+def test_multi_field_order_and_cursors(client):
+    async def scenario():
+        await fill(client, 'users', USERS)
+        query = client.collection('users').order_by('age', direction=DESCENDING).order_by('city')
+        ordered = await ids(query)
+        after_fields = await ids(query.start_after({'age': 30, 'city': 'Kazan'}))
+        snapshot = await client.collection('users').document('clara').get()
+        after_snapshot = await ids(query.start_after(snapshot).limit(2))
+        by_id = await ids(client.collection('users').order_by('age').order_by(DOCUMENT_ID, direction=DESCENDING)
+                          .start_after({'age': 25, DOCUMENT_ID: 'elena'}))
+        return ordered, after_fields, after_snapshot, by_id
+
+    ordered, after_fields, after_snapshot, by_id = run(scenario())
+    # У denis город null: он идет раньше строк
+    assert ordered == ['denis', 'clara', 'anna', 'boris', 'elena']
+    assert after_fields == ['anna', 'boris', 'elena']
+    assert after_snapshot == ['anna', 'boris']
+    assert by_id == ['boris', 'clara', 'anna', 'denis']
+
+
+def test_order_by_skips_documents_without_the_field(client):
+    async def scenario():
+        await fill(client, 'users', USERS)
+        return await ids(client.collection('users').order_by('score', direction=DESCENDING))
+
+    assert run(scenario()) == ['boris', 'elena', 'anna', 'clara']
+
+
+@pytest.mark.parametrize('direction', [ASCENDING, DESCENDING])
+def test_mixed_type_order(client, direction):
+    async def scenario():
+        await fill(client, 'values', {document_id: {'value': value} for document_id, value in MIXED.items()})
+        query = client.collection('values').order_by('value', direction=direction)
+        ordered = await ids(query)
+        after_bool = await ids(query.start_after({'value': True}).limit(3))
+        after_number = await ids(query.start_after({'value': 1}).limit(3))
+        return ordered, after_bool, after_number
+
+    expected = ['a', 'c', 'b', 'g', 'd', 'e', 'f', 'j', 'h', 'i']
+    if direction == DESCENDING:
+        expected.reverse()
+    ordered, after_bool, after_number = run(scenario())
+    assert ordered == expected
+    assert after_bool == expected[expected.index('b') + 1:][:3]
+    assert after_number == expected[expected.index('e') + 1:][:3]
+
+
+def test_order_by_array_values(client):
+    async def scenario():
+        await fill(client, 'values', {'a': {'value': [10]}, 'b': {'value': [9]}, 'c': {'value': 'text'},
+                                      'd': {'value': [9, 1]}})
+        return await ids(client.collection('values').order_by('value'))
+
+    assert run(scenario()) == ['c', 'b', 'd', 'a']
+
+
+def test_transforms(client):
+    async def scenario():
+        counters = client.collection('counters')
+        await counters.document('c').set({'hits': 1, 'best': 5, 'flag': True})
+        await counters.document('c').update({'hits': Increment(2), 'best': Maximum(3), 'flag': Increment(1),
+                                             'nested.count': Increment(4)})
+        await counters.document('c').set({'best': Maximum(9), 'created': Increment(1)}, merge=True)
+        return (await counters.document('c').get()).to_dict()
+
+    assert run(scenario()) == {'hits': 3, 'best': 9, 'flag': 1, 'nested': {'count': 4}, 'created': 1}
+
+
+def test_write_option_exists(client):
+    async def scenario():
+        documents = client.collection('documents')
+        await documents.document('present').set({'value': 1})
+        errors = []
+
+        batch = client.batch()
+        batch.update(documents.document('present'), {'value': 2}, option=client.write_option(exists=True))
+        batch.update(documents.document('missing'), {'value': 2}, option=client.write_option(exists=True))
+        try:
+            await batch.commit()
+        except NotFound:
+            errors.append('update')
+
+        try:
+            await documents.document('present').delete(option=client.write_option(exists=False))
+        except AlreadyExists:
+            errors.append('delete')
+
+        await documents.document('present').delete(option=client.write_option(exists=True))
+        return errors, (await documents.document('present').get()).exists
+
+    # Пакет с невыполненным условием не применяется целиком
+    assert run(scenario()) == (['update', 'delete'], False)
+
+
+def test_transaction_is_retried_when_read_documents_change(client):
+    async def scenario():
+        reference = client.collection('counters').document('c')
+        await reference.set({'value': 1})
+        seen = []
+
+        async def double(transaction, counter_ref):
+            [snapshot] = [snapshot async for snapshot in client.get_all([counter_ref], transaction=transaction)]
+            seen.append(snapshot.get('value'))
+            if len(seen) == 1:
+                # Параллельная запись между чтением и фиксацией
+                await counter_ref.update({'value': Increment(10)})
+            transaction.update(counter_ref, {'value': snapshot.get('value') * 2})
+            return len(seen)
+
+        attempts = await run_transaction(client, double, reference)
+        return attempts, seen, (await reference.get()).get('value')
+
+    assert run(scenario()) == (2, [1, 11], 22)
@@ -0,0 +1,91 @@
+import asyncio
+
+from lib.write_behind import WriteBehindBuffer
+
+
+def make_buffer(database, **options):
+    return WriteBehindBuffer(database, **{'flush_interval': 0.01, 'retry_backoff': 0.01, **options})
+
+
+async def read(reference):
+    return (await reference.get()).to_dict()
+
+
+def test_writes_are_committed_in_batches(database):
+    async def scenario():
+        buffer = make_buffer(database, batch_size=2)
+        messages = database.collection('messages')
+        for index in range(5):
+            await buffer.put(messages.document(str(index)), {'index': index})
+        await buffer.stop()
+        return [await read(messages.document(str(index))) for index in range(5)], buffer.stats()
+
+    documents, stats = asyncio.run(scenario())
+    assert documents == [{'index': index} for index in range(5)]
+    assert stats['written'] == 5
+    assert stats['batches'] == 3
+    assert stats['buffered'] == 0
+
+
+def test_conflicting_write_calls_on_conflict_and_keeps_the_rest(database):
+    conflicts = []
+
+    async def scenario():
+        messages = database.collection('messages')
+        await messages.document('taken').create({'owner': 'other worker'})
+
+        async def on_conflict():
+            conflicts.append('taken')
+
+        buffer = make_buffer(database)
+        await buffer.put(messages.document('first'), {'owner': 'us'})
+        await buffer.put(messages.document('taken'), {'owner': 'us'}, on_conflict=on_conflict)
+        await buffer.put(messages.document('last'), {'owner': 'us'})
+        await buffer.stop()
+        return [await read(messages.document(document_id)) for document_id in ('first', 'taken', 'last')], \
+            buffer.stats()
+
+    documents, stats = asyncio.run(scenario())
+    assert documents == [{'owner': 'us'}, {'owner': 'other worker'}, {'owner': 'us'}]
+    assert conflicts == ['taken']
+    assert stats['conflicts'] == 1
+    assert stats['written'] == 3
+
+
+def test_failed_batch_is_retried(database, monkeypatch):
+    store = database._store
+    apply = store.apply
+    failures = [RuntimeError('unavailable')]
+
+    async def flaky_apply(writes):
+        if failures:
+            raise failures.pop()
+        await apply(writes)
+
+    monkeypatch.setattr(store, 'apply', flaky_apply)
+
+    async def scenario():
+        buffer = make_buffer(database)
+        reference = database.collection('messages').document('1')
+        await buffer.put(reference, {'content': 'hi'})
+        await buffer.stop()
+        return await read(reference), buffer.stats()
+
+    document, stats = asyncio.run(scenario())
+    assert document == {'content': 'hi'}
+    assert stats['retries'] == 1
+    assert stats['written'] == 1
+
+
+def test_full_buffer_makes_the_sender_wait(database):
+    async def scenario():
+        buffer = make_buffer(database, buffer_size=1, batch_size=1)
+        messages = database.collection('messages')
+        for index in range(3):
+            await buffer.put(messages.document(str(index)), {'index': index})
+        await buffer.stop()
+        return buffer.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats['written'] == 3
+    assert stats['backpressure_waits'] >= 1